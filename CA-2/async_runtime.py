@@ -0,0 +1,267 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from confluent_kafka import Consumer, KafkaException, Producer, TopicPartition
+
+import kafka_consumer
+from darooghe_codec import encode
+from darooghe_pulse import BURST_BLOCK_MIN, TransactionGenerator, serialize_event_block
+from event_pacer import PoissonPacer, peak_hour_rate
+from metrics import REGISTRY
+from state_checkpoint import PartitionStates
+
+
+QUEUE_BATCHES = int(os.getenv('QUEUE_BATCHES', 4))  # Batches buffered between pipeline tasks
+POLL_INTERVAL = float(os.getenv('PRODUCER_POLL_INTERVAL', 0.005))
+BACKOFF = 0.01
+
+
+class FutureProducer:
+    # Wraps a confluent_kafka Producer so every produce() also yields an asyncio future for its
+    # delivery report. Delivery callbacks run inside poll(), which only the event loop thread calls.
+    def __init__(self, producer, loop):
+        self.producer = producer
+        self.loop = loop
+        self.pending = []
+
+    def produce(self, topic, value = None, key = None, callback = None, on_delivery = None):
+        future = self.loop.create_future()
+        report = callback or on_delivery
+
+        def delivered(err, msg):
+            if report:
+                report(err, msg)
+            if not future.done():
+                if err is not None:
+                    future.set_exception(KafkaException(err))
+                else:
+                    future.set_result(msg)
+
+        self.producer.produce(topic, value = value, key = key, on_delivery = delivered)
+        self.pending.append(future)
+
+    def take_pending(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def poll(self, timeout = 0):
+        return self.producer.poll(timeout)
+
+    def flush(self, timeout = None):
+        return self.producer.flush(timeout) if timeout is not None else self.producer.flush()
+
+
+async def produce(producer, topic, key, value):
+    while True:
+        try:
+            producer.produce(topic, key = key, value = value)
+            return
+        except BufferError:
+            # Local queue is full: let delivery reports drain it without blocking the loop
+            producer.poll(0)
+            await asyncio.sleep(BACKOFF)
+
+
+def batch_offsets(msgs):
+    offsets = {}
+    for msg in msgs:
+        if not msg.error():
+            offsets[(msg.topic(), msg.partition())] = msg.offset() + 1
+    return [TopicPartition(topic, partition, offset) for (topic, partition), offset in offsets.items()]
+
+
+async def poll_producer(producer, done):
+    while not done.is_set():
+        producer.poll(0)
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def consume_batches(consumer, inbox, executor, stop, batch_size, linger_ms):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        # consume() blocks and releases the GIL, so it runs on its own thread
+        msgs = await loop.run_in_executor(executor, consumer.consume, batch_size, linger_ms / 1000)
+        if msgs:
+            await inbox.put(msgs)
+    await inbox.put(None)
+
+
+async def validate_batches(inbox, outbox, producer, state):
+    while True:
+        msgs = await inbox.get()
+        if msgs is None:
+            inbox.task_done()
+            await outbox.put(None)
+            return
+        started = time.perf_counter()
+        invalid_count = kafka_consumer.process_batch(msgs, producer, state)
+        await outbox.put((msgs, producer.take_pending(), invalid_count, started))
+        inbox.task_done()
+        if state is not None and state.checkpoint_due():
+            # Snapshots must match committed offsets: wait until every earlier batch is committed
+            await outbox.join()
+            state.checkpoint()
+        await asyncio.sleep(0)
+
+
+async def commit_batches(consumer, outbox, on_batch, state = None):
+    last_offsets = None
+    while True:
+        item = await outbox.get()
+        if item is None:
+            outbox.task_done()
+            break
+        msgs, futures, invalid_count, started = item
+        waited = time.perf_counter()
+        # Offsets are only committed once every error log of the batch is acknowledged
+        results = await asyncio.gather(*futures, return_exceptions = True)
+        failures = sum(isinstance(result, Exception) for result in results)
+        if failures:
+            logging.error(f"{failures} error logs of the batch could not be delivered")
+        last_offsets = batch_offsets(msgs)
+        if last_offsets:
+            consumer.commit(offsets = last_offsets, asynchronous = True)
+            if state is not None:
+                state.committed(last_offsets)
+        kafka_consumer.COMMIT_SECONDS.record(time.perf_counter() - waited)
+        REGISTRY.maybe_log()
+        outbox.task_done()
+        if on_batch:
+            on_batch(len(msgs), invalid_count, time.perf_counter() - started)
+    if last_offsets:
+        consumer.commit(offsets = last_offsets, asynchronous = False)
+
+
+async def generate_events(producer, generator, base_rate, peak_factor, stop, topic = kafka_consumer.TRANSACTIONS_TOPIC,
+                          limit = None):
+    # base_rate is in events per minute like EVENT_RATE; 0 produces as fast as the loop allows
+    pacer = PoissonPacer(peak_hour_rate(base_rate / 60.0, peak_factor), generator.np_rng) if base_rate else None
+    produced = 0
+    while not stop.is_set() and (limit is None or produced < limit):
+        if pacer is not None:
+            now = pacer.clock()
+            due = pacer.take_due(now)
+            if not due:
+                await asyncio.sleep(pacer.next_delay(now))
+                continue
+        else:
+            due = 1000
+        if limit is not None:
+            due = min(due, limit - produced)
+        if due >= BURST_BLOCK_MIN:
+            now = datetime.utcnow()
+            keys, payloads = serialize_event_block(generator.event_block(due, now, now))
+            for key, payload in zip(keys, payloads):
+                await produce(producer, topic, key, payload)
+        else:
+            for _ in range(due):
+                event = generator.event()
+                await produce(producer, topic, event["customer_id"], encode(event))
+        produced += due
+        await asyncio.sleep(0)
+    return produced
+
+
+def run_on_loop(loop, callback):
+    # Rebalance callbacks fire inside consume() on the consumer thread; run them on the loop so
+    # they never interleave with a batch being validated
+    def on_rebalance(consumer, partitions):
+        asyncio.run_coroutine_threadsafe(callback(consumer, partitions), loop).result()
+    return on_rebalance
+
+
+async def run_pipeline(consumer, producer, state = None, batch_size = kafka_consumer.BATCH_SIZE,
+                       linger_ms = kafka_consumer.BATCH_LINGER_MS, queue_batches = QUEUE_BATCHES,
+                       generator = None, event_rate = 0, peak_factor = 1.0, generate_limit = None,
+                       should_stop = lambda: False, on_batch = None, subscribe = False):
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'kafka-consume')
+    stop = asyncio.Event()
+    done = asyncio.Event()
+    # Bounded queues give backpressure: slow delivery stalls validation, which stalls fetching
+    inbox = asyncio.Queue(queue_batches)
+    outbox = asyncio.Queue(queue_batches)
+    failed = asyncio.Event()
+
+    if subscribe:
+        async def on_assign(consumer, partitions):
+            if state is not None:
+                state.on_assign(consumer, partitions)
+
+        async def on_revoke(consumer, partitions):
+            # Finish and commit what was fetched from these partitions before giving them up. Once a
+            # task has died nothing drains the queues: the uncommitted batches are redelivered instead.
+            if not failed.is_set():
+                await inbox.join()
+                await outbox.join()
+            if state is not None:
+                state.on_revoke(consumer, partitions)
+
+        consumer.subscribe([kafka_consumer.TRANSACTIONS_TOPIC], on_assign = run_on_loop(loop, on_assign),
+                           on_revoke = run_on_loop(loop, on_revoke))
+
+    async def watch():
+        while not should_stop():
+            await asyncio.sleep(0.01)
+        stop.set()
+
+    generated = 0
+    poller = asyncio.ensure_future(poll_producer(producer, done))
+    tasks = [
+        watch(),
+        consume_batches(consumer, inbox, executor, stop, batch_size, linger_ms),
+        validate_batches(inbox, outbox, FutureProducer(producer, loop), state),
+        commit_batches(consumer, outbox, on_batch, state),
+    ]
+    if generator is not None:
+        tasks.append(generate_events(producer, generator, event_rate, peak_factor, stop, limit = generate_limit))
+    tasks = [asyncio.ensure_future(task) for task in tasks]
+    try:
+        # A task that raises would leave the others blocked on its queue: stop them all and re-raise
+        await asyncio.wait(tasks, return_when = asyncio.FIRST_EXCEPTION)
+        for task in tasks:
+            if task.done() and task.exception() is not None:
+                raise task.exception()
+        if generator is not None:
+            generated = tasks[-1].result()
+    finally:
+        unfinished = [task for task in tasks if not task.done()]
+        if unfinished:
+            failed.set()
+            for task in unfinished:
+                task.cancel()
+            await asyncio.wait(unfinished)
+        done.set()
+        await poller
+        producer.flush(kafka_consumer.FLUSH_TIMEOUT)
+        if subscribe:
+            # close() revokes the partitions, whose callback needs the loop to still be running
+            await loop.run_in_executor(executor, consumer.close)
+        executor.shutdown(wait = True)
+    return generated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Validate (and optionally generate) transactions in one event loop")
+    parser.add_argument('--generate-rate', type = float, default = float(os.getenv('ASYNC_EVENT_RATE', 0)),
+                        help = "also produce events at this rate (events/min, like EVENT_RATE); 0 = consume only")
+    parser.add_argument('--peak-factor', type = float, default = float(os.getenv('PEAK_FACTOR', 2.5)))
+    parser.add_argument('--seed', type = int, default = None)
+    args = parser.parse_args()
+
+    REGISTRY.serve()
+    consumer = Consumer(REGISTRY.client_conf(kafka_consumer.batch_conf))
+    producer = Producer(REGISTRY.client_conf({'bootstrap.servers': kafka_consumer.KAFKA_BROKER}))
+    state = PartitionStates(kafka_consumer.build_stages)
+    generator = TransactionGenerator(seed = args.seed) if args.generate_rate else None
+    kafka_consumer.wait_for_topic(consumer)
+    try:
+        asyncio.run(run_pipeline(consumer, producer, state, generator = generator, event_rate = args.generate_rate,
+                                 peak_factor = args.peak_factor, subscribe = True))
+    except KeyboardInterrupt:
+        logging.info("Shutting down async runtime...")
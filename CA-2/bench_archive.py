@@ -0,0 +1,172 @@
+"""Compare the Parquet archive with the JSON Kafka messages it replaces.
+
+Generates `--events` transactions over a day, about 90% of them valid, and
+encodes them as the consumer's Kafka messages would be: valid transactions as
+they are, invalid ones as error logs embedding the original transaction. Then
+archives the same records. Reports bytes on disk and the time to answer a
+one-hour query from each format; both answers must agree. Rejected records with
+unreadable timestamps or non-finite and oversized amounts must be archived too,
+with nulls in those columns. A slow stream (100 events a minute, far below a
+row group) must reach finished files within ARCHIVE_FLUSH_SECONDS.
+
+    python bench_archive.py --events 1000000
+"""
+import argparse
+import copy
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from columnar_validator import validate_batch
+from darooghe_codec import decode, encode
+from darooghe_pulse import TransactionGenerator, serialize_event_block
+from fake_kafka import sample_transaction
+from parquet_archive import ParquetArchive, scan
+
+
+def directory_bytes(root):
+    return sum(os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(root) for name in names)
+
+
+def json_query(messages, start, end, errors = False):
+    # Declined amount per merchant in [start, end), decoding every message like a consumer would
+    start, end = start.isoformat(), end.isoformat()
+    totals = {}
+    for message in messages:
+        record = decode(message)
+        if errors:
+            record = record["original_data"]
+        if start <= record["timestamp"][:-1] < end and record["status"] == "declined":
+            totals[record["merchant_id"]] = totals.get(record["merchant_id"], 0) + record["amount"]
+    return totals
+
+
+def parquet_query(directory, start, end, kind = 'transactions'):
+    table = scan(directory, kind, start, end, columns = ['merchant_id', 'amount'],
+                 filter = ds.field('status') == 'declined')
+    grouped = table.group_by('merchant_id').aggregate([('amount', 'sum')])
+    return dict(zip(grouped['merchant_id'].to_pylist(), grouped['amount_sum'].to_pylist()))
+
+
+def check_malformed(now):
+    # (timestamp, amount) pairs a producer may send; JSON's Infinity decodes to float('inf')
+    cases = [("not a time", 50000), (None, json.loads('Infinity')), (1714564800, float('nan')), ("garbage", 1e30)]
+    rejected = []
+    for timestamp, amount in cases:
+        transaction = copy.deepcopy(sample_transaction(0, now))
+        transaction["timestamp"], transaction["amount"] = timestamp, amount
+        rejected.append(transaction)
+    errors = [[{"code": "ERR_TIME", "message": "Invalid timestamp format"}]] * len(rejected)
+    with tempfile.TemporaryDirectory() as directory:
+        archive = ParquetArchive(directory)
+        archive.reject(rejected, errors)
+        archive.close()
+        table = scan(directory, 'errors', filter = ds.field('timestamp').is_null())
+        amounts = sorted(table['amount'].to_pylist(), key = lambda amount: amount is None)
+    ok = table.num_rows == len(cases) and amounts == [50000, None, None, None]
+    print(f"malformed rejects: {table.num_rows}/{len(cases)} archived with a null timestamp, amounts {amounts} "
+          f"{'ok' if ok else 'NOT ARCHIVED'}")
+    return ok
+
+
+class ManualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def check_slow_stream(now, rate_per_minute = 100, minutes = 20, flush_seconds = 300):
+    # One batch a minute: without age-based writes nothing would reach disk before a row group fills
+    clock = ManualClock()
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        archive = ParquetArchive(directory, flush_seconds = flush_seconds, clock = clock)
+        for minute in range(minutes):
+            clock.now = minute * 60.0
+            start = minute * rate_per_minute
+            archive.process([sample_transaction(i, now) for i in range(start, start + rate_per_minute)], None)
+            # Every row buffered at least flush_seconds ago must be in a finished file
+            due = max(0, minute - flush_seconds // 60 + 1) * rate_per_minute
+            on_disk = scan(directory, 'transactions').num_rows if due else 0
+            ok = ok and on_disk >= due
+        archive.close()
+    print(f"slow stream: {on_disk:,} of {minutes * rate_per_minute:,} rows in finished files after {minutes} min "
+          f"(flush after {flush_seconds}s) {'ok' if ok else 'ROWS STILL BUFFERED'}")
+    return ok
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type = int, default = 1000000)
+    parser.add_argument('--batch-size', type = int, default = 500)
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+
+    end = datetime(2025, 5, 2)
+    generator = TransactionGenerator(seed = args.seed)
+    payloads = serialize_event_block(generator.event_block(args.events, end - timedelta(hours = 24), end))[1]
+    transactions = [json.loads(payload) for payload in payloads]
+    # Generated totals include the commission, which the validator rejects; make 90% of them pass
+    for i, transaction in enumerate(transactions):
+        if i % 10:
+            transaction["total_amount"] = transaction["amount"] + transaction["vat_amount"]
+
+    valid_messages, error_messages = [], []
+    with tempfile.TemporaryDirectory() as directory:
+        archive = ParquetArchive(directory)
+        write_seconds = 0.0
+        for offset in range(0, len(transactions), args.batch_size):
+            batch = transactions[offset:offset + args.batch_size]
+            batch_errors = validate_batch(batch, end)
+            valid = [t for i, t in enumerate(batch) if i not in batch_errors]
+            invalid = sorted(batch_errors)
+            valid_messages.extend(encode(t) for t in valid)
+            error_messages.extend(encode({"transaction_id": batch[i]["transaction_id"], "errors": batch_errors[i],
+                                          "original_data": batch[i]}) for i in invalid)
+            started = time.perf_counter()
+            archive.process(valid, None)
+            archive.reject([batch[i] for i in invalid], [batch_errors[i] for i in invalid])
+            write_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        archive.close()
+        write_seconds += time.perf_counter() - started
+        print(f"{args.events:,} events: {len(valid_messages):,} valid, {len(error_messages):,} error logs; "
+              f"archived in {write_seconds:.2f}s ({args.events / write_seconds:,.0f} rows/s), "
+              f"{archive.files_written} files")
+
+        ok = True
+        for kind, messages in (('transactions', valid_messages), ('errors', error_messages)):
+            json_mb = sum(len(m) for m in messages) / 2**20
+            parquet_mb = directory_bytes(os.path.join(directory, kind)) / 2**20
+            query_start = end - timedelta(hours = 6)
+            query_end = query_start + timedelta(hours = 1)
+            expected, json_seconds = timed(json_query, messages, query_start, query_end, errors = kind == 'errors')
+            found, parquet_seconds = timed(parquet_query, directory, query_start, query_end, kind)
+            full, full_seconds = timed(scan, directory, kind)
+            matches = expected == found and full.num_rows == len(messages)
+            ok = ok and matches
+            print(f"{kind:>12}: JSON {json_mb:7.1f} MB, Parquet {parquet_mb:6.1f} MB ({json_mb / parquet_mb:4.1f}x smaller) | "
+                  f"1 h declined-by-merchant: JSON {json_seconds:6.2f}s, Parquet {parquet_seconds * 1000:6.1f} ms "
+                  f"({json_seconds / parquet_seconds:,.0f}x) | full scan {full_seconds:.2f}s "
+                  f"{'ok' if matches else 'RESULTS DIFFER'}")
+            if kind == 'errors' and full.num_rows:
+                codes = pc.value_counts(pc.list_flatten(full['error_codes'])).to_pylist()
+                summary = ', '.join(f"{c['values']}={c['counts']:,}" for c in codes)
+                print(f"{'':>12}  error codes: {summary}")
+    ok = check_malformed(end) and ok
+    ok = check_slow_stream(end) and ok
+    if not ok:
+        raise SystemExit(1)
@@ -0,0 +1,151 @@
+"""Compare the blocking batch consumer with the asyncio runtime on a fake broker.
+
+Every fetch, synchronous commit and delivery report pays a simulated broker
+round trip. The blocking loop waits for each of them in turn; the async
+runtime overlaps fetching, validation and delivery. The "both" scenario hosts
+the generator in the same process: blocking produces everything first and then
+consumes, async does both at once. A last run has a stage fail halfway through
+and checks that the async runtime stops with its error instead of hanging.
+
+    python bench_async.py --messages 100000 --fetch-ms 5 --round-trip-ms 5 --commit-ms 5
+"""
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+import async_runtime
+import kafka_consumer
+from darooghe_pulse import TransactionGenerator, serialize_event_block
+from event_sinks import KafkaSink
+from fake_kafka import BrokerConsumer, BrokerProducer, FakeBroker, transaction_messages
+from state_checkpoint import PartitionStates
+
+
+def preloaded_broker(count):
+    broker = FakeBroker()
+    for msg in transaction_messages(count):
+        broker.append(msg.topic(), msg.key(), msg.value())
+    return broker
+
+
+def connect(broker, args):
+    consumer = BrokerConsumer(broker, fetch_ms = args.fetch_ms, commit_ms = args.commit_ms)
+    consumer.subscribe([kafka_consumer.TRANSACTIONS_TOPIC])
+    return consumer, BrokerProducer(broker, round_trip_ms = args.round_trip_ms)
+
+
+def generate_blocking(producer, count, seed):
+    generator = TransactionGenerator(seed = seed)
+    now = datetime.utcnow()
+    sink = KafkaSink(producer, kafka_consumer.TRANSACTIONS_TOPIC)
+    for offset in range(0, count, 1000):
+        sink.write_many(*serialize_event_block(generator.event_block(min(1000, count - offset), now, now)))
+    sink.flush()
+
+
+def run_blocking(broker, args, generate = 0):
+    consumer, producer = connect(broker, args)
+    state = PartitionStates(kafka_consumer.build_stages, directory = None)
+    started = time.perf_counter()
+    if generate:
+        generate_blocking(producer, generate, args.seed)
+    kafka_consumer.run_batch_consumer(consumer, producer, batch_size = args.batch_size, linger_ms = args.linger_ms,
+                                      should_stop = lambda: consumer.lag() == 0, state = state)
+    return time.perf_counter() - started, consumer, producer
+
+
+def run_async(broker, args, generate = 0):
+    consumer, producer = connect(broker, args)
+    state = PartitionStates(kafka_consumer.build_stages, directory = None)
+    generator = TransactionGenerator(seed = args.seed) if generate else None
+
+    def should_stop():
+        # Stop fetching once the generator is done and everything produced has been fetched
+        return (not generate or broker.size(kafka_consumer.TRANSACTIONS_TOPIC) >= generate) and consumer.lag() == 0
+
+    started = time.perf_counter()
+    asyncio.run(async_runtime.run_pipeline(
+        consumer, producer, state, batch_size = args.batch_size, linger_ms = args.linger_ms,
+        queue_batches = args.queue_batches, generator = generator, generate_limit = generate or None,
+        should_stop = should_stop))
+    return time.perf_counter() - started, consumer, producer
+
+
+class FailingStage:
+    # Fails on the n-th batch it sees, like a bug in a stage
+    name = 'failing'
+
+    def __init__(self, after_batches):
+        self.batches = 0
+        self.after_batches = after_batches
+
+    def process(self, transactions, producer):
+        self.batches += 1
+        if self.batches > self.after_batches:
+            raise RuntimeError("stage failed")
+
+    def get_state(self):
+        return None
+
+    def set_state(self, state):
+        pass
+
+
+def check_failure(args, count = 20000, timeout = 10):
+    broker = preloaded_broker(count)
+    consumer, producer = connect(broker, args)
+    failing = FailingStage(after_batches = count // args.batch_size // 2)
+    state = PartitionStates(lambda: kafka_consumer.build_stages() + [failing], directory = None)
+    pipeline = async_runtime.run_pipeline(consumer, producer, state, batch_size = args.batch_size,
+                                          linger_ms = args.linger_ms, queue_batches = args.queue_batches,
+                                          should_stop = lambda: consumer.lag() == 0, subscribe = True)
+    try:
+        asyncio.run(asyncio.wait_for(pipeline, timeout))
+        outcome = "returned"
+    except RuntimeError:
+        outcome = "raised"
+    except asyncio.TimeoutError:
+        outcome = "HUNG"
+    committed = sum(consumer.committed_offsets.values())
+    ok = outcome == "raised" and consumer.closed and committed <= failing.after_batches * args.batch_size
+    print(f"failing stage: run {outcome}, committed {committed:,} of {count:,} {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+def report(name, count, elapsed, consumer, producer):
+    committed = sum(consumer.committed_offsets.values())
+    errors = sum(msg.topic() == kafka_consumer.ERROR_TOPIC for msg in producer.delivered)
+    print(f"{name:>14}: {count:,} messages in {elapsed:6.2f}s ({count / elapsed:9,.0f} msg/s), "
+          f"committed {committed:,}, {errors:,} error logs delivered, {consumer.commit_count:,} commits")
+    return committed, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type = int, default = 100000)
+    parser.add_argument('--fetch-ms', type = float, default = 5.0)
+    parser.add_argument('--round-trip-ms', type = float, default = 5.0)
+    parser.add_argument('--commit-ms', type = float, default = 5.0)
+    parser.add_argument('--batch-size', type = int, default = kafka_consumer.BATCH_SIZE)
+    parser.add_argument('--linger-ms', type = int, default = kafka_consumer.BATCH_LINGER_MS)
+    parser.add_argument('--queue-batches', type = int, default = async_runtime.QUEUE_BATCHES)
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"consume only, fetch {args.fetch_ms}ms, delivery {args.round_trip_ms}ms, commit {args.commit_ms}ms")
+    blocking = report("blocking", args.messages, *run_blocking(preloaded_broker(args.messages), args))
+    asynchronous = report("async", args.messages, *run_async(preloaded_broker(args.messages), args))
+
+    print("generate + consume in one process")
+    both_blocking = report("blocking", args.messages, *run_blocking(FakeBroker(), args, generate = args.messages))
+    both_async = report("async", args.messages, *run_async(FakeBroker(), args, generate = args.messages))
+
+    # Same offsets committed and same error logs delivered, whichever runtime did the work
+    if blocking != asynchronous or both_blocking != both_async:
+        print("RESULTS DIFFER")
+        raise SystemExit(1)
+    if not check_failure(args):
+        raise SystemExit(1)
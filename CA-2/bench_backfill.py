@@ -0,0 +1,173 @@
+"""Compare the bulk backfill generator with TransactionGenerator.event.
+
+Checks that both produce the same field distributions (chi-square tests for
+categorical fields, two-sample Kolmogorov-Smirnov tests for continuous ones)
+and reports events/s for generation plus serialization.
+
+    python bench_backfill.py --samples 100000 --count 1000000
+"""
+import argparse
+import datetime
+import json
+import math
+import time
+from collections import Counter
+
+import numpy as np
+
+import darooghe_pulse
+from darooghe_codec import encode
+from event_sinks import KafkaSink
+from fake_kafka import FakeProducer
+
+CATEGORICAL_FIELDS = [
+    "customer_id", "merchant_id", "merchant_category", "payment_method", "status", "failure_reason",
+    "commission_type", "customer_type", "risk_level", "device_model",
+]
+CONTINUOUS_FIELDS = ["amount", "lat_offset", "lng_offset", "age_seconds"]
+Z_999 = 3.090  # one-sided normal quantile for alpha = 0.001
+KS_C_999 = 1.949
+
+
+def features(events, bases, now):
+    rows = []
+    for e in events:
+        base = bases[e["merchant_id"]]
+        timestamp = datetime.datetime.fromisoformat(e["timestamp"].replace("Z", ""))
+        rows.append({
+            **{f: e.get(f) for f in CATEGORICAL_FIELDS},
+            "device_model": e["device_info"].get("device_model"),
+            "amount": e["amount"],
+            "lat_offset": e["location"]["lat"] - base["lat"],
+            "lng_offset": e["location"]["lng"] - base["lng"],
+            "age_seconds": (now - timestamp).total_seconds(),
+        })
+    return rows
+
+
+def chi_square_same(a, b):
+    counts_a, counts_b = Counter(a), Counter(b)
+    categories = sorted(set(counts_a) | set(counts_b), key=str)
+    n_a, n_b = len(a), len(b)
+    stat = 0.0
+    for c in categories:
+        total = counts_a[c] + counts_b[c]
+        for observed, n in ((counts_a[c], n_a), (counts_b[c], n_b)):
+            expected = total * n / (n_a + n_b)
+            stat += (observed - expected) ** 2 / expected
+    df = max(len(categories) - 1, 1)
+    # Wilson-Hilferty approximation of the chi-square critical value
+    critical = df * (1 - 2 / (9 * df) + Z_999 * math.sqrt(2 / (9 * df))) ** 3
+    return stat, critical
+
+
+def ks_same(a, b):
+    a, b = np.sort(np.asarray(a, dtype=float)), np.sort(np.asarray(b, dtype=float))
+    values = np.concatenate([a, b])
+    d = np.max(np.abs(np.searchsorted(a, values, side="right") / len(a)
+                      - np.searchsorted(b, values, side="right") / len(b)))
+    return d, KS_C_999 * math.sqrt((len(a) + len(b)) / (len(a) * len(b)))
+
+
+def check_determinism(args):
+    now = datetime.datetime.utcnow()
+    streams = []
+    for _ in range(2):
+        generator = make_generator(args)
+        events = [generator.event(generator.random_datetime(now - datetime.timedelta(days=7), now))
+                  for _ in range(1000)]
+        _, payloads = darooghe_pulse.serialize_event_block(generator.event_block(1000, now, now))
+        streams.append((events, payloads))
+    return streams[0] == streams[1]
+
+
+def check_distributions(samples, args):
+    now = datetime.datetime.utcnow()
+    start = now - datetime.timedelta(days=7)
+    generator = make_generator(args)
+    reference = [generator.event(generator.random_datetime(start, now)) for _ in range(samples)]
+    block = generator.event_block(samples, start, now)
+    _, payloads = darooghe_pulse.serialize_event_block(block)
+    bulk = [json.loads(p) for p in payloads]
+    assert list(bulk[0]) == list(reference[0]), "field order differs"
+    assert all(e["total_amount"] == e["amount"] + e["vat_amount"] + e["commission_amount"] for e in bulk)
+
+    bases = generator.merchant_bases
+    ref_rows, bulk_rows = features(reference, bases, now), features(bulk, bases, now)
+    ok = True
+    for field in CATEGORICAL_FIELDS:
+        stat, critical = chi_square_same([r[field] for r in ref_rows], [r[field] for r in bulk_rows])
+        ok &= stat <= critical
+        print(f"  chi2 {field:<18} {stat:10.1f} (critical {critical:.1f}) {'ok' if stat <= critical else 'DIFFERS'}")
+    for field in CONTINUOUS_FIELDS:
+        d, critical = ks_same([r[field] for r in ref_rows], [r[field] for r in bulk_rows])
+        ok &= d <= critical
+        print(f"  KS   {field:<18} {d:10.4f} (critical {critical:.4f}) {'ok' if d <= critical else 'DIFFERS'}")
+    return ok
+
+
+def make_generator(args):
+    return darooghe_pulse.TransactionGenerator(args.seed, args.merchants, args.customers, args.fraud_rate,
+                                               args.declined_rate)
+
+
+def bench_per_event(count, args, producer=None):
+    generator = make_generator(args)
+    now = datetime.datetime.utcnow()
+    start = now - datetime.timedelta(days=7)
+    started = time.perf_counter()
+    for _ in range(count):
+        event = generator.event(generator.random_datetime(start, now))
+        value = encode(event)
+        if producer:
+            producer.produce("darooghe.transactions", key=event["customer_id"], value=value)
+    if producer:
+        producer.flush()
+    return count / (time.perf_counter() - started)
+
+
+def bench_bulk_serialize(count, block_size, args):
+    generator = make_generator(args)
+    now = datetime.datetime.utcnow()
+    start = now - datetime.timedelta(days=7)
+    started = time.perf_counter()
+    for offset in range(0, count, block_size):
+        darooghe_pulse.serialize_event_block(generator.event_block(min(block_size, count - offset), start, now))
+    return count / (time.perf_counter() - started)
+
+
+def bench_bulk(count, block_size, args):
+    sink = KafkaSink(FakeProducer(round_trip_ms=0), "darooghe.transactions")
+    started = time.perf_counter()
+    darooghe_pulse.produce_bulk_historical_events(sink, make_generator(args), count, block_size=block_size)
+    return count / (time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=100000)
+    parser.add_argument("--count", type=int, default=1000000)
+    parser.add_argument("--block-size", type=int, default=darooghe_pulse.BULK_BLOCK_SIZE)
+    parser.add_argument("--merchants", type=int, default=50)
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--fraud-rate", type=float, default=0.02)
+    parser.add_argument("--declined-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    if not check_determinism(args):
+        print("the same seed produced different events")
+        raise SystemExit(1)
+    print(f"distribution check on {args.samples} events per generator:")
+    if not check_distributions(args.samples, args):
+        raise SystemExit(1)
+
+    sample = min(args.count, 200000)
+    per_event = bench_per_event(sample, args)
+    per_event_produce = bench_per_event(sample, args, FakeProducer(round_trip_ms=0))
+    bulk = bench_bulk_serialize(args.count, args.block_size, args)
+    bulk_produce = bench_bulk(args.count, args.block_size, args)
+    print(f"generate + serialize   per-event {per_event:10,.0f} events/s   bulk {bulk:10,.0f} events/s "
+          f"({bulk / per_event:.1f}x)")
+    print(f"... + fake produce     per-event {per_event_produce:10,.0f} events/s   bulk {bulk_produce:10,.0f} events/s "
+          f"({bulk_produce / per_event_produce:.1f}x)")
@@ -0,0 +1,175 @@
+"""Compare recovering from a state snapshot with replaying the whole topic.
+
+For each topic length the stateful stages are rebuilt twice: once by replaying
+every message, once by restoring the snapshot taken `--tail` messages before
+the end and replaying only those. Both must end in the same state. A batch that
+fails half way through its stages must leave the previous snapshot in place.
+A new owner that restores a snapshot older than the committed offset must not
+publish the replayed messages' error logs, alerts or windows again.
+
+    python bench_checkpoint.py --lengths 50000 200000 500000 --tail 10000
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from confluent_kafka import TopicPartition
+
+import kafka_consumer
+from fake_kafka import FakeConsumer, FakeMessage, FakeProducer, sample_transaction
+from state_checkpoint import PartitionStates, read_snapshot
+
+
+def ordered_messages(count, customers, now, seed = 0):
+    # Valid transactions in timestamp order, ending now, so every stage sees a live-like stream
+    rng = random.Random(seed)
+    start = now - timedelta(hours = 20)
+    messages = []
+    for i in range(count):
+        transaction = sample_transaction(i, now)
+        transaction["timestamp"] = (start + timedelta(hours = 20) * (i / count)).isoformat() + "Z"
+        transaction["customer_id"] = f"cust_{rng.randint(1, customers)}"
+        transaction["merchant_id"] = f"merch_{rng.randint(1, 50)}"
+        transaction["location"] = {"lat": 35.7 + rng.uniform(-0.1, 0.1), "lng": 51.3 + rng.uniform(-0.1, 0.1)}
+        messages.append(FakeMessage(kafka_consumer.TRANSACTIONS_TOPIC, 0, i, transaction["customer_id"],
+                                    json.dumps(transaction).encode()))
+    return messages
+
+
+def consume(messages, state, producer = None):
+    consumer = FakeConsumer(messages)
+    started = time.perf_counter()
+    kafka_consumer.run_batch_consumer(consumer, FakeProducer(round_trip_ms = 0) if producer is None else producer,
+                                      should_stop = consumer.exhausted, state = state)
+    return time.perf_counter() - started
+
+
+def with_invalid(messages, every = 10):
+    # Every n-th transaction gets a wrong total, so the stream produces error logs
+    for msg in messages[::every]:
+        transaction = json.loads(msg.value())
+        transaction["total_amount"] += 1
+        msg._value = json.dumps(transaction).encode()
+    return messages
+
+
+def same_state(a, b):
+    a, b = a.get_state(), b.get_state()
+    if "filters" in a:
+        # Dedup admission times are wall-clock; the ids and filter bits must match
+        return (all(np.array_equal(x[2], y[2]) for x, y in zip(a["filters"], b["filters"]))
+                and np.array_equal(a["exact_keys"], b["exact_keys"]))
+    return all(np.array_equal(a[k], b[k]) if isinstance(a[k], np.ndarray) else a[k] == b[k] for k in a)
+
+
+class FailingStage:
+    # Raises after the stages before it have taken the batch, like a crash in the middle of a batch
+    name = 'failing'
+
+    def process(self, transactions, producer):
+        raise RuntimeError("stage failed")
+
+    def get_state(self):
+        return None
+
+    def set_state(self, state):
+        pass
+
+
+def check_interrupted(length, customers, directory):
+    messages = ordered_messages(length, customers, datetime.utcnow())
+    key = (kafka_consumer.TRANSACTIONS_TOPIC, 0)
+    state = PartitionStates(kafka_consumer.build_stages, directory, interval = float('inf'))
+    consume(messages[:length // 2], state)
+    state.checkpoint()
+    before = read_snapshot(state.path(*key))['offset']
+    state.partitions[key].stages.append(FailingStage())
+    try:
+        consume(messages[length // 2:], state)
+    except RuntimeError:
+        pass
+    # What on_revoke does when consumer.close() follows the error
+    state.checkpoint([key])
+    after = read_snapshot(state.path(*key))['offset']
+    ok = before == after == length // 2
+    print(f"interrupted batch: snapshot offset {before} before, {after} after "
+          f"{'ok' if ok else 'SNAPSHOT ADVANCED'}")
+    return ok
+
+
+def check_replay(length, customers, directory, extra = 2000):
+    messages = with_invalid(ordered_messages(length + extra, customers, datetime.utcnow()))
+    key = (kafka_consumer.TRANSACTIONS_TOPIC, 0)
+    old_owner = PartitionStates(kafka_consumer.build_stages, directory, interval = float('inf'))
+    consume(messages[:length // 2], old_owner)
+    old_owner.checkpoint()
+    consume(messages[length // 2:length], old_owner)
+
+    # The old owner committed up to `length`; the new one restores the snapshot at length // 2
+    group = FakeConsumer(messages)
+    group.committed_offsets[key] = length
+    new_owner = PartitionStates(kafka_consumer.build_stages, directory, interval = float('inf'))
+    new_owner.on_assign(group, [TopicPartition(*key)])
+    offset = new_owner.partitions[key].offset
+    replayed, live = FakeProducer(round_trip_ms = 0), FakeProducer(round_trip_ms = 0)
+    consume(messages[offset:length], new_owner, replayed)
+    consume(messages[length:], new_owner, live)
+
+    expected = FakeProducer(round_trip_ms = 0)
+    consume(messages[length:], old_owner, expected)
+    outputs = lambda producer: sorted((msg.topic(), msg.key(), msg.value()) for msg in producer.delivered)
+    ok = (offset == length // 2 and not replayed.delivered and outputs(live) == outputs(expected)
+          and all(same_state(a, b) for a, b in zip(old_owner.partitions[key].stages, new_owner.partitions[key].stages)))
+    print(f"replay below the committed offset: {length - offset:,} messages replayed, "
+          f"{len(replayed.delivered):,} outputs published again, then {len(live.delivered):,} outputs for "
+          f"{extra:,} new messages {'ok' if ok else 'DIFFERS'}")
+    return ok
+
+
+def bench(length, tail, customers, directory):
+    messages = ordered_messages(length, customers, datetime.utcnow())
+    key = (kafka_consumer.TRANSACTIONS_TOPIC, 0)
+
+    reference = PartitionStates(kafka_consumer.build_stages, directory, interval = float('inf'))
+    replay_seconds = consume(messages[:length - tail], reference)
+    started = time.perf_counter()
+    reference.checkpoint()
+    write_seconds = time.perf_counter() - started
+    replay_seconds += consume(messages[length - tail:], reference)
+    snapshot_mb = os.path.getsize(reference.path(*key)) / 2**20
+
+    recovered = PartitionStates(kafka_consumer.build_stages, directory, interval = float('inf'))
+    started = time.perf_counter()
+    offset = recovered.restore(*key)
+    restore_seconds = time.perf_counter() - started
+    tail_seconds = consume(messages[offset:], recovered)
+
+    ok = offset == length - tail and all(
+        same_state(a, b) for a, b in zip(reference.partitions[key].stages, recovered.partitions[key].stages))
+    recovery = restore_seconds + tail_seconds
+    print(f"{length:>9} messages: full replay {replay_seconds:6.2f}s | snapshot {snapshot_mb:6.1f} MB written in "
+          f"{write_seconds:.2f}s, restore {restore_seconds:.2f}s + tail {tail_seconds:.2f}s = {recovery:.2f}s "
+          f"({replay_seconds / recovery:.0f}x faster) {'ok' if ok else 'STATE DIFFERS'}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type = int, nargs = '+', default = [50000, 200000, 500000])
+    parser.add_argument('--tail', type = int, default = 10000)
+    parser.add_argument('--customers', type = int, default = 20000)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        ok = all([bench(length, args.tail, args.customers, directory) for length in args.lengths])
+        ok = check_interrupted(min(args.lengths), args.customers, directory) and ok
+        ok = check_replay(min(args.lengths), args.customers, directory) and ok
+        if not ok:
+            raise SystemExit(1)
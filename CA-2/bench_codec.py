@@ -0,0 +1,81 @@
+"""Encode/decode throughput of every available darooghe_codec backend.
+
+First checks that every backend decodes mistyped and incomplete transactions
+like the stdlib one, so the backend never decides whether a record reaches
+validation.
+
+    python bench_codec.py --count 100000
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+
+from darooghe_codec import available_backends, get_codec
+from fake_kafka import sample_transaction
+
+
+MALFORMED = [
+    {"timestamp": 1700000000},
+    {"amount": "100"},
+    {"device_info": None},
+    {"location": [35.7, 51.4]},
+    {"risk_level": "high"},
+]
+
+
+def outcome(codec, payload):
+    try:
+        return codec.decode_transaction(payload)
+    except json.JSONDecodeError:
+        return 'JSONDecodeError'
+    except KeyError as e:
+        return f'KeyError {e}'
+
+
+def check_malformed(event):
+    payloads = [json.dumps({**event, **change}).encode() for change in MALFORMED]
+    payloads.append(json.dumps({key: value for key, value in event.items() if key != 'amount'}).encode())
+    payloads.append(b'[1, 2]')
+    payloads.append(b'{"transaction_id": ')
+    reference = get_codec('json')
+    ok = True
+    for name in available_backends():
+        codec = get_codec(name)
+        for payload in payloads:
+            expected, actual = outcome(reference, payload), outcome(codec, payload)
+            if actual != expected:
+                print(f"MISMATCH {name}: {payload[:80]} decoded as {str(actual)[:80]}, json gives {str(expected)[:80]}")
+                ok = False
+    print(f"malformed: {len(payloads)} payloads, {'same' if ok else 'DIFFERENT'} outcome on every backend")
+    return ok
+
+
+def best_of(fn, repeats = 3):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type = int, default = 100000)
+    args = parser.parse_args()
+
+    now = datetime.utcnow()
+    events = [sample_transaction(i, now) for i in range(args.count)]
+    payloads = [get_codec('json').encode(event) for event in events]
+    if not check_malformed(events[0]):
+        raise SystemExit(1)
+
+    for name in available_backends():
+        codec = get_codec(name)
+        assert codec.decode_transaction(codec.encode(events[0])) == events[0]
+        encode_s = best_of(lambda: [codec.encode(event) for event in events])
+        decode_s = best_of(lambda: [codec.decode(payload) for payload in payloads])
+        typed_s = best_of(lambda: [codec.decode_transaction(payload) for payload in payloads])
+        print(f"{name:>8}: encode {args.count / encode_s:10,.0f}/s  decode {args.count / decode_s:10,.0f}/s  "
+              f"decode_transaction {args.count / typed_s:10,.0f}/s")
@@ -0,0 +1,135 @@
+"""Check validate_batch against validate_transaction and time both per event.
+
+Also checks that a batch with malformed records (a string amount, a null
+device_info) is validated record by record, with only those records
+reported as ERR_TYPE.
+
+    python bench_columnar_validator.py --sizes 10000 100000 1000000
+"""
+import argparse
+import copy
+import random
+import time
+from datetime import datetime, timedelta
+
+from columnar_validator import validate_batch
+from fake_kafka import sample_transaction
+from kafka_consumer import MALFORMED, validate_records
+from transaction_validation import validate_transaction
+
+TIMESTAMP_VARIANTS = [
+    lambda now, rng: (now - timedelta(seconds = rng.uniform(0, 80000))).isoformat() + "Z",
+    lambda now, rng: (now - timedelta(days = rng.uniform(1.01, 30))).isoformat() + "Z",
+    lambda now, rng: (now + timedelta(seconds = rng.uniform(1, 3600))).isoformat() + "Z",
+    lambda now, rng: (now - timedelta(hours = 3)).replace(microsecond = 0).isoformat(),
+    lambda now, rng: (now - timedelta(hours = 3)).strftime("%Y-%m-%d %H:%M"),
+    lambda now, rng: now.strftime("%Y-%m-%d"),
+    lambda now, rng: (now - timedelta(hours = 3)).isoformat() + "+03:30",
+    lambda now, rng: "not a timestamp",
+    lambda now, rng: "2025-13-01T00:00:00",
+    lambda now, rng: "NaT",
+    lambda now, rng: "",
+    lambda now, rng: "2024-02-30T10:00:00",
+    lambda now, rng: "2024-02-29T23:59:59.999999Z",
+    lambda now, rng: "2025-01-01T24:00:00",
+    lambda now, rng: "2025-01-01X10:00:00",
+    lambda now, rng: (now - timedelta(hours = 3)).isoformat()[:23],
+    lambda now, rng: (now - timedelta(hours = 3)).isoformat().replace('-', 'Z-', 1),
+    lambda now, rng: 1700000000,
+]
+
+# Fields of the wrong type, as a producer with another schema could send them
+MALFORMED_VARIANTS = [
+    lambda transaction: transaction.update(amount = str(transaction["amount"])),
+    lambda transaction: transaction.update(vat_amount = None),
+    lambda transaction: transaction.update(payment_method = "mobile", device_info = None),
+    lambda transaction: transaction.update(total_amount = [transaction["total_amount"]]),
+]
+
+
+def mixed_batch(count, now, seed = 0):
+    rng = random.Random(seed)
+    transactions = []
+    for i in range(count):
+        transaction = sample_transaction(i, now, invalid = rng.random() < 0.1)
+        if rng.random() < 0.2:
+            transaction["timestamp"] = rng.choice(TIMESTAMP_VARIANTS)(now, rng)
+        transaction["payment_method"] = rng.choice(["online", "pos", "mobile", "nfc", "crypto"])
+        device = rng.random()
+        if device < 0.1:
+            del transaction["device_info"]
+        elif device < 0.2:
+            transaction["device_info"] = {}
+        elif device < 0.3:
+            transaction["device_info"] = {"os": "Windows"}
+        elif device < 0.4:
+            transaction["device_info"] = {"os": "iOS"}
+        if rng.random() < 0.05:
+            transaction["amount"] = float(transaction["amount"]) + 0.5
+        transactions.append(transaction)
+    return transactions
+
+
+def check_equivalence(count = 20000):
+    now = datetime.utcnow()
+    transactions = mixed_batch(count, now)
+    expected = [validate_transaction(copy.deepcopy(t), now) for t in transactions]
+    actual = validate_batch(transactions, now)
+    mismatches = [i for i in range(count) if expected[i] != actual.get(i, [])]
+    for i in mismatches[:5]:
+        print("MISMATCH", transactions[i], expected[i], actual.get(i))
+    flagged = sum(1 for errors in expected if errors)
+    print(f"equivalence: {count} records, {flagged} with errors, {len(mismatches)} mismatches")
+    return not mismatches
+
+
+def check_malformed(count = 20000, malformed_ratio = 0.01):
+    now = datetime.utcnow()
+    rng = random.Random(1)
+    transactions = mixed_batch(count, now)
+    for transaction in transactions:
+        if rng.random() < malformed_ratio:
+            rng.choice(MALFORMED_VARIANTS)(transaction)
+    expected = []
+    for transaction in transactions:
+        try:
+            expected.append([error["code"] for error in validate_transaction(copy.deepcopy(transaction), now)])
+        except MALFORMED:
+            expected.append(["ERR_TYPE"])
+    actual = validate_records(transactions, now)
+    mismatches = [i for i in range(count) if expected[i] != [error["code"] for error in actual.get(i, [])]]
+    for i in mismatches[:5]:
+        print("MISMATCH", transactions[i], expected[i], actual.get(i))
+    malformed = sum(1 for codes in expected if codes == ["ERR_TYPE"])
+    print(f"malformed: {count} records, {malformed} malformed, {len(mismatches)} mismatches")
+    return malformed > 0 and not mismatches
+
+
+def time_per_event(fn, transactions, now, repeats = 3):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(transactions, now)
+        best = min(best, time.perf_counter() - start)
+    return best / len(transactions) * 1e9
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10000, 100000, 1000000])
+    parser.add_argument('--invalid-ratio', type = float, default = 0.1)
+    args = parser.parse_args()
+
+    if not check_equivalence() or not check_malformed():
+        raise SystemExit(1)
+
+    now = datetime.utcnow()
+    for size in args.sizes:
+        invalid_every = round(1 / args.invalid_ratio) if args.invalid_ratio else 0
+        transactions = [sample_transaction(i, now, invalid = bool(invalid_every) and i % invalid_every == 0)
+                        for i in range(size)]
+        per_record = time_per_event(lambda batch, now: [validate_transaction(t, now) for t in batch],
+                                    transactions, now, repeats = 1 if size >= 1000000 else 3)
+        columnar = time_per_event(validate_batch, transactions, now, repeats = 1 if size >= 1000000 else 3)
+        print(f"{size:>8} events: per-record {per_record:7.0f} ns/event, columnar {columnar:7.0f} ns/event, "
+              f"speedup {per_record / columnar:.1f}x")
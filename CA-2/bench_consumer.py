@@ -0,0 +1,148 @@
+"""Compare the per-message and batch consume loops against fake_kafka.
+
+Also runs one consumer_supervisor worker (worker_main) in this process on fake_kafka, so a worker
+that cannot start fails the bench instead of only showing up as restarts under the supervisor.
+A second worker run has a stage fail halfway through and checks that the failed batch is not
+committed.
+
+    python bench_consumer.py --count 20000 --invalid-ratio 0.1 --round-trip-ms 2
+"""
+import argparse
+import logging
+import queue
+import signal
+import time
+
+import consumer_supervisor
+import kafka_consumer
+from fake_kafka import FakeConsumer, FakeProducer, transaction_messages
+
+
+def run(mode, messages, round_trip_ms, batch_size):
+    consumer = FakeConsumer(messages)
+    producer = FakeProducer(round_trip_ms)
+    start = time.perf_counter()
+    if mode == 'single':
+        kafka_consumer.run_single_consumer(consumer, producer, should_stop = consumer.exhausted)
+    else:
+        kafka_consumer.run_batch_consumer(consumer, producer, batch_size = batch_size,
+                                          should_stop = consumer.exhausted)
+    producer.flush()
+    elapsed = time.perf_counter() - start
+    return {
+        "mode": mode,
+        "messages": len(messages),
+        "errors_published": len(producer.delivered),
+        "flushes": producer.flush_count,
+        "commits": consumer.commit_count,
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(len(messages) / elapsed),
+    }
+
+
+class StopWhenExhausted:
+    # Stands in for the supervisor's stop event: set once every message was consumed
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.stopped = False
+
+    def set(self):
+        self.stopped = True
+
+    def is_set(self):
+        return self.stopped or self.consumer.exhausted()
+
+
+class FailingStage:
+    # Fails on the n-th batch it sees, like a poison batch
+    name = 'failing'
+
+    def __init__(self, after_batches):
+        self.batches = 0
+        self.after_batches = after_batches
+
+    def process(self, transactions, producer):
+        self.batches += 1
+        if self.batches > self.after_batches:
+            raise RuntimeError("stage failed")
+
+    def get_state(self):
+        return None
+
+    def set_state(self, state):
+        pass
+
+
+def run_failing_worker(messages, round_trip_ms, after_batches):
+    build_stages = kafka_consumer.build_stages
+    kafka_consumer.build_stages = lambda: build_stages() + [FailingStage(after_batches)]
+    try:
+        run_worker(messages, round_trip_ms)
+    except RuntimeError:
+        pass
+    finally:
+        kafka_consumer.build_stages = build_stages
+    consumer = consumer_supervisor.Consumer(None)
+    return {
+        "mode": "failing worker",
+        "consumed": consumer.position,
+        "committed": consumer.committed_position,
+        "closed": consumer.closed,
+    }
+
+
+def run_worker(messages, round_trip_ms):
+    consumer = FakeConsumer(messages)
+    producer = FakeProducer(round_trip_ms)
+    consumer_supervisor.Consumer = lambda conf: consumer
+    consumer_supervisor.Producer = lambda conf: producer
+    metrics_queue = queue.Queue()
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+    start = time.perf_counter()
+    try:
+        consumer_supervisor.worker_main(0, StopWhenExhausted(consumer), metrics_queue)
+    finally:
+        # worker_main installs the handlers of a worker process
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    elapsed = time.perf_counter() - start
+    snapshot = metrics_queue.get_nowait()
+    return {
+        "mode": "supervised worker",
+        "messages": snapshot["messages"],
+        "errors_published": len(producer.delivered),
+        "commits": consumer.commit_count,
+        "closed": consumer.closed,
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(snapshot["messages"] / elapsed),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type = int, default = 20000)
+    parser.add_argument('--invalid-ratio', type = float, default = 0.1)
+    parser.add_argument('--round-trip-ms', type = float, default = 2.0)
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [100, 500, 2000])
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    messages = transaction_messages(args.count, args.invalid_ratio)
+    baseline = run('single', messages, args.round_trip_ms, 1)
+    print(baseline)
+    for batch_size in args.batch_sizes:
+        result = run('batch', messages, args.round_trip_ms, batch_size)
+        result["batch_size"] = batch_size
+        result["speedup"] = round(result["msgs_per_sec"] / baseline["msgs_per_sec"], 1)
+        print(result)
+
+    worker = run_worker(messages, args.round_trip_ms)
+    print(worker)
+    if worker["messages"] != len(messages) or not worker["closed"]:
+        raise SystemExit(1)
+
+    # The batch that failed must stay uncommitted, so that it is redelivered
+    failing = run_failing_worker(messages, args.round_trip_ms, after_batches = 2)
+    print(failing)
+    if failing["committed"] != 2 * kafka_consumer.BATCH_SIZE or failing["consumed"] <= failing["committed"]:
+        raise SystemExit(1)
@@ -0,0 +1,94 @@
+"""Measure DedupIndex lookup throughput, memory and false-positive rate.
+
+Admits `--ids` unique transaction ids, then replays a sample of them (all must
+be caught) and offers never-seen ids (the share wrongly dropped is the
+observed false-positive rate). Finally moves a partition to a new owner
+without checkpoints and checks that the ids redelivered after the rebalance
+are still caught.
+
+    python bench_dedup.py --ids 10000000 --capacity 1000000 --fp-rate 1e-6 --generations 24
+"""
+import argparse
+import tempfile
+import time
+
+from confluent_kafka import TopicPartition
+
+from dedup_index import DedupIndex, id_hashes
+from fake_kafka import FakeConsumer
+from state_checkpoint import PartitionStates
+
+TOPIC = 'darooghe.transactions'
+
+
+def id_batches(start, stop, batch_size, prefix = "tx"):
+    for offset in range(start, stop, batch_size):
+        yield [{"transaction_id": f"{prefix}-{i:012d}"} for i in range(offset, min(offset + batch_size, stop))]
+
+
+def check_rebalance(ids = 10000, batch_size = 500):
+    # The old owner commits every batch, then the partition is revoked and assigned to a new owner
+    # that only has the committed offset: the last batch is redelivered to it
+    with tempfile.TemporaryDirectory() as handover_directory:
+        old_owner, new_owner = (PartitionStates(lambda: [DedupIndex()], directory = '',
+                                                handover_directory = handover_directory) for _ in range(2))
+        consumer = FakeConsumer([])
+        partitions = [TopicPartition(TOPIC, 0)]
+        for offset, batch in zip(range(0, ids, batch_size), id_batches(0, ids, batch_size)):
+            for i in range(len(batch)):
+                old_owner.record(TOPIC, 0, offset + i)
+            old_owner.admit(batch, [(TOPIC, 0)] * len(batch))
+            old_owner.committed()
+        old_owner.on_revoke(consumer, partitions)
+        new_owner.on_assign(consumer, partitions)
+        redelivered = list(id_batches(ids - batch_size, ids, batch_size))[0]
+        kept, _ = new_owner.admit(redelivered, [(TOPIC, 0)] * len(redelivered))
+    ok = not kept
+    print(f"rebalance: {len(redelivered) - len(kept)} of {len(redelivered)} redelivered ids caught by the new owner "
+          f"{'ok' if ok else 'MISSED'}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ids', type = int, default = 10000000)
+    parser.add_argument('--capacity', type = int, default = 1000000, help = "ids per Bloom generation")
+    parser.add_argument('--fp-rate', type = float, default = 1e-6, help = "false-positive rate per generation")
+    parser.add_argument('--generations', type = int, default = 24)
+    parser.add_argument('--exact-max', type = int, default = 1000000)
+    parser.add_argument('--batch-size', type = int, default = 10000)
+    parser.add_argument('--probes', type = int, default = 1000000)
+    args = parser.parse_args()
+
+    index = DedupIndex(capacity = args.capacity, fp_rate = args.fp_rate, generations = args.generations,
+                       exact_max = args.exact_max)
+    bloom = index.filters[0]
+    print(f"filter: {bloom.bit_count / 8 / 2**20:.2f} MB and {bloom.hash_count} hashes per generation")
+
+    started = time.perf_counter()
+    admitted = sum(sum(index.admit(batch)) for batch in id_batches(0, args.ids, args.batch_size))
+    elapsed = time.perf_counter() - started
+    print(f"admitted {admitted:,} of {args.ids:,} unique ids in {elapsed:.1f}s "
+          f"({args.ids / elapsed:,.0f} ids/s, {elapsed / args.ids * 1e9:.0f} ns/id), "
+          f"{len(index.filters)} generations, {index.memory_bytes() / 2**20:.1f} MB")
+
+    # Replays spread over the whole history, so most are only in the Bloom filters
+    step = max(1, args.ids // args.probes)
+    replayed = [{"transaction_id": f"tx-{i:012d}"} for i in range(0, args.ids, step)]
+    started = time.perf_counter()
+    caught = sum(not fresh for offset in range(0, len(replayed), args.batch_size)
+                 for fresh in index.admit(replayed[offset:offset + args.batch_size]))
+    elapsed = time.perf_counter() - started
+    print(f"duplicates caught: {caught:,} of {len(replayed):,} ({elapsed / len(replayed) * 1e9:.0f} ns/id)")
+
+    false_positives = sum(not fresh for batch in id_batches(0, args.probes, args.batch_size, prefix = "new")
+                          for fresh in index.admit(batch))
+    expected = 1 - (1 - args.fp_rate) ** len(index.filters)
+    print(f"false positives: {false_positives:,} of {args.probes:,} new ids "
+          f"({false_positives / args.probes:.2e}, configured {expected:.2e} over {len(index.filters)} generations)")
+
+    started = time.perf_counter()
+    id_hashes([f"tx-{i:012d}" for i in range(args.batch_size * 10)])
+    print(f"hashing alone: {(time.perf_counter() - started) / (args.batch_size * 10) * 1e9:.0f} ns/id")
+    if not check_rebalance() or caught != len(replayed):
+        raise SystemExit(1)
@@ -0,0 +1,103 @@
+"""Check the sliding-window features against a brute-force recomputation and
+measure per-event scoring latency as the number of tracked customers grows.
+
+    python bench_fraud_features.py --customers 10000 100000 1000000 --events 200000
+"""
+import argparse
+import random
+import resource
+import time
+from datetime import datetime, timedelta
+
+from fraud_features import WINDOWS, CustomerFeatureStore, haversine_km
+
+
+def random_events(count, customers, start, rng, step = 0.5):
+    events = []
+    moment = start
+    for i in range(count):
+        moment += timedelta(seconds = rng.expovariate(1 / step))
+        events.append({
+            "transaction_id": str(i),
+            "timestamp": moment.isoformat() + "Z",
+            "customer_id": f"cust_{rng.randint(1, customers)}",
+            "merchant_id": f"merch_{rng.randint(1, 8)}",
+            "amount": rng.randint(50000, 2000000),
+            "location": {"lat": 35.7 + rng.uniform(-0.3, 0.3), "lng": 51.3 + rng.uniform(-0.3, 0.3)},
+        })
+    return events
+
+
+def brute_force(history, now):
+    expected = {}
+    for w, span in enumerate(WINDOWS):
+        inside = [e for e in history if e[0] > now - span]
+        expected[w] = (len(inside), sum(e[1] for e in inside), len({e[2] for e in inside}),
+                       max((e[3] for e in inside), default = 0.0))
+    return expected
+
+
+def check_against_brute_force(count = 20000, customers = 40, seed = 1):
+    rng = random.Random(seed)
+    start = datetime(2025, 5, 1)
+    events = random_events(count, customers, start, rng, step = 2.0)
+    store = CustomerFeatureStore(velocity_max_1m = 10**9, amount_max_1h = 10**18, merchants_max_5m = 10**9,
+                                 distance_max_km = 10**9)
+    histories = {}
+    mismatches = comparisons = 0
+    for offset in range(0, count, 500):
+        batch = events[offset:offset + 500]
+        store.score(batch)
+        for e in batch:
+            history = histories.setdefault(e["customer_id"], [])
+            now = (datetime.fromisoformat(e["timestamp"][:-1]) - datetime(1970, 1, 1)).total_seconds()
+            lat, lng = e["location"]["lat"], e["location"]["lng"]
+            distance = haversine_km(history[-1][4], history[-1][5], lat, lng) if history else 0.0
+            history.append((now, e["amount"], e["merchant_id"], distance, lat, lng))
+        # Every customer of the batch, as of its latest event
+        for customer in {e["customer_id"] for e in batch}:
+            state = store.customers[customer]
+            expected = brute_force(histories[customer], state.last_time)
+            comparisons += 1
+            for w in range(len(WINDOWS)):
+                actual = (state.count(w), state.sums[w], state.distinct[w], state.max_distance(w))
+                if actual[:3] != expected[w][:3] or abs(actual[3] - expected[w][3]) > 1e-9:
+                    mismatches += 1
+                    print("MISMATCH", customer, w, actual, expected[w])
+    print(f"brute-force check: {comparisons} comparisons, {mismatches} mismatches")
+    return mismatches == 0
+
+
+def bench(customers, events, batch_size = 500, seed = 2):
+    rng = random.Random(seed)
+    start = datetime(2025, 5, 1)
+    store = CustomerFeatureStore()
+    # Every customer gets one event in the 30 minutes before the measured stream
+    warmup_start = (start - datetime(1970, 1, 1)).total_seconds() - 1800
+    for c in range(1, customers + 1):
+        store.update(f"cust_{c}", warmup_start + 1800 * c / customers, 100000, "merch_1", 35.7, 51.3)
+    stream = random_events(events, customers, start, rng, step = 0.001)
+    batch_times = []
+    started = time.perf_counter()
+    for offset in range(0, events, batch_size):
+        batch_started = time.perf_counter()
+        store.score(stream[offset:offset + batch_size])
+        batch_times.append((time.perf_counter() - batch_started) / len(stream[offset:offset + batch_size]))
+    elapsed = time.perf_counter() - started
+    batch_times.sort()
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{customers:>9} customers: {elapsed / events * 1e6:6.2f} us/event mean, "
+          f"{batch_times[len(batch_times) // 2] * 1e6:6.2f} p50, {batch_times[int(len(batch_times) * 0.99)] * 1e6:6.2f} p99 "
+          f"(per-batch), {len(store)} tracked, max RSS {rss_mb:.0f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--customers', type = int, nargs = '+', default = [10000, 100000, 1000000])
+    parser.add_argument('--events', type = int, default = 200000)
+    args = parser.parse_args()
+
+    if not check_against_brute_force():
+        raise SystemExit(1)
+    for customers in args.customers:
+        bench(customers, args.events)
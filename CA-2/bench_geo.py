@@ -0,0 +1,125 @@
+"""Benchmark the geospatial checks with a large merchant population.
+
+1. Vectorized haversine against the scalar one (speed and largest difference).
+2. Grid nearest-merchant (within 2 km) and 300 m radius queries against a
+   brute-force scan of all merchants; every answer must be identical.
+3. GeoChecks on generated traffic where every `--inject-every`-th transaction is
+   moved `--shift-deg` away from its merchant: per-event latency, share of moved
+   transactions flagged and share of untouched ones flagged.
+
+    python bench_geo.py --merchants 100000 --events 500000
+"""
+import argparse
+import json
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from darooghe_pulse import TransactionGenerator, serialize_event_block
+from fraud_features import haversine_km
+from geo_index import GeoChecks, GridIndex, haversine_km_array
+from window_aggregates import event_times
+
+
+def bench_haversine(count, rng):
+    lat1, lat2 = rng.uniform(25, 40, count), rng.uniform(25, 40, count)
+    lng1, lng2 = rng.uniform(44, 63, count), rng.uniform(44, 63, count)
+    started = time.perf_counter()
+    scalar = [haversine_km(a, b, c, d) for a, b, c, d in zip(lat1.tolist(), lng1.tolist(), lat2.tolist(), lng2.tolist())]
+    scalar_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    vector = haversine_km_array(lat1, lng1, lat2, lng2)
+    vector_seconds = time.perf_counter() - started
+    difference = float(np.max(np.abs(vector - np.array(scalar))))
+    print(f"haversine x{count:,}: scalar {scalar_seconds / count * 1e9:5.0f} ns/pair, "
+          f"vectorized {vector_seconds / count * 1e9:4.1f} ns/pair, max difference {difference:.2e} km")
+    return difference < 1e-6
+
+
+def bench_grid(bases, queries, rng):
+    grid = GridIndex()
+    started = time.perf_counter()
+    for merchant, base in bases.items():
+        grid.insert(merchant, base["lat"], base["lng"])
+    build_seconds = time.perf_counter() - started
+    names = list(bases)
+    lat = np.array([bases[m]["lat"] for m in names])
+    lng = np.array([bases[m]["lng"] for m in names])
+    points = [(35.7219 + rng.uniform(-0.12, 0.12), 51.3347 + rng.uniform(-0.12, 0.12)) for _ in range(queries)]
+
+    started = time.perf_counter()
+    answers = [(grid.nearest(a, b, 2), grid.nearby(a, b, 0.3)) for a, b in points]
+    grid_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    expected = []
+    for a, b in points:
+        distances = haversine_km_array(a, b, lat, lng)
+        closest = int(np.argmin(distances))
+        inside = np.flatnonzero(distances <= 0.3)
+        nearest = (float(distances[closest]), names[closest]) if distances[closest] <= 2 else None
+        expected.append((nearest, sorted((float(distances[i]), names[i]) for i in inside.tolist())))
+    brute_seconds = time.perf_counter() - started
+
+    same = all((found[0] is None and wanted[0] is None or found[0] is not None and wanted[0] is not None
+                and found[0][1] == wanted[0][1] and math.isclose(found[0][0], wanted[0][0], abs_tol = 1e-9))
+               and [k for _, k in found[1]] == [k for _, k in wanted[1]]
+               for found, wanted in zip(answers, expected))
+    print(f"grid of {len(bases):,} merchants built in {build_seconds:.2f}s: nearest within 2 km + 300 m radius "
+          f"{grid_seconds / queries * 1e6:6.1f} us/query vs brute force {brute_seconds / queries * 1e6:8.1f} us/query, "
+          f"{'identical' if same else 'DIFFERENT'} answers")
+    return same
+
+
+def bench_checks(generator, count, inject_every, shift_deg, batch_size):
+    end = datetime(2025, 5, 2)
+    block = generator.event_block(count, end - timedelta(hours = 24), end, sort_timestamps = True)
+    events = [json.loads(payload) for payload in serialize_event_block(block)[1]]
+    for event in events[::inject_every]:
+        event["location"]["lat"] += shift_deg
+    checks = GeoChecks(merchant_locations = '')
+    checks.merchants.load(generator.merchant_bases)
+
+    flagged = set()
+    travel = 0
+    elapsed = 0.0
+    for offset in range(0, count, batch_size):
+        batch = events[offset:offset + batch_size]
+        started = time.perf_counter()
+        alerts = checks.score(batch, event_times(batch))
+        elapsed += time.perf_counter() - started
+        for transaction, flags, _ in alerts:
+            codes = {flag["code"] for flag in flags}
+            if "FRAUD_MERCHANT_LOCATION" in codes:
+                flagged.add(transaction["transaction_id"])
+            travel += "FRAUD_TRAVEL_SPEED" in codes
+    injected = {event["transaction_id"] for event in events[::inject_every]}
+    caught = len(injected & flagged)
+    false_flags = len(flagged - injected)
+    print(f"GeoChecks on {count:,} events: {elapsed / count * 1e6:.1f} us/event, moved transactions flagged "
+          f"{caught:,}/{len(injected):,}, untouched ones flagged {false_flags:,}/{count - len(injected):,}, "
+          f"{travel:,} impossible-travel flags, {len(checks.customers):,} customers tracked")
+    return caught == len(injected) and false_flags == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--merchants', type = int, default = 100000)
+    parser.add_argument('--customers', type = int, default = 200000)
+    parser.add_argument('--events', type = int, default = 500000)
+    parser.add_argument('--pairs', type = int, default = 1000000)
+    parser.add_argument('--queries', type = int, default = 2000)
+    parser.add_argument('--inject-every', type = int, default = 100)
+    parser.add_argument('--shift-deg', type = float, default = 0.3)
+    parser.add_argument('--batch-size', type = int, default = 500)
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+
+    generator = TransactionGenerator(seed = args.seed, merchant_count = args.merchants, customer_count = args.customers)
+    ok = bench_haversine(args.pairs, np.random.default_rng(args.seed))
+    ok = bench_grid(generator.merchant_bases, args.queries, random.Random(args.seed)) and ok
+    ok = bench_checks(generator, args.events, args.inject_every, args.shift_deg, args.batch_size) and ok
+    if not ok:
+        raise SystemExit(1)
@@ -0,0 +1,130 @@
+"""Measure what the metrics instrumentation costs the batch consumer.
+
+1. Micro-costs: counter increment, histogram record (scalar and vectorized)
+   and rendering the Prometheus page, plus the histogram's quantile error
+   against numpy on exponential latencies. A label value with a quote, a
+   backslash and a newline (a rule code from the rules file) must come out
+   escaped on one line.
+2. The batch consumer, with every default stage, on `--messages` in-memory
+   messages (10% invalid, so error logs are produced), run in child processes
+   with METRICS=on and METRICS=off in alternating rounds. Reports the best
+   per-event time of each and the overhead of instrumentation.
+
+    python bench_metrics.py --messages 100000 --rounds 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def child(messages, batch_size):
+    import kafka_consumer
+    from fake_kafka import FakeConsumer, FakeProducer, transaction_messages
+    from metrics import REGISTRY
+    from state_checkpoint import PartitionStates
+
+    msgs = transaction_messages(messages)
+    consumer = FakeConsumer(msgs)
+    producer = FakeProducer(round_trip_ms = 0)
+    state = PartitionStates(kafka_consumer.build_stages, directory = None)
+    # CPU time: less exposed to other processes than wall time, and the fake broker never waits
+    started = time.process_time()
+    kafka_consumer.run_batch_consumer(consumer, producer, batch_size = batch_size, linger_ms = 0,
+                                      should_stop = consumer.exhausted, state = state)
+    elapsed = time.process_time() - started
+    print(json.dumps({"seconds": elapsed, "summary": REGISTRY.summary() if REGISTRY.enabled else ""}))
+
+
+def run_child(enabled, args):
+    env = {**os.environ, "METRICS": "on" if enabled else "off", "METRICS_LOG_INTERVAL": "0"}
+    output = subprocess.run([sys.executable, __file__, '--child', '--messages', str(args.messages),
+                             '--batch-size', str(args.batch_size)],
+                            env = env, check = True, capture_output = True, text = True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_micro(count):
+    from metrics import MetricsRegistry
+
+    registry = MetricsRegistry(enabled = True)
+    counter = registry.counter('bench_total', 'Counter')
+    histogram = registry.histogram('bench_seconds', 'Histogram')
+    labelled = registry.histogram('bench_stage_seconds', 'Labelled histogram', ('stage',))
+    values = np.random.default_rng(1).exponential(0.01, count)
+    scalars = values.tolist()
+
+    started = time.perf_counter()
+    for _ in range(count):
+        counter.inc()
+    inc_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for value in scalars:
+        histogram.record(value)
+    record_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for value in scalars:
+        labelled.labels('geo').record(value)
+    labelled_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for offset in range(0, count, 500):
+        histogram.record_many(values[offset:offset + 500])
+    many_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    page = registry.render()
+    render_seconds = time.perf_counter() - started
+
+    expected = np.quantile(values, [0.5, 0.9, 0.99, 0.999])
+    found = np.array(histogram.quantiles())
+    error = float(np.max(np.abs(found - expected) / expected))
+    print(f"counter.inc {inc_seconds / count * 1e9:.0f} ns, histogram.record {record_seconds / count * 1e9:.0f} ns, "
+          f"labelled record {labelled_seconds / count * 1e9:.0f} ns, record_many(500) "
+          f"{many_seconds / count * 1e9:.0f} ns/value, render {render_seconds * 1e3:.2f} ms ({len(page):,} bytes)")
+    print(f"quantiles p50/p90/p99/p99.9 within {error:.2%} of numpy on {count * 2:,} values")
+    return error < 0.01
+
+
+def check_label_escaping():
+    from metrics import MetricsRegistry
+
+    registry = MetricsRegistry(enabled = True)
+    registry.counter('bench_invalid_total', 'Counter', ('code',)).labels('ERR_"X"\\\nY').inc()
+    expected = 'bench_invalid_total{code="ERR_\\"X\\"\\\\\\nY"} 1'
+    ok = expected in registry.render().splitlines()
+    print(f"label escaping: {'ok' if ok else 'BROKEN EXPOSITION'}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type = int, default = 100000)
+    parser.add_argument('--batch-size', type = int, default = 500)
+    parser.add_argument('--rounds', type = int, default = 5)
+    parser.add_argument('--micro', type = int, default = 200000)
+    parser.add_argument('--child', action = 'store_true', help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.messages, args.batch_size)
+        raise SystemExit(0)
+
+    ok = bench_micro(args.micro) and check_label_escaping()
+    times = {True: [], False: []}
+    summary = ""
+    for _ in range(args.rounds):
+        for enabled in (False, True):
+            result = run_child(enabled, args)
+            times[enabled].append(result["seconds"])
+            summary = result["summary"] or summary
+    # Each round pairs an off and an on run; the median of the pairs' ratios shrugs off noisy rounds
+    overhead = float(np.median(np.array(times[True]) / np.array(times[False]))) - 1
+    print(f"batch consumer on {args.messages:,} messages, best of {args.rounds}: "
+          f"metrics off {min(times[False]) / args.messages * 1e6:.2f} us/event, "
+          f"on {min(times[True]) / args.messages * 1e6:.2f} us/event; median paired overhead {overhead:+.1%}")
+    print(f"last summary: {summary}")
+    if not ok:
+        raise SystemExit(1)
@@ -0,0 +1,89 @@
+"""Measure how close continuous_event_production gets to its target rate.
+
+First checks the pacer against a simulated clock (rate accuracy and the
+peak-hour multiplier), then runs the real loop into an in-memory sink at each
+rate and compares it with the previous sleep(expovariate) loop.
+
+    python bench_pacer.py --rates 1 100 1000 10000 100000 --seconds 5
+"""
+import argparse
+import datetime
+import random
+import time
+
+import darooghe_pulse
+from darooghe_codec import encode
+from event_pacer import PoissonPacer, peak_hour_rate
+from event_sinks import MemoryRingSink
+
+
+class FakeClock:
+    def __init__(self, start=datetime.datetime(2025, 5, 1, 8, 0)):
+        self.start = start
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def utcnow(self):
+        return self.start + datetime.timedelta(seconds=self.now)
+
+
+def check_simulated(base_rate=50.0, peak_factor=2.5):
+    # 08:00 -> 10:00 UTC: one hour at the base rate, one hour at the peak rate
+    clock = FakeClock()
+    pacer = PoissonPacer(peak_hour_rate(base_rate, peak_factor, clock.utcnow), clock=clock.monotonic,
+                         sleep=clock.sleep)
+    hourly = []
+    for _ in range(2):
+        emitted = pacer.emitted
+        while clock.now < 3600 * (len(hourly) + 1):
+            pacer.wait()
+        hourly.append((pacer.emitted - emitted) / 3600)
+    ok = abs(hourly[0] / base_rate - 1) < 0.02 and abs(hourly[1] / (base_rate * peak_factor) - 1) < 0.02
+    print(f"simulated clock: off-peak {hourly[0]:.2f}/s (target {base_rate}), "
+          f"peak {hourly[1]:.2f}/s (target {base_rate * peak_factor}) {'ok' if ok else 'OFF'}")
+    return ok
+
+
+def run_paced(rate, seconds):
+    sink = MemoryRingSink(1000)
+    generator = darooghe_pulse.TransactionGenerator(seed=7)
+    deadline = time.monotonic() + seconds
+    stats = darooghe_pulse.continuous_event_production(
+        sink, generator, rate * 60, peak_factor=1.0, should_stop=lambda: time.monotonic() >= deadline,
+        report_interval=seconds * 2)
+    return sink.total / stats["elapsed"]
+
+
+def run_legacy(rate, seconds):
+    # The loop continuous_event_production used before the pacer
+    sink = MemoryRingSink(1000)
+    generator = darooghe_pulse.TransactionGenerator(seed=7)
+    started = time.monotonic()
+    while time.monotonic() - started < seconds:
+        datetime.datetime.utcnow().hour
+        time.sleep(random.expovariate(rate))
+        event = generator.event()
+        sink.write(event["customer_id"], encode(event))
+    return sink.total / (time.monotonic() - started)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rates", type=float, nargs="+", default=[1, 10, 100, 1000, 10000, 100000])
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    if not check_simulated():
+        raise SystemExit(1)
+    for rate in args.rates:
+        # Low rates need longer runs for the Poisson count to settle
+        seconds = max(args.seconds, 200 / rate) if rate < 40 else args.seconds
+        paced = run_paced(rate, seconds)
+        legacy = run_legacy(rate, min(seconds, 5))
+        print(f"target {rate:>9,.0f}/s   paced {paced:>10,.1f}/s ({paced / rate:6.1%})   "
+              f"legacy {legacy:>10,.1f}/s ({legacy / rate:6.1%})")
@@ -0,0 +1,127 @@
+"""Check the compiled validation rules against the hand-written checks and time both.
+
+1. validation_rules.json (the amount, time and device checks as rules) must give
+   exactly the errors of validate_transaction on a batch of malformed and edge-case
+   records.
+2. Per-event time of validate_transaction, the compiled rules and, for reference,
+   columnar_validator.validate_batch on batches of `--sizes` events.
+3. Hot reload: a rule added to the file is picked up without restarting, and a
+   broken file (invalid JSON, an unknown operator, or rules of the wrong shape or
+   types) leaves the previous rules in force without raising.
+
+    python bench_rule_engine.py --sizes 10000 100000 1000000
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from bench_columnar_validator import mixed_batch, time_per_event
+from columnar_validator import validate_batch
+from fake_kafka import sample_transaction
+from rule_engine import RuleFile, RuleSet
+from transaction_validation import validate_transaction
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'validation_rules.json')
+
+# Rule files a reload must refuse: each is written over a working file in turn
+BROKEN_RULES = {
+    "invalid JSON": '[{"code": "ERR_BROKEN",',
+    "unknown operator": [{"code": "ERR_BROKEN", "when": {"nope": []}}],
+    "not a rule": ["not a rule"],
+    "unknown conversion": [{"code": "ERR_BROKEN", "when": {"gt": ["$amount", 0]}, "message": "{amount!x}"}],
+    "let as a list": [{"code": "ERR_BROKEN", "let": [{"a": 1}], "when": True}],
+    "duration not a number": [{"code": "ERR_BROKEN", "when": {"gt": ["$now", {"days": "x"}]}}],
+    "duration out of range": [{"code": "ERR_BROKEN", "when": {"gt": ["$now", {"days": 1e12}]}}],
+    "cases not a list": [{"code": "ERR_BROKEN", "cases": "x"}],
+    "message not a string": [{"code": "ERR_BROKEN", "when": True, "message": 3}],
+    "unbalanced template": [{"code": "ERR_BROKEN", "when": True, "message": "{amount"}],
+}
+
+
+def check_equivalence(rules, count = 20000):
+    now = datetime.utcnow()
+    transactions = mixed_batch(count, now, seed = 3)
+    expected = [validate_transaction(copy.deepcopy(t), now) for t in transactions]
+    actual = [rules.validate(t, now) for t in transactions]
+    batch = rules.validate_batch(transactions, now)
+    mismatches = [i for i in range(count) if expected[i] != actual[i] or expected[i] != batch.get(i, [])]
+    for i in mismatches[:5]:
+        print("MISMATCH", transactions[i], expected[i], actual[i])
+    flagged = sum(1 for errors in expected if errors)
+    print(f"equivalence: {count} records, {flagged} with errors, {len(mismatches)} mismatches")
+    return not mismatches
+
+
+def check_reload():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'rules.json')
+        shutil.copy(RULES_PATH, path)
+        rule_file = RuleFile(path, interval = 0)
+        transaction = sample_transaction(0, datetime.utcnow())
+        before = rule_file.validate(transaction)
+
+        with open(RULES_PATH) as f:
+            rules = json.load(f)
+        rules.append({"code": "ERR_LARGE_AMOUNT", "when": {"gt": ["$amount", 10000]},
+                      "message": "Amount {amount} is above the limit"})
+        with open(path, 'w') as f:
+            json.dump(rules, f)
+        os.utime(path, ns = (time.time_ns(), time.time_ns() + 10**9))
+        reloaded = rule_file.maybe_reload()
+        after = rule_file.validate(transaction)
+
+        not_ignored = []
+        for n, (name, broken) in enumerate(BROKEN_RULES.items(), 2):
+            with open(path, 'w') as f:
+                f.write(broken if isinstance(broken, str) else json.dumps(rules + broken))
+            os.utime(path, ns = (time.time_ns(), time.time_ns() + n * 10**9))
+            try:
+                kept = not rule_file.maybe_reload() and rule_file.validate(transaction) == after
+            except Exception as e:
+                kept = False
+                name = f"{name} ({type(e).__name__} raised)"
+            if not kept:
+                not_ignored.append(name)
+    finally:
+        shutil.rmtree(directory)
+    ok = before == [] and reloaded and [e["code"] for e in after] == ["ERR_LARGE_AMOUNT"] and not not_ignored
+    print(f"hot reload: new rule {'applied' if reloaded and after else 'MISSING'}, "
+          f"{len(BROKEN_RULES) - len(not_ignored)}/{len(BROKEN_RULES)} broken files ignored"
+          + (f", NOT IGNORED: {', '.join(not_ignored)}" if not_ignored else ""))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10000, 100000, 1000000])
+    parser.add_argument('--invalid-ratio', type = float, default = 0.1)
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.CRITICAL)
+
+    started = time.perf_counter()
+    rules = RuleSet.load(RULES_PATH)
+    print(f"compiled {len(rules.rules)} rules in {(time.perf_counter() - started) * 1000:.2f} ms")
+    ok = check_equivalence(rules)
+    ok = check_reload() and ok
+
+    now = datetime.utcnow()
+    for size in args.sizes:
+        invalid_every = round(1 / args.invalid_ratio) if args.invalid_ratio else 0
+        transactions = [sample_transaction(i, now, invalid = bool(invalid_every) and i % invalid_every == 0)
+                        for i in range(size)]
+        repeats = 1 if size >= 1000000 else 3
+        hand_written = time_per_event(lambda batch, now: [validate_transaction(t, now) for t in batch],
+                                      transactions, now, repeats = repeats)
+        compiled = time_per_event(rules.validate_batch, transactions, now, repeats = repeats)
+        columnar = time_per_event(validate_batch, transactions, now, repeats = repeats)
+        print(f"{size:>8} events: hand-written {hand_written:6.0f} ns/event, compiled rules {compiled:6.0f} ns/event "
+              f"({hand_written / compiled:.2f}x), columnar {columnar:5.0f} ns/event")
+    if not ok:
+        raise SystemExit(1)
@@ -0,0 +1,124 @@
+"""Compare direct error publishing with the local error spool under broker failures.
+
+The batch consumer runs over `--messages` in-memory transactions (`--invalid-ratio`
+of them invalid, each producing an error log) against a fake producer that can be
+slow, fail a share of deliveries at random, or fail everything during an outage.
+"direct" is the default path: every batch flushes the producer before committing.
+"spool" appends error logs to the memory-mapped spool and a background thread
+delivers them, retrying failures with backoff. Reported per run: consume
+throughput, the slowest batch, error logs delivered (unique) and lost, and how
+long the spool took to drain after the last batch.
+
+A last check stops a spooled consumer mid-outage and reopens its spool with a
+healthy producer: every error log must be delivered after the restart.
+
+    python bench_spool.py --messages 50000 --round-trip-ms 5
+"""
+import argparse
+import logging
+import shutil
+import tempfile
+import time
+
+import kafka_consumer
+from error_spool import SpooledProducer
+from fake_kafka import FakeConsumer, FlakyProducer, transaction_messages
+
+SCENARIOS = {
+    "healthy": {},
+    "slow": {"round_trip_factor": 20},
+    "flaky": {"failure_rate": 0.2},
+    "outage": {"outage": 2.0},
+}
+
+
+def delivered_ids(producer):
+    return {msg.key() if isinstance(msg.key(), str) else msg.key().decode() for msg in producer.delivered}
+
+
+def run(mode, scenario, args, directory):
+    settings = SCENARIOS[scenario]
+    fake = FlakyProducer(round_trip_ms = args.round_trip_ms * settings.get("round_trip_factor", 1),
+                         failure_rate = settings.get("failure_rate", 0.0), seed = args.seed)
+    if settings.get("outage"):
+        fake.set_outage(settings["outage"])
+    msgs = transaction_messages(args.messages, invalid_ratio = args.invalid_ratio)
+    expected = args.messages - sum(1 for i in range(args.messages) if i % round(1 / args.invalid_ratio))
+    consumer = FakeConsumer(msgs)
+    producer = fake if mode == "direct" else SpooledProducer(fake, directory, backoff_ms = args.backoff_ms,
+                                                             backoff_max_ms = args.backoff_max_ms)
+    slowest = 0.0
+
+    def on_batch(count, invalid_count, elapsed):
+        nonlocal slowest
+        slowest = max(slowest, elapsed)
+
+    started = time.perf_counter()
+    kafka_consumer.run_batch_consumer(consumer, producer, batch_size = args.batch_size, linger_ms = 0,
+                                      should_stop = consumer.exhausted, on_batch = on_batch)
+    consumed = time.perf_counter() - started
+    drained = 0.0
+    if mode == "spool":
+        while len(producer) and time.perf_counter() - started < args.drain_timeout:
+            time.sleep(0.01)
+        drained = time.perf_counter() - started - consumed
+        producer.close(0)
+    delivered = len(delivered_ids(fake))
+    print(f"{scenario:>8} {mode:>6}: {args.messages / consumed:9,.0f} msg/s, slowest batch {slowest * 1000:7.1f} ms, "
+          f"error logs delivered {delivered:,}/{expected:,} (lost {expected - delivered:,}, "
+          f"{fake.failed:,} failed attempts)" + (f", spool drained {drained:.2f}s after the last batch" if drained else ""))
+    return mode == "direct" or delivered == expected
+
+
+def check_restart(args, directory):
+    msgs = transaction_messages(args.messages, invalid_ratio = args.invalid_ratio)
+    down = FlakyProducer(round_trip_ms = args.round_trip_ms)
+    down.set_outage(3600)
+    producer = SpooledProducer(down, directory, backoff_ms = args.backoff_ms, backoff_max_ms = args.backoff_max_ms)
+    consumer = FakeConsumer(msgs)
+    kafka_consumer.run_batch_consumer(consumer, producer, batch_size = args.batch_size, linger_ms = 0,
+                                      should_stop = consumer.exhausted)
+    spooled = len(producer)
+    producer.close(0)
+
+    healthy = FlakyProducer(round_trip_ms = args.round_trip_ms)
+    started = time.perf_counter()
+    restarted = SpooledProducer(healthy, directory)
+    while len(restarted) and time.perf_counter() - started < args.drain_timeout:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    restarted.close(0)
+    delivered = len(delivered_ids(healthy))
+    print(f" restart: {spooled:,} error logs spooled during an outage, {delivered:,} delivered "
+          f"{elapsed:.2f}s after reopening the spool")
+    return delivered == spooled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type = int, default = 50000)
+    parser.add_argument('--invalid-ratio', type = float, default = 0.2)
+    parser.add_argument('--batch-size', type = int, default = 500)
+    parser.add_argument('--round-trip-ms', type = float, default = 5.0)
+    parser.add_argument('--backoff-ms', type = float, default = 50)
+    parser.add_argument('--backoff-max-ms', type = float, default = 1000)
+    parser.add_argument('--drain-timeout', type = float, default = 60)
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    ok = True
+    for scenario in SCENARIOS:
+        for mode in ("direct", "spool"):
+            directory = tempfile.mkdtemp()
+            try:
+                ok = run(mode, scenario, args, directory) and ok
+            finally:
+                shutil.rmtree(directory)
+    directory = tempfile.mkdtemp()
+    try:
+        ok = check_restart(args, directory) and ok
+    finally:
+        shutil.rmtree(directory)
+    if not ok:
+        raise SystemExit(1)
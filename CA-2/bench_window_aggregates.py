@@ -0,0 +1,135 @@
+"""Check the streaming window aggregates against a batch recomputation and
+measure throughput and open state as the stream grows.
+
+Events are generated over `--hours` of event time, then shuffled within runs of
+`--disorder` events so they arrive out of order. The watermark lateness is set
+just above the largest resulting delay, so no event may be dropped and every
+window must match the batch result exactly. A second pass with no lateness
+shows how many events the same stream loses as late. A third pass splits the
+stream over `--partitions` aggregators by customer, like the consumer's
+partitions; their partial windows, merged with merge_windows, must match too.
+
+    python bench_window_aggregates.py --events 200000 1000000 --size 300 --hop 60
+"""
+import argparse
+import json
+import random
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from darooghe_pulse import TransactionGenerator, serialize_event_block
+from window_aggregates import DIMENSIONS, WindowAggregator, event_times, merge_windows, window_starts
+
+
+def disordered_events(count, hours, disorder, seed):
+    generator = TransactionGenerator(seed = seed)
+    end = datetime(2025, 5, 1, 12)
+    block = generator.event_block(count, end - timedelta(hours = hours), end, sort_timestamps = True)
+    events = [json.loads(payload) for payload in serialize_event_block(block)[1]]
+    rng = random.Random(seed)
+    for offset in range(0, count, disorder):
+        chunk = events[offset:offset + disorder]
+        rng.shuffle(chunk)
+        events[offset:offset + disorder] = chunk
+    return events
+
+
+def max_delay(times):
+    newest, delay = float('-inf'), 0.0
+    for moment in times:
+        delay = max(delay, newest - moment)
+        newest = max(newest, moment)
+    return delay
+
+
+def batch_recompute(events, times, size, hop):
+    totals = defaultdict(lambda: [0, 0, 0, 0, 0])
+    for event, moment in zip(events, times):
+        for start in window_starts(moment, size, hop):
+            for dimension in DIMENSIONS:
+                row = totals[(start, dimension, str(event[dimension]))]
+                row[0] += 1
+                row[1] += event["status"] == "approved"
+                row[2] += event["amount"]
+                row[3] += event["commission_amount"]
+                row[4] += event["vat_amount"]
+    return {key: (*row, round(row[1] / row[0], 4)) for key, row in totals.items()}
+
+
+def flatten(results):
+    rows = {}
+    for result in results:
+        start = (datetime.fromisoformat(result["window_start"][:-1]) - datetime(1970, 1, 1)).total_seconds()
+        for dimension, values in result["dimensions"].items():
+            for key, stats in values.items():
+                rows[(start, dimension, key)] = (stats["count"], stats["approved"], stats["amount"],
+                                                 stats["commission"], stats["vat"], stats["approval_rate"])
+    return rows
+
+
+def stream(events, size, hop, lateness, batch_size = 500):
+    aggregator = WindowAggregator(size = size, hop = hop, lateness = lateness)
+    results = []
+    open_windows = open_values = 0
+    started = time.perf_counter()
+    for offset in range(0, len(events), batch_size):
+        results.extend(aggregator.aggregate(events[offset:offset + batch_size]))
+        open_windows = max(open_windows, len(aggregator.windows))
+        open_values = max(open_values, sum(len(values) for window in aggregator.windows.values()
+                                           for values in window.values()))
+    results.extend(aggregator.flush())
+    return results, aggregator, time.perf_counter() - started, open_windows, open_values
+
+
+def stream_partitioned(events, size, hop, lateness, partitions):
+    # Each partition's aggregator sees its customers' events in their original order
+    by_partition = [[] for _ in range(partitions)]
+    for event in events:
+        by_partition[zlib.crc32(event["customer_id"].encode()) % partitions].append(event)
+    results = []
+    for partition, partition_events in enumerate(by_partition):
+        aggregator = WindowAggregator(size = size, hop = hop, lateness = lateness)
+        aggregator.assign('darooghe.transactions', partition)
+        results.extend(stream_with(aggregator, partition_events))
+    return results
+
+
+def stream_with(aggregator, events, batch_size = 500):
+    results = []
+    for offset in range(0, len(events), batch_size):
+        results.extend(aggregator.aggregate(events[offset:offset + batch_size]))
+    return results + aggregator.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type = int, nargs = '+', default = [200000, 1000000])
+    parser.add_argument('--hours', type = float, default = 6)
+    parser.add_argument('--size', type = float, default = 300)
+    parser.add_argument('--hop', type = float, default = 60)
+    parser.add_argument('--disorder', type = int, default = 200, help = "events shuffled together")
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--partitions', type = int, default = 4)
+    args = parser.parse_args()
+
+    ok = True
+    for count in args.events:
+        events = disordered_events(count, args.hours, args.disorder, args.seed)
+        times = event_times(events)
+        lateness = max_delay(times) + 1
+        results, aggregator, elapsed, open_windows, open_values = stream(events, args.size, args.hop, lateness)
+        expected = batch_recompute(events, times, args.size, args.hop)
+        matches = flatten(results) == expected
+        partials = stream_partitioned(events, args.size, args.hop, lateness, args.partitions)
+        merged = flatten(merge_windows(partials)) == expected
+        ok = ok and matches and merged and aggregator.late == 0
+        _, strict, _, _, _ = stream(events, args.size, args.hop, 0)
+        print(f"{count:>9} events: {elapsed:6.2f}s ({elapsed / count * 1e6:5.1f} us/event), {len(results)} windows, "
+              f"at most {open_windows} open ({open_values} values) | lateness {lateness:.0f}s: "
+              f"{'matches batch' if matches else 'DIFFERS FROM BATCH'}, {aggregator.late} late | "
+              f"lateness 0s: {strict.late} late | {args.partitions} partitions: {len(partials)} partials, "
+              f"{'merged match batch' if merged else 'MERGED DIFFER FROM BATCH'}")
+    if not ok:
+        raise SystemExit(1)
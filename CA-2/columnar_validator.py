@@ -0,0 +1,141 @@
+from datetime import datetime
+from operator import itemgetter
+
+import numpy as np
+
+from transaction_validation import validate_time
+
+PAYMENT_METHOD_CODES = {"online": 0, "pos": 1, "mobile": 2, "nfc": 3}
+DEVICE_OS_CODES = {"iOS": 1, "Android": 2}
+MOBILE = PAYMENT_METHOD_CODES["mobile"]
+ONE_DAY_US = 86400 * 10**6
+
+# Character positions of "YYYY-MM-DDTHH:MM:SS.ffffff"
+DIGITS_19 = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+DIGITS_FRACTION = [20, 21, 22, 23, 24, 25]
+TIMESTAMP_WIDTH = 27
+
+
+def numeric_column(values):
+    column = np.array(values)
+    if column.dtype.kind not in 'iufO':
+        raise TypeError(f"Non-numeric amount column of dtype {column.dtype}")
+    return column
+
+
+def transaction_columns(transactions):
+    n = len(transactions)
+    payment_methods = np.fromiter(map(PAYMENT_METHOD_CODES.get, map(itemgetter('payment_method'), transactions),
+                                      [-1] * n),
+                                  dtype = np.int8, count = n)
+    mobile_rows = np.flatnonzero(payment_methods == MOBILE)
+    device_os = np.zeros(n, dtype = np.int8)
+    device_os[mobile_rows] = np.fromiter(
+        (DEVICE_OS_CODES.get(t['device_info'].get('os'), 0) if 'device_info' in t else 0
+         for t in map(transactions.__getitem__, mobile_rows.tolist())),
+        dtype = np.int8, count = len(mobile_rows))
+    return {
+        # np.array keeps ints as int64 (or exact Python ints when they overflow) and floats as float64
+        "amount": numeric_column(list(map(itemgetter('amount'), transactions))),
+        "vat_amount": numeric_column(list(map(itemgetter('vat_amount'), transactions))),
+        "commission_amount": numeric_column(list(map(itemgetter('commission_amount'), transactions))),
+        "total_amount": numeric_column(list(map(itemgetter('total_amount'), transactions))),
+        "timestamp": list(map(itemgetter('timestamp'), transactions)),
+        "payment_method": payment_methods,
+        "device_os": device_os,
+    }
+
+
+def parse_timestamps(timestamps):
+    # Canonical "YYYY-MM-DD[T ]HH:MM:SS[.ffffff][Z]" strings are decoded straight from their
+    # code points; anything else is flagged so the caller can hand it to validate_time.
+    n = len(timestamps)
+    epoch_us = np.zeros(n, dtype = np.int64)
+    raw = np.array(timestamps)
+    if n == 0 or raw.dtype.kind != 'U' or raw.ndim != 1 or raw.dtype.itemsize // 4 < 19:
+        return epoch_us, np.ones(n, dtype = bool)
+
+    width = min(raw.dtype.itemsize // 4, TIMESTAMP_WIDTH)
+    points = raw.view(np.uint32).reshape(n, -1)[:, :width]
+    codes = np.zeros((n, TIMESTAMP_WIDTH), dtype = np.uint8)
+    codes[:, :width] = points
+    lengths = np.char.str_len(raw)
+    has_z = codes[np.arange(n), np.clip(lengths - 1, 0, TIMESTAMP_WIDTH - 1)] == ord('Z')
+    body = lengths - has_z
+    with_fraction = body == 26
+    digits = codes.astype(np.int32) - ord('0')
+
+    ok = (
+        ((body == 19) | with_fraction)
+        & (points < 128).all(axis = 1)
+        & (codes[:, 4] == ord('-')) & (codes[:, 7] == ord('-'))
+        & ((codes[:, 10] == ord('T')) | (codes[:, 10] == ord(' ')))
+        & (codes[:, 13] == ord(':')) & (codes[:, 16] == ord(':'))
+        & ((digits[:, DIGITS_19] >= 0) & (digits[:, DIGITS_19] <= 9)).all(axis = 1)
+        & (~with_fraction | (
+            (codes[:, 19] == ord('.'))
+            & ((digits[:, DIGITS_FRACTION] >= 0) & (digits[:, DIGITS_FRACTION] <= 9)).all(axis = 1)))
+    )
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 5] * 10 + digits[:, 6]
+    day = digits[:, 8] * 10 + digits[:, 9]
+    hour = digits[:, 11] * 10 + digits[:, 12]
+    minute = digits[:, 14] * 10 + digits[:, 15]
+    second = digits[:, 17] * 10 + digits[:, 18]
+    fraction = np.where(with_fraction, digits[:, DIGITS_FRACTION] @ (10 ** np.arange(5, -1, -1)), 0)
+
+    ok &= (year >= 1) & (month >= 1) & (month <= 12) & (hour < 24) & (minute < 60) & (second < 60)
+    months = np.where(ok, (year - 1970) * 12 + month - 1, 0)
+    month_start = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+    month_days = (months + 1).astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) - month_start
+    ok &= (day >= 1) & (day <= month_days)
+
+    epoch_us = ((month_start + day - 1) * 86400 + hour * 3600 + minute * 60 + second) * 10**6 + fraction
+    return epoch_us, ~ok
+
+
+def validate_batch(transactions, current_time = None):
+    # Returns {batch index: errors} for the records validate_transaction would reject.
+    # Raises KeyError/TypeError like validate_transaction when a record is malformed,
+    # so callers can fall back to the per-record path for that batch.
+    if current_time is None:
+        current_time = datetime.utcnow()
+    columns = transaction_columns(transactions)
+
+    # Mirrors validate_amount, whose commission term is a separate statement
+    amount_bad = np.asarray(columns["total_amount"] != columns["amount"] + columns["vat_amount"], dtype = bool)
+
+    epoch_us, needs_fallback = parse_timestamps(columns["timestamp"])
+    now_us = int(np.datetime64(current_time, 'us').astype(np.int64))
+    future = ~needs_fallback & (epoch_us > now_us)
+    too_old = ~needs_fallback & ~future & (now_us - epoch_us > ONE_DAY_US)
+
+    device_bad = (columns["payment_method"] == MOBILE) & (columns["device_os"] == 0)
+
+    results = {}
+    for i in np.flatnonzero(amount_bad | future | too_old | needs_fallback | device_bad).tolist():
+        transaction = transactions[i]
+        errors = []
+        if amount_bad[i]:
+            errors.append({
+                "code" : "ERR_AMOUNT",
+                "message" : f'Total amount mismatch. Expected {transaction["amount"] + transaction["vat_amount"]}, got {transaction["total_amount"]}'
+            })
+        if needs_fallback[i]:
+            validate_time(transaction, errors, current_time)
+        elif future[i] or too_old[i]:
+            transaction_time = np.datetime64(int(epoch_us[i]), 'us').item()
+            reason = 'in the future' if future[i] else 'older than 24 hours'
+            errors.append({
+                "code" : "ERR_TIME",
+                "message" : f'Transaction time is {reason}. Transaction time: {transaction_time}, Current time: {current_time}'
+            })
+        if device_bad[i]:
+            errors.append({
+                "code" : "ERR_DEVICE",
+                "message" : f'Invalid device information for payment method {transaction["payment_method"]}'
+            })
+        if errors:
+            results[i] = errors
+    return results
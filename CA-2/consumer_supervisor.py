@@ -0,0 +1,202 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from confluent_kafka import Consumer, KafkaException, Producer
+
+import kafka_consumer
+from error_spool import ERROR_SPOOL_DIR, SpooledProducer
+from metrics import METRICS_PORT, REGISTRY
+from state_checkpoint import PartitionStates
+
+CONSUMER_WORKERS = int(os.getenv('CONSUMER_WORKERS', os.cpu_count() or 1))
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', 30))
+# A worker that exits is restarted after 1s, doubling up to 60s while it keeps failing
+RESTART_BACKOFF = float(os.getenv('WORKER_RESTART_BACKOFF', 1))
+RESTART_BACKOFF_MAX = float(os.getenv('WORKER_RESTART_BACKOFF_MAX', 60))
+
+
+class WorkerMetrics:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.messages = 0
+        self.invalid = 0
+        self.batches = 0
+        self.busy_seconds = 0.0
+        self.partitions = []
+        self.rebalances = 0
+
+    def record_batch(self, count, invalid_count, elapsed):
+        self.messages += count
+        self.invalid += invalid_count
+        self.batches += 1
+        self.busy_seconds += elapsed
+
+    def snapshot(self):
+        return {
+            "worker": self.worker_id,
+            "pid": os.getpid(),
+            "messages": self.messages,
+            "invalid": self.invalid,
+            "batches": self.batches,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "partitions": list(self.partitions),
+            "rebalances": self.rebalances,
+        }
+
+
+def worker_main(worker_id, stop_event, metrics_queue):
+    # The supervisor owns shutdown; workers finish their batch once stop_event is set
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    metrics = WorkerMetrics(worker_id)
+    if METRICS_PORT:
+        # One endpoint per worker process: METRICS_PORT + worker id
+        REGISTRY.serve(METRICS_PORT + worker_id)
+    consumer = Consumer(REGISTRY.client_conf({
+        **kafka_consumer.batch_conf,
+        'client.id': f'validator-{worker_id}',
+        'partition.assignment.strategy': 'cooperative-sticky',
+    }))
+    producer = Producer(REGISTRY.client_conf({'bootstrap.servers': kafka_consumer.KAFKA_BROKER}))
+    if ERROR_SPOOL_DIR:
+        # A spool belongs to one process: each worker keeps its own directory
+        producer = SpooledProducer(producer, os.path.join(ERROR_SPOOL_DIR, f'worker-{worker_id}'),
+                                   on_delivery = kafka_consumer.delivery_report)
+    state = PartitionStates(kafka_consumer.build_stages, incremental = True)
+
+    def on_assign(consumer, partitions):
+        metrics.rebalances += 1
+        metrics.partitions.extend(p.partition for p in partitions)
+        logging.info(f"Worker {worker_id} assigned partitions {[p.partition for p in partitions]}")
+        # Restores each partition's snapshot and resumes from the offset it was taken at
+        state.on_assign(consumer, partitions)
+
+    def on_revoke(consumer, partitions):
+        # Every consumed batch is committed before the next consume(), so only
+        # pending error logs need draining before the partitions move away
+        metrics.rebalances += 1
+        producer.flush(kafka_consumer.FLUSH_TIMEOUT)
+        revoked = {p.partition for p in partitions}
+        metrics.partitions = [p for p in metrics.partitions if p not in revoked]
+        logging.info(f"Worker {worker_id} revoked partitions {sorted(revoked)}")
+        state.on_revoke(consumer, partitions)
+
+    last_report = time.monotonic()
+
+    def on_batch(count, invalid_count, elapsed):
+        nonlocal last_report
+        metrics.record_batch(count, invalid_count, elapsed)
+        if time.monotonic() - last_report >= METRICS_INTERVAL:
+            metrics_queue.put(metrics.snapshot())
+            last_report = time.monotonic()
+
+    consumer.subscribe([kafka_consumer.TRANSACTIONS_TOPIC], on_assign = on_assign, on_revoke = on_revoke)
+    kafka_consumer.wait_for_topic(consumer)
+    try:
+        kafka_consumer.run_batch_consumer(consumer, producer, should_stop = stop_event.is_set,
+                                          on_batch = on_batch, state = state)
+        # Only after a clean stop: a batch interrupted by an exception must neither be committed nor
+        # reach a snapshot, so that it is redelivered
+        producer.flush(kafka_consumer.FLUSH_TIMEOUT)
+        try:
+            consumer.commit(asynchronous = False)
+        except KafkaException:
+            pass  # Nothing consumed since the last commit
+        state.checkpoint()
+    finally:
+        producer.flush(kafka_consumer.FLUSH_TIMEOUT)
+        consumer.close()
+        if ERROR_SPOOL_DIR:
+            producer.close(kafka_consumer.FLUSH_TIMEOUT)
+        metrics_queue.put(metrics.snapshot())
+        logging.info(f"Worker {worker_id} stopped after {metrics.messages} messages")
+
+
+def log_metrics(latest):
+    total = sum(m["messages"] for m in latest.values())
+    for worker_id in sorted(latest):
+        m = latest[worker_id]
+        rate = m["messages"] / m["busy_seconds"] if m["busy_seconds"] else 0
+        logging.info(f"Worker {worker_id} (pid {m['pid']}): {m['messages']} messages, {m['invalid']} invalid, "
+                     f"{rate:.0f} msgs/busy-sec, partitions {m['partitions']}")
+    logging.info(f"All workers: {total} messages")
+
+
+def supervise(worker_count = CONSUMER_WORKERS):
+    stop_event = multiprocessing.Event()
+    metrics_queue = multiprocessing.Queue()
+    workers = {}
+    latest = {}
+    started_at = {}
+    failures = {}
+    restart_at = {}
+
+    def start_worker(worker_id):
+        process = multiprocessing.Process(target = worker_main, args = (worker_id, stop_event, metrics_queue),
+                                          name = f'validator-{worker_id}')
+        process.start()
+        workers[worker_id] = process
+        started_at[worker_id] = time.monotonic()
+
+    def request_stop(signum, frame):
+        logging.info("Stopping workers...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    logging.info(f"Starting {worker_count} consumer workers")
+    for worker_id in range(worker_count):
+        start_worker(worker_id)
+
+    last_log = time.monotonic()
+    while not stop_event.is_set():
+        try:
+            snapshot = metrics_queue.get(timeout = 1)
+            latest[snapshot["worker"]] = snapshot
+        except queue.Empty:
+            pass
+        now = time.monotonic()
+        for worker_id, process in list(workers.items()):
+            if process.is_alive() or stop_event.is_set():
+                continue
+            if worker_id not in restart_at:
+                # A worker stuck on a poison batch fails again at once: back off instead of respawning it
+                # every second. One that ran for a while before exiting starts over from the base delay.
+                if now - started_at[worker_id] >= RESTART_BACKOFF_MAX:
+                    failures[worker_id] = 0
+                delay = min(RESTART_BACKOFF * 2 ** failures.get(worker_id, 0), RESTART_BACKOFF_MAX)
+                failures[worker_id] = failures.get(worker_id, 0) + 1
+                restart_at[worker_id] = now + delay
+                logging.warning(f"Worker {worker_id} exited with code {process.exitcode}, restarting in {delay:.0f}s")
+            elif now >= restart_at[worker_id]:
+                del restart_at[worker_id]
+                start_worker(worker_id)
+        if latest and time.monotonic() - last_log >= METRICS_INTERVAL:
+            log_metrics(latest)
+            last_log = time.monotonic()
+
+    deadline = time.monotonic() + kafka_consumer.FLUSH_TIMEOUT + 5
+    for worker_id, process in workers.items():
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            logging.warning(f"Worker {worker_id} did not stop in time, terminating")
+            process.terminate()
+            process.join()
+    while True:
+        try:
+            snapshot = metrics_queue.get_nowait()
+            latest[snapshot["worker"]] = snapshot
+        except queue.Empty:
+            break
+    if latest:
+        log_metrics(latest)
+
+
+if __name__ == "__main__":
+    supervise()
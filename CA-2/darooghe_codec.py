@@ -0,0 +1,139 @@
+import json
+import os
+from typing import Optional, TypedDict, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+Number = Union[int, float]
+
+
+class Location(TypedDict):
+    lat: float
+    lng: float
+
+
+class _TransactionOptional(TypedDict, total = False):
+    customer_id: str
+    merchant_id: str
+    merchant_category: str
+    location: Location
+    device_info: dict
+    status: str
+    commission_type: str
+    customer_type: str
+    risk_level: int
+    failure_reason: Optional[str]
+
+
+class Transaction(_TransactionOptional):
+    # Fields the consumer reads on every message
+    transaction_id: str
+    timestamp: str
+    payment_method: str
+    amount: Number
+    commission_amount: Number
+    vat_amount: Number
+    total_amount: Number
+
+
+REQUIRED_FIELDS = Transaction.__required_keys__
+
+
+def check_transaction(transaction):
+    # Every backend only checks the shape: field types are the validator's to report (as ERR_TYPE)
+    if not isinstance(transaction, dict):
+        raise json.JSONDecodeError(f"Expected a JSON object, got {type(transaction).__name__}", '', 0)
+    missing = REQUIRED_FIELDS.difference(transaction)
+    if missing:
+        raise KeyError(min(missing))
+    return transaction
+
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode()
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def decode_transaction(self, data):
+        return check_transaction(json.loads(data))
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def encode(self, obj):
+        return orjson.dumps(obj)
+
+    def decode(self, data):
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError
+        return orjson.loads(data)
+
+    def decode_transaction(self, data):
+        return check_transaction(orjson.loads(data))
+
+
+class MsgspecCodec(JsonCodec):
+    name = 'msgspec'
+
+    def __init__(self):
+        self.encoder = msgspec.json.Encoder()
+        self.decoder = msgspec.json.Decoder()
+        self.transaction_decoder = msgspec.json.Decoder(Transaction)
+
+    def encode(self, obj):
+        return self.encoder.encode(obj)
+
+    def decode(self, data):
+        try:
+            return self.decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise json.JSONDecodeError(str(e), '', 0) from e
+
+    def decode_transaction(self, data):
+        # Decoding into Transaction is the fast path. A message that does not match it (a missing
+        # field, or one of the wrong type) is decoded again as a plain object, so that it reaches
+        # validation and error_logs exactly as with the other backends
+        try:
+            return self.transaction_decoder.decode(data)
+        except msgspec.ValidationError:
+            return check_transaction(self.decode(data))
+        except msgspec.DecodeError as e:
+            raise json.JSONDecodeError(str(e), '', 0) from e
+
+
+BACKENDS = {
+    'msgspec': MsgspecCodec if msgspec else None,
+    'orjson': OrjsonCodec if orjson else None,
+    'json': JsonCodec,
+}
+
+
+def available_backends():
+    return [name for name, backend in BACKENDS.items() if backend]
+
+
+def get_codec(name = 'auto'):
+    if name == 'auto':
+        name = available_backends()[0]
+    backend = BACKENDS.get(name)
+    if backend is None:
+        raise ValueError(f"Codec backend '{name}' is not available (have {available_backends()})")
+    return backend()
+
+
+codec = get_codec(os.getenv('DAROOGHE_CODEC', 'auto').lower())
+encode = codec.encode
+decode = codec.decode
+decode_transaction = codec.decode_transaction
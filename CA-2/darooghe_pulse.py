@@ -1,14 +1,22 @@
 import os
+import json
 import time
 import random
 import uuid
-import json
+import argparse
+import itertools
 import datetime
 import logging
 from datetime import timedelta
+import numpy as np
 from confluent_kafka import Producer, Consumer, TopicPartition
 from confluent_kafka.admin import AdminClient
 
+from darooghe_codec import encode
+from event_pacer import PoissonPacer, peak_hour_rate
+from event_sinks import DELIVERY_FAILURES, KafkaSink, open_sink
+from metrics import REGISTRY
+
 log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(
     level=getattr(logging, log_level_str, logging.INFO),
@@ -32,107 +40,265 @@ DEVICE_INFO_LIBRARY = [
     {"os": "Android", "app_version": "1.9.5", "device_model": "Google Pixel 6"},
 ]
 
+# Bulk backfill: events are generated column-wise and rendered with a fixed template
+BULK_BLOCK_SIZE = 10000
+BULK_PRODUCER_CONF = {
+    "linger.ms": 50,
+    "batch.num.messages": 10000,
+    "batch.size": 1048576,
+    "compression.type": "lz4",
+    "queue.buffering.max.messages": 500000,
+    "queue.buffering.max.kbytes": 1048576,
+}
+EVENT_TEMPLATE = (
+    '{"transaction_id":"%s","timestamp":"%sZ","customer_id":"%s","merchant_id":"merch_%d",%s,'
+    '"amount":%d,"location":{"lat":%s,"lng":%s},%s,'
+    '"commission_amount":%d,"vat_amount":%d,"total_amount":%d,%s}'
+)
+DEVICE_PAYMENT_METHODS = [PAYMENT_METHODS.index(m) for m in ["online", "mobile"]]
+RISK_LEVELS = [1, 2, 3, 5]
+# Pre-rendered JSON for every combination of the adjacent categorical fields,
+# so a row is formatted from 13 values instead of 18
+CATEGORY_PAYMENT_JSON = np.array([
+    f'"merchant_category":"{c}","payment_method":"{m}"'
+    for c, m in itertools.product(MERCHANT_CATEGORIES, PAYMENT_METHODS)
+], dtype=object)
+DEVICE_STATUS_COMMISSION_JSON = np.array([
+    f'"device_info":{d},"status":"{s}","commission_type":"{c}"'
+    for d, s, c in itertools.product(
+        ["{}"] + [encode(d).decode() for d in DEVICE_INFO_LIBRARY], ["approved", "declined"], COMMISSION_TYPES)
+], dtype=object)
+CUSTOMER_RISK_FAILURE_JSON = np.array([
+    f'"customer_type":"{c}","risk_level":{r},"failure_reason":{f}'
+    for c, r, f in itertools.product(CUSTOMER_TYPES, RISK_LEVELS, ["null"] + [f'"{f}"' for f in FAILURE_REASONS])
+], dtype=object)
+# Continuous production: bursts this large are generated as a block instead of event by event
+BURST_BLOCK_MIN = 32
+PACING_REPORT_INTERVAL = float(os.getenv("PACING_REPORT_INTERVAL", 30))
+HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+UUID_HEX_POSITIONS = [i for i in range(36) if i not in (8, 13, 18, 23)]
 
-def generate_random_datetime(start, end):
-    delta = end - start
-    random_seconds = random.uniform(0, delta.total_seconds())
-    return start + timedelta(seconds=random_seconds)
 
+class TransactionGenerator:
+    # Owns its random state, so a seed reproduces the same event stream
+    def __init__(self, seed=None, merchant_count=50, customer_count=1000, fraud_rate=0.02, declined_rate=0.05):
+        self.rng = random.Random(seed)
+        self.np_rng = np.random.default_rng(seed)
+        self.customer_count = customer_count
+        self.fraud_rate = fraud_rate
+        self.declined_rate = declined_rate
+        self.merchant_bases = {
+            f"merch_{i}": {
+                "lat": 35.7219 + self.rng.uniform(-0.1, 0.1),
+                "lng": 51.3347 + self.rng.uniform(-0.1, 0.1),
+            }
+            for i in range(1, merchant_count + 1)
+        }
+        self.merchant_lat = np.array([base["lat"] for base in self.merchant_bases.values()])
+        self.merchant_lng = np.array([base["lng"] for base in self.merchant_bases.values()])
 
-def generate_transaction_event(is_historical=False, timestamp_override=None):
-    event_time = (
-        timestamp_override if timestamp_override else datetime.datetime.utcnow()
-    )
-    transaction_id = str(uuid.uuid4())
-    customer_id = f"cust_{random.randint(1, customer_count)}"
-    merchant_id = f"merch_{random.randint(1, merchant_count)}"
-    merchant_category = random.choice(MERCHANT_CATEGORIES)
-    payment_method = random.choice(PAYMENT_METHODS)
-    amount = random.randint(50000, 2000000)
-    base = merchant_bases[merchant_id]
-    location = {
-           "lat": base["lat"] + random.uniform(-0.005, 0.005),
-           "lng": base["lng"] + random.uniform(-0.005, 0.005),
-    }
+    def random_datetime(self, start, end):
+        delta = end - start
+        random_seconds = self.rng.uniform(0, delta.total_seconds())
+        return start + timedelta(seconds=random_seconds)
 
-    device_info = (
-        random.choice(DEVICE_INFO_LIBRARY)
-        if payment_method in ["online", "mobile"]
-        else {}
-    )
-    if random.random() < declined_rate:
-        status = "declined"
-        failure_reason = random.choice(FAILURE_REASONS)
-    else:
-        status = "approved"
-        failure_reason = None
-    risk_level = 5 if random.random() < fraud_rate else random.randint(1, 3)
-    commission_type = random.choice(COMMISSION_TYPES)
-    commission_amount = int(amount * 0.02)
-    vat_amount = int(amount * 0.09)
-    total_amount = amount + vat_amount + commission_amount
-    event = {
-        "transaction_id": transaction_id,
-        "timestamp": event_time.isoformat() + "Z",
-        "customer_id": customer_id,
-        "merchant_id": merchant_id,
-        "merchant_category": merchant_category,
-        "payment_method": payment_method,
-        "amount": amount,
-        "location": location,
-        "device_info": device_info,
-        "status": status,
-        "commission_type": commission_type,
-        "commission_amount": commission_amount,
-        "vat_amount": vat_amount,
-        "total_amount": total_amount,
-        "customer_type": random.choice(CUSTOMER_TYPES),
-        "risk_level": risk_level,
-        "failure_reason": failure_reason,
-    }
-    return event
+    def event(self, timestamp=None):
+        rng = self.rng
+        event_time = timestamp if timestamp else datetime.datetime.utcnow()
+        transaction_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        customer_id = f"cust_{rng.randint(1, self.customer_count)}"
+        merchant_id = f"merch_{rng.randint(1, len(self.merchant_bases))}"
+        merchant_category = rng.choice(MERCHANT_CATEGORIES)
+        payment_method = rng.choice(PAYMENT_METHODS)
+        amount = rng.randint(50000, 2000000)
+        base = self.merchant_bases[merchant_id]
+        location = {
+            "lat": base["lat"] + rng.uniform(-0.005, 0.005),
+            "lng": base["lng"] + rng.uniform(-0.005, 0.005),
+        }
+
+        device_info = (
+            rng.choice(DEVICE_INFO_LIBRARY)
+            if payment_method in ["online", "mobile"]
+            else {}
+        )
+        if rng.random() < self.declined_rate:
+            status = "declined"
+            failure_reason = rng.choice(FAILURE_REASONS)
+        else:
+            status = "approved"
+            failure_reason = None
+        risk_level = 5 if rng.random() < self.fraud_rate else rng.randint(1, 3)
+        commission_type = rng.choice(COMMISSION_TYPES)
+        commission_amount = int(amount * 0.02)
+        vat_amount = int(amount * 0.09)
+        total_amount = amount + vat_amount + commission_amount
+        event = {
+            "transaction_id": transaction_id,
+            "timestamp": event_time.isoformat() + "Z",
+            "customer_id": customer_id,
+            "merchant_id": merchant_id,
+            "merchant_category": merchant_category,
+            "payment_method": payment_method,
+            "amount": amount,
+            "location": location,
+            "device_info": device_info,
+            "status": status,
+            "commission_type": commission_type,
+            "commission_amount": commission_amount,
+            "vat_amount": vat_amount,
+            "total_amount": total_amount,
+            "customer_type": rng.choice(CUSTOMER_TYPES),
+            "risk_level": risk_level,
+            "failure_reason": failure_reason,
+        }
+        return event
+
+    def event_block(self, count, start_time, end_time, sort_timestamps=False):
+        return generate_event_block(self.np_rng, count, start_time, end_time, self.merchant_lat, self.merchant_lng,
+                                    self.customer_count, self.fraud_rate, self.declined_rate, sort_timestamps)
 
 
 def delivery_report(err, msg):
     if err is not None:
+        DELIVERY_FAILURES.inc()
         logging.error(f"Message delivery failed: {err}")
     else:
         logging.debug(f"Delivered to {msg.topic()} [{msg.partition()}]")
 
 
-def produce_historical_events(producer, topic, count=20000):
-    logging.info(f"Producing {count} historical events...")
-    now = datetime.datetime.utcnow()
+def random_uuid4_strings(rng, count):
+    raw = rng.integers(0, 256, (count, 16), dtype=np.uint8)
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40  # version 4
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80  # RFC 4122 variant
+    chars = np.full((count, 36), ord("-"), dtype=np.uint8)
+    chars[:, UUID_HEX_POSITIONS] = HEX_DIGITS[np.stack([raw >> 4, raw & 0x0F], axis=2).reshape(count, 32)]
+    text = chars.tobytes().decode()
+    return [text[i:i + 36] for i in range(0, 36 * count, 36)]
+
+
+def generate_event_block(rng, count, start_time, end_time, merchant_lat, merchant_lng,
+                         customer_count, fraud_rate, declined_rate, sort_timestamps=False):
+    span_us = int((end_time - start_time).total_seconds() * 1e6)
+    offsets = rng.integers(0, span_us, count, endpoint=True)
+    if sort_timestamps:
+        offsets.sort()
+    merchant = rng.integers(1, len(merchant_lat), count, endpoint=True)
+    payment_method = rng.integers(0, len(PAYMENT_METHODS), count)
+    amount = rng.integers(50000, 2000000, count, endpoint=True)
+    declined = rng.random(count) < declined_rate
+    fraud = rng.random(count) < fraud_rate
+    has_device = np.isin(payment_method, DEVICE_PAYMENT_METHODS)
+    return {
+        "transaction_id": random_uuid4_strings(rng, count),
+        "timestamp": np.datetime64(start_time, "us") + offsets.astype("timedelta64[us]"),
+        "customer": rng.integers(1, customer_count, count, endpoint=True),
+        "merchant": merchant,
+        "merchant_category": rng.integers(0, len(MERCHANT_CATEGORIES), count),
+        "payment_method": payment_method,
+        "amount": amount,
+        "lat": merchant_lat[merchant - 1] + rng.uniform(-0.005, 0.005, count),
+        "lng": merchant_lng[merchant - 1] + rng.uniform(-0.005, 0.005, count),
+        "device": np.where(has_device, rng.integers(0, len(DEVICE_INFO_LIBRARY), count), -1),
+        "declined": declined,
+        "failure_reason": np.where(declined, rng.integers(0, len(FAILURE_REASONS), count), -1),
+        "risk_level": np.where(fraud, 5, rng.integers(1, 3, count, endpoint=True)),
+        "commission_type": rng.integers(0, len(COMMISSION_TYPES), count),
+        # Same float arithmetic as int(amount * 0.02) in TransactionGenerator.event
+        "commission_amount": (amount * 0.02).astype(np.int64),
+        "vat_amount": (amount * 0.09).astype(np.int64),
+        "customer_type": rng.integers(0, len(CUSTOMER_TYPES), count),
+    }
+
+
+def json_number_strings(values):
+    # One codec call renders the whole column; float formatting is the costliest part of a row
+    return encode(values.tolist()).decode()[1:-1].replace(" ", "").split(",")
+
+
+def serialize_event_block(block):
+    customer_ids = ["cust_%d" % c for c in block["customer"].tolist()]
+    total_amount = block["amount"] + block["vat_amount"] + block["commission_amount"]
+    category_payment = block["merchant_category"] * len(PAYMENT_METHODS) + block["payment_method"]
+    device_status_commission = (
+        ((block["device"] + 1) * 2 + block["declined"]) * len(COMMISSION_TYPES) + block["commission_type"]
+    )
+    risk_index = np.searchsorted(RISK_LEVELS, block["risk_level"])
+    customer_risk_failure = (
+        (block["customer_type"] * len(RISK_LEVELS) + risk_index) * (len(FAILURE_REASONS) + 1)
+        + block["failure_reason"] + 1
+    )
+    rows = zip(
+        block["transaction_id"],
+        block["timestamp"].astype("U26").tolist(),
+        customer_ids,
+        block["merchant"].tolist(),
+        CATEGORY_PAYMENT_JSON[category_payment].tolist(),
+        block["amount"].tolist(),
+        json_number_strings(block["lat"]),
+        json_number_strings(block["lng"]),
+        DEVICE_STATUS_COMMISSION_JSON[device_status_commission].tolist(),
+        block["commission_amount"].tolist(),
+        block["vat_amount"].tolist(),
+        total_amount.tolist(),
+        CUSTOMER_RISK_FAILURE_JSON[customer_risk_failure].tolist(),
+    )
+    return customer_ids, [EVENT_TEMPLATE % row for row in rows]
+
+
+def produce_bulk_historical_events(sink, generator, count, rate=0, block_size=BULK_BLOCK_SIZE,
+                                   sort_timestamps=False, now=None):
+    logging.info(f"Producing {count} historical events in blocks of {block_size}...")
+    now = now or datetime.datetime.utcnow()
     start_time = now - timedelta(days=7)
-    for _ in range(count):
-        event_time = generate_random_datetime(start_time, now)
-        event = generate_transaction_event(timestamp_override=event_time)
-        producer.produce(
-            topic,
-            key=event["customer_id"],
-            value=json.dumps(event),
-            callback=delivery_report,
-        )
-    producer.flush()
-    logging.info("Historical events production completed.")
-
-
-def continuous_event_production(producer, topic, base_rate):
-    while True:
-        current_hour = datetime.datetime.utcnow().hour
-        multiplier = peak_factor if 9 <= current_hour < 18 else 1.0
-        effective_rate = base_rate * multiplier
-        lambda_per_sec = effective_rate / 60.0
-        wait_time = random.expovariate(lambda_per_sec)
-        time.sleep(wait_time)
-        event = generate_transaction_event()
-        producer.produce(
-            topic,
-            key=event["customer_id"],
-            value=json.dumps(event),
-            callback=delivery_report,
-        )
-        producer.poll(0)
+    started = time.perf_counter()
+    produced = 0
+    while produced < count:
+        n = min(block_size, count - produced)
+        if sort_timestamps:
+            # Each block covers its share of the window so the whole stream stays ordered
+            block_start = start_time + (now - start_time) * (produced / count)
+            block_end = start_time + (now - start_time) * ((produced + n) / count)
+        else:
+            block_start, block_end = start_time, now
+        block = generator.event_block(n, block_start, block_end, sort_timestamps)
+        keys, payloads = serialize_event_block(block)
+        sink.write_many(keys, payloads)
+        produced += n
+        if rate:
+            ahead = produced / rate - (time.perf_counter() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    sink.flush()
+    elapsed = time.perf_counter() - started
+    logging.info(f"Historical events production completed: {count} events in {elapsed:.1f}s "
+                 f"({count / elapsed:.0f} events/s, {getattr(sink, 'failures', 0)} delivery failures).")
+
+
+def continuous_event_production(sink, generator, base_rate, peak_factor=2.5, clock=time.monotonic,
+                                sleep=time.sleep, utcnow=datetime.datetime.utcnow, should_stop=lambda: False,
+                                report_interval=PACING_REPORT_INTERVAL):
+    # base_rate is in events per minute, as EVENT_RATE always has been
+    pacer = PoissonPacer(peak_hour_rate(base_rate / 60.0, peak_factor, utcnow), generator.np_rng, clock, sleep)
+    next_report = clock() + report_interval
+    while not should_stop():
+        due = pacer.wait()
+        if due >= BURST_BLOCK_MIN:
+            now = utcnow()
+            keys, payloads = serialize_event_block(generator.event_block(due, now, now))
+            sink.write_many(keys, payloads)
+        elif due:
+            for _ in range(due):
+                event = generator.event(utcnow())
+                sink.write(event["customer_id"], encode(event))
+            sink.poll()
+        if clock() >= next_report:
+            stats = pacer.stats()
+            logging.info(f"Pacing: target {stats['target_rate']:.1f} events/s, achieved {stats['achieved_rate']:.1f} "
+                         f"events/s, lag {stats['lag'] * 1000:.1f} ms, {stats['dropped']} dropped")
+            next_report += report_interval
+        REGISTRY.maybe_log()
+    return pacer.stats()
 
 
 def flush_topic(broker, topic):
@@ -168,41 +334,78 @@ def topic_has_messages(broker, topic):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Darooghe transaction event generator")
+    parser.add_argument("--count", type=int, default=int(os.getenv("HISTORICAL_COUNT", 20000)),
+                        help="historical events to backfill before continuous production")
+    parser.add_argument("--rate", type=float, default=float(os.getenv("HISTORICAL_RATE", 0)),
+                        help="backfill rate in events/s (0 = as fast as possible)")
+    parser.add_argument("--block-size", type=int, default=BULK_BLOCK_SIZE)
+    parser.add_argument("--sorted", action="store_true", help="emit backfill events in timestamp order")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--now", type=datetime.datetime.fromisoformat, default=None,
+                        help="end of the backfill window; with --seed gives byte-identical captures")
+    parser.add_argument("--backfill-only", action="store_true", help="exit after the historical backfill")
+    parser.add_argument("--sink", default=os.getenv("EVENT_SINK", "kafka"),
+                        help="kafka, file:PATH (NDJSON), segments:DIR (gzip segments) or memory[:N]")
+    parser.add_argument("--merchant-locations", default=None,
+                        help="write the merchants' base locations to this JSON file (MERCHANT_LOCATIONS of the consumer)")
+    args = parser.parse_args()
+
     EVENT_RATE = float(os.getenv("EVENT_RATE", 100))
     peak_factor = float(os.getenv("PEAK_FACTOR", 2.5))
-    fraud_rate = float(os.getenv("FRAUD_RATE", 0.02))
-    declined_rate = float(os.getenv("DECLINED_RATE", 0.05))
-    merchant_count = int(os.getenv("MERCHANT_COUNT", 50))
-    merchant_bases = {
-        f"merch_{i}": {
-            "lat": 35.7219 + random.uniform(-0.1, 0.1),
-            "lng": 51.3347 + random.uniform(-0.1, 0.1),
-        }
-        for i in range(1, merchant_count + 1)
-    }
-    customer_count = int(os.getenv("CUSTOMER_COUNT", 1000))
-    kafka_broker = os.getenv("KAFKA_BROKER", "kafka:9092")
+    generator = TransactionGenerator(
+        seed=args.seed,
+        merchant_count=int(os.getenv("MERCHANT_COUNT", 50)),
+        customer_count=int(os.getenv("CUSTOMER_COUNT", 1000)),
+        fraud_rate=float(os.getenv("FRAUD_RATE", 0.02)),
+        declined_rate=float(os.getenv("DECLINED_RATE", 0.05)),
+    )
+    if args.merchant_locations:
+        with open(args.merchant_locations, "w") as f:
+            json.dump(generator.merchant_bases, f)
     topic = "darooghe.transactions"
-    event_init_mode = os.getenv("EVENT_INIT_MODE", "flush").lower()
     skip_initial = False
-    if event_init_mode == "flush":
-        flush_topic(kafka_broker, topic)
-    elif event_init_mode == "skip":
-        if topic_has_messages(kafka_broker, topic):
-            logging.info("Topic has messages; skipping historical events production.")
-            skip_initial = True
-    conf = {"bootstrap.servers": kafka_broker}
-    producer = Producer(conf)
-    
-    for _ in range(5):  # Retry 5 times
+    if args.sink == "kafka":
+        kafka_broker = os.getenv("KAFKA_BROKER", "kafka:9092")
+        event_init_mode = os.getenv("EVENT_INIT_MODE", "flush").lower()
+        if event_init_mode == "flush":
+            flush_topic(kafka_broker, topic)
+        elif event_init_mode == "skip":
+            if topic_has_messages(kafka_broker, topic):
+                logging.info("Topic has messages; skipping historical events production.")
+                skip_initial = True
+        conf = REGISTRY.client_conf({"bootstrap.servers": kafka_broker})
+        producer = Producer(conf)
+
+        for _ in range(5):  # Retry 5 times
+            try:
+                producer.list_topics(timeout=5)  # Test connection
+                break
+            except Exception as e:
+                logging.warning(f"Kafka connection failed: {e}")
+                time.sleep(5)
+
+        backfill_sink = KafkaSink(Producer({**conf, **BULK_PRODUCER_CONF}), topic)
+        sink = KafkaSink(producer, topic, on_delivery=delivery_report)
+    else:
         try:
-            producer.list_topics(timeout=5)  # Test connection
-            break
-        except Exception as e:
-            logging.warning(f"Kafka connection failed: {e}")
-            time.sleep(5)
-        
-    if not skip_initial:
-        produce_historical_events(producer, topic, count=20000)
-    logging.info("Starting continuous event production...")
-    continuous_event_production(producer, topic, base_rate=EVENT_RATE)
+            backfill_sink = sink = open_sink(args.sink)
+        except ValueError as e:
+            parser.error(str(e))
+    REGISTRY.serve()
+
+    try:
+        if not skip_initial:
+            produce_bulk_historical_events(
+                backfill_sink, generator, args.count, rate=args.rate, block_size=args.block_size,
+                sort_timestamps=args.sorted, now=args.now,
+            )
+        if backfill_sink is not sink:
+            # Done with the bulk-tuned producer: deliver anything it still holds before producing live
+            backfill_sink.close()
+        if args.backfill_only:
+            raise SystemExit(0)
+        logging.info("Starting continuous event production...")
+        continuous_event_production(sink, generator, base_rate=EVENT_RATE, peak_factor=peak_factor)
+    finally:
+        sink.close()
@@ -0,0 +1,151 @@
+from collections import OrderedDict
+from hashlib import blake2b
+import math
+import os
+import time
+
+import numpy as np
+
+
+DEDUP_ENABLED = os.getenv('DEDUP', 'on').lower() == 'on'
+DEDUP_CAPACITY = int(os.getenv('DEDUP_CAPACITY', 200000))  # ids per Bloom generation
+DEDUP_FP_RATE = float(os.getenv('DEDUP_FP_RATE', 1e-6))  # per generation
+DEDUP_GENERATIONS = int(os.getenv('DEDUP_GENERATIONS', 24))
+DEDUP_GENERATION_SECONDS = float(os.getenv('DEDUP_GENERATION_SECONDS', 3600))
+DEDUP_EXACT_SECONDS = float(os.getenv('DEDUP_EXACT_SECONDS', 600))
+DEDUP_EXACT_MAX = int(os.getenv('DEDUP_EXACT_MAX', 1000000))
+
+
+def id_hashes(ids):
+    # Two 64-bit halves of a blake2b digest: unlike hash() it is stable across processes and
+    # restarts, so snapshots stay valid
+    digests = b''.join(blake2b(i.encode(), digest_size = 16).digest() for i in ids)
+    return np.frombuffer(digests, dtype = np.uint64).reshape(-1, 2)
+
+
+class BloomFilter:
+    def __init__(self, capacity, fp_rate, started = 0.0):
+        self.bit_count = max(64, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = np.zeros((self.bit_count + 7) // 8, dtype = np.uint8)
+        self.capacity = capacity
+        self.count = 0
+        self.started = started
+
+    def locate(self, hashes):
+        # Double hashing: position i is h1 + i * h2 (mod m); uint64 arithmetic wraps like the C version.
+        # Returns byte offsets and bit masks, which every generation of the same size can share.
+        steps = np.arange(self.hash_count, dtype = np.uint64)
+        positions = (hashes[:, :1] + steps * hashes[:, 1:]) % np.uint64(self.bit_count)
+        masks = np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+        return (positions >> np.uint64(3)).astype(np.intp), masks
+
+    def contains(self, located):
+        offsets, masks = located
+        return (self.bits[offsets] & masks).all(axis = 1)
+
+    def add(self, located):
+        offsets, masks = located
+        np.bitwise_or.at(self.bits, offsets.ravel(), masks.ravel())
+        self.count += len(offsets)
+
+
+class DedupIndex:
+    # Drops transactions whose transaction_id was already admitted. Ids of the last `exact_seconds`
+    # are matched exactly; older ones by a ring of Bloom filters, each covering `generation_seconds`
+    # or `capacity` ids, whichever fills first. Memory is bounded by generations * filter size + exact_max.
+    name = 'dedup'
+    handover = True  # Passed to the partition's next owner on revoke even without checkpoints
+
+    def __init__(self, capacity = DEDUP_CAPACITY, fp_rate = DEDUP_FP_RATE, generations = DEDUP_GENERATIONS,
+                 generation_seconds = DEDUP_GENERATION_SECONDS, exact_seconds = DEDUP_EXACT_SECONDS,
+                 exact_max = DEDUP_EXACT_MAX, clock = time.time):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.generations = generations
+        self.generation_seconds = generation_seconds
+        self.exact_seconds = exact_seconds
+        self.exact_max = exact_max
+        self.clock = clock
+        self.filters = [BloomFilter(capacity, fp_rate, clock())]
+        # First hash half -> admission time, oldest first; OrderedDict pops from the front in O(1)
+        self.exact = OrderedDict()
+        self.duplicates = 0
+
+    def rotate(self, now, incoming = 0):
+        # A generation never takes more than `capacity` ids, which is what its size was computed for
+        current = self.filters[-1]
+        if (current.count and current.count + incoming > self.capacity
+                or now - current.started >= self.generation_seconds):
+            self.filters.append(BloomFilter(self.capacity, self.fp_rate, now))
+            del self.filters[:-self.generations]
+
+    def expire_exact(self, now):
+        exact = self.exact
+        cutoff = now - self.exact_seconds
+        while exact:
+            key, admitted = exact.popitem(last = False)
+            if admitted > cutoff and len(exact) < self.exact_max:
+                exact[key] = admitted
+                exact.move_to_end(key, last = False)
+                break
+
+    def admit(self, transactions):
+        # Returns one flag per transaction: True for first sightings, False for duplicates
+        if not transactions:
+            return []
+        now = self.clock()
+        self.rotate(now, len(transactions))
+        self.expire_exact(now)
+        hashes = id_hashes([t['transaction_id'] for t in transactions])
+        keys = hashes[:, 0].tolist()
+
+        # Exact pass in order, so repeats inside the batch are caught as well
+        exact = self.exact
+        fresh = []
+        for key in keys:
+            if key in exact:
+                fresh.append(False)
+            else:
+                fresh.append(True)
+                exact[key] = now
+        candidates = np.flatnonzero(fresh)
+        if len(candidates):
+            located = self.filters[-1].locate(hashes[candidates])
+            seen = np.zeros(len(candidates), dtype = bool)
+            for bloom in self.filters:
+                seen |= bloom.contains(located)
+            for i in candidates[seen].tolist():
+                fresh[i] = False
+            self.filters[-1].add((located[0][~seen], located[1][~seen]))
+        self.duplicates += len(fresh) - sum(fresh)
+        return fresh
+
+    def process(self, transactions, producer):
+        return 0
+
+    def memory_bytes(self):
+        # Filter bits plus a rough 100 bytes per exact entry (dict slot, int key, float value)
+        return sum(bloom.bits.nbytes for bloom in self.filters) + 100 * len(self.exact)
+
+    def get_state(self):
+        return {
+            "filters": [(bloom.started, bloom.count, bloom.bits) for bloom in self.filters],
+            "exact_keys": np.array(list(self.exact), dtype = np.uint64),
+            "exact_times": np.array(list(self.exact.values()), dtype = np.float64),
+            "duplicates": self.duplicates,
+        }
+
+    def set_state(self, snapshot):
+        self.filters = []
+        for started, count, bits in snapshot["filters"]:
+            bloom = BloomFilter(self.capacity, self.fp_rate, started)
+            if bloom.bits.shape != bits.shape:
+                # Sized with other settings: start over rather than misread the bits
+                self.filters = [BloomFilter(self.capacity, self.fp_rate, self.clock())]
+                break
+            bloom.bits = bits.copy()
+            bloom.count = count
+            self.filters.append(bloom)
+        self.exact = OrderedDict(zip(snapshot["exact_keys"].tolist(), snapshot["exact_times"].tolist()))
+        self.duplicates = snapshot["duplicates"]
@@ -0,0 +1,306 @@
+import heapq
+import logging
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+
+
+ERROR_SPOOL_DIR = os.getenv('ERROR_SPOOL_DIR', '')  # Empty: produce error logs directly and flush before commits
+SPOOL_SEGMENT_MB = int(os.getenv('ERROR_SPOOL_SEGMENT_MB', 64))
+SPOOL_MAX_MB = int(os.getenv('ERROR_SPOOL_MAX_MB', 1024))  # Disk budget; producing waits while it is exceeded
+SPOOL_IN_FLIGHT = int(os.getenv('ERROR_SPOOL_IN_FLIGHT', 10000))  # Spooled messages handed to the producer at once
+RETRY_BACKOFF_MS = float(os.getenv('RETRY_BACKOFF_MS', 100))
+RETRY_BACKOFF_MAX_MS = float(os.getenv('RETRY_BACKOFF_MAX_MS', 30000))
+
+# Segment header: magic, version, offset of the oldest record not yet acknowledged
+HEADER = struct.Struct('<4sIQ')
+MAGIC = b'DLS1'
+# Record header: body length, crc32 of the body, topic length, key length; the body is topic + key + value
+RECORD = struct.Struct('<IIHH')
+
+
+def as_bytes(value):
+    if value is None:
+        return b''
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+class Segment:
+    # One preallocated, memory-mapped file of records. A record's header is written after its body,
+    # so a crash mid-append leaves a zero length (or a bad crc) where the readable records end.
+    def __init__(self, path, size = None):
+        self.path = path
+        self.id = int(os.path.basename(path).split('.')[0].split('-')[1])
+        with open(path, 'w+b' if size is not None else 'r+b') as f:
+            if size is not None:
+                f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.size = len(self.map)
+        self.acked = set()
+        if size is not None:
+            HEADER.pack_into(self.map, 0, MAGIC, 1, HEADER.size)
+            self.watermark = self.end = HEADER.size
+            self.records = 0
+            self.sealed = False
+        else:
+            magic, _, self.watermark = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a spool segment")
+            self.end, self.records = self.scan()
+            self.sealed = True
+
+    def scan(self):
+        offset, records = self.watermark, 0
+        while offset + RECORD.size <= self.size:
+            length, crc, _, _ = RECORD.unpack_from(self.map, offset)
+            body = offset + RECORD.size
+            if not length or body + length > self.size or zlib.crc32(self.map[body:body + length]) != crc:
+                break
+            offset = body + length
+            records += 1
+        return offset, records
+
+    def append(self, topic, key, value):
+        length = len(topic) + len(key) + len(value)
+        offset = self.end
+        body = offset + RECORD.size
+        if body + length > self.size:
+            return None
+        self.map[body:body + len(topic)] = topic
+        self.map[body + len(topic):body + len(topic) + len(key)] = key
+        self.map[body + len(topic) + len(key):body + length] = value
+        crc = zlib.crc32(value, zlib.crc32(key, zlib.crc32(topic)))
+        RECORD.pack_into(self.map, offset, length, crc, len(topic), len(key))
+        self.end = body + length
+        self.records += 1
+        return offset
+
+    def read(self, offset):
+        length, _, topic_length, key_length = RECORD.unpack_from(self.map, offset)
+        body = offset + RECORD.size
+        topic = self.map[body:body + topic_length].decode()
+        key = self.map[body + topic_length:body + topic_length + key_length]
+        value = self.map[body + topic_length + key_length:body + length]
+        return topic, key, value, body + length
+
+    def ack(self, offset):
+        # Acknowledgements arrive out of order; the watermark only moves over a contiguous prefix
+        if offset != self.watermark:
+            self.acked.add(offset)
+            return
+        watermark = self.watermark
+        while True:
+            watermark += RECORD.size + RECORD.unpack_from(self.map, watermark)[0]
+            if watermark not in self.acked:
+                break
+            self.acked.discard(watermark)
+        self.watermark = watermark
+        HEADER.pack_into(self.map, 0, MAGIC, 1, watermark)
+
+    def done(self):
+        return self.sealed and self.watermark >= self.end
+
+    def close(self, delete = False):
+        self.map.flush()
+        self.map.close()
+        if delete:
+            os.remove(self.path)
+
+
+class ErrorSpool:
+    # Append-only queue of messages in memory-mapped segment files. Messages are read back in order
+    # for sending; a segment is deleted once all of its messages are acknowledged. Segments left by a
+    # previous run are resent from their watermark, so delivery is at least once.
+    def __init__(self, directory, segment_bytes = SPOOL_SEGMENT_MB << 20, max_bytes = SPOOL_MAX_MB << 20):
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.segments = {}
+        for name in sorted(os.listdir(directory)):
+            if name.startswith('spool-') and name.endswith('.seg'):
+                try:
+                    segment = Segment(os.path.join(directory, name))
+                except (ValueError, OSError) as e:
+                    logging.error(f"Skipping unreadable spool segment {name}: {e}")
+                    continue
+                if segment.watermark >= segment.end:
+                    segment.close(delete = True)
+                else:
+                    self.segments[segment.id] = segment
+        recovered = sum(s.records for s in self.segments.values())
+        if recovered:
+            logging.info(f"Resending {recovered} spooled messages from {len(self.segments)} segments in {directory}")
+        self.pending = recovered
+        self.active = self.open_segment(max(self.segments, default = 0) + 1, segment_bytes)
+        first = min(self.segments)
+        self.cursor = (first, self.segments[first].watermark)
+
+    def open_segment(self, segment_id, size):
+        segment = Segment(os.path.join(self.directory, f'spool-{segment_id:08d}.seg'), size)
+        self.segments[segment_id] = segment
+        return segment
+
+    def append(self, topic, key, value):
+        topic = topic.encode()
+        with self.lock:
+            offset = self.active.append(topic, key, value)
+            if offset is None:
+                self.active.sealed = True
+                self.active.map.flush()
+                needed = HEADER.size + RECORD.size + len(topic) + len(key) + len(value)
+                self.active = self.open_segment(self.active.id + 1, max(self.segment_bytes, needed))
+                offset = self.active.append(topic, key, value)
+            self.pending += 1
+            return self.active.id, offset
+
+    def next_record(self):
+        # The next message not yet handed out, as (segment id, offset, topic, key, value), or None
+        with self.lock:
+            segment_id, offset = self.cursor
+            segment = self.segments.get(segment_id)
+            while segment is None or offset >= segment.end:
+                if segment is not None and not segment.sealed:
+                    return None
+                later = [i for i in self.segments if i > segment_id]
+                if not later:
+                    return None
+                segment_id = min(later)
+                segment = self.segments[segment_id]
+                offset = segment.watermark
+            topic, key, value, next_offset = segment.read(offset)
+            self.cursor = (segment_id, next_offset)
+            return segment_id, offset, topic, key, value
+
+    def read(self, segment_id, offset):
+        with self.lock:
+            return self.segments[segment_id].read(offset)[:3]
+
+    def ack(self, segment_id, offset):
+        with self.lock:
+            segment = self.segments[segment_id]
+            segment.ack(offset)
+            self.pending -= 1
+            if segment.done():
+                segment.close(delete = True)
+                del self.segments[segment_id]
+
+    def sync(self):
+        # Makes every appended message durable (msync); sealed segments were synced when sealed
+        with self.lock:
+            self.active.map.flush()
+
+    def disk_bytes(self):
+        with self.lock:
+            return sum(segment.size for segment in self.segments.values())
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close(delete = segment.watermark >= segment.end)
+            self.segments = {}
+
+
+class SpooledProducer:
+    # Stands in for the error producer: produce() appends to the spool and returns at once, and a
+    # background thread sends spooled messages, retrying failed deliveries with exponential backoff.
+    # flush() only has to make the spool durable, so offsets can be committed without waiting for
+    # the broker. Memory stays bounded: at most `max_in_flight` messages are handed to the producer
+    # at a time, the rest wait on disk.
+    def __init__(self, producer, directory = ERROR_SPOOL_DIR, on_delivery = None, max_in_flight = SPOOL_IN_FLIGHT,
+                 backoff_ms = RETRY_BACKOFF_MS, backoff_max_ms = RETRY_BACKOFF_MAX_MS,
+                 segment_bytes = SPOOL_SEGMENT_MB << 20, max_bytes = SPOOL_MAX_MB << 20):
+        self.producer = producer
+        self.spool = ErrorSpool(directory, segment_bytes, max_bytes)
+        self.on_delivery = on_delivery
+        self.max_in_flight = max_in_flight
+        self.backoff = backoff_ms / 1000
+        self.backoff_max = backoff_max_ms / 1000
+        self.retries = []  # Heap of (due, segment id, offset, attempt)
+        self.attempts = {}
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.delivered = 0
+        self.failures = 0
+        self.failing = False
+        self.stopping = threading.Event()
+        self.abandon = False
+        self.thread = threading.Thread(target = self.run, name = 'error-spool', daemon = True)
+        self.thread.start()
+
+    def produce(self, topic, value = None, key = None, callback = None, on_delivery = None):
+        # Per-message callbacks are not kept: they could not survive a restart. Successful deliveries
+        # go to the on_delivery given to the constructor.
+        while self.spool.disk_bytes() > self.spool.max_bytes and self.thread.is_alive():
+            logging.warning(f"Error spool is over {self.spool.max_bytes >> 20} MB, waiting for the broker...")
+            time.sleep(1)
+        self.spool.append(topic, as_bytes(key), as_bytes(value))
+
+    def poll(self, timeout = 0):
+        return 0  # Delivery reports are served by the sender thread
+
+    def flush(self, timeout = None):
+        self.spool.sync()
+        return 0
+
+    def __len__(self):
+        return self.spool.pending
+
+    def send(self, segment_id, offset, topic, key, value, attempt):
+        def delivered(err, msg):
+            self.report(segment_id, offset, attempt, err, msg)
+        try:
+            self.producer.produce(topic, key = key or None, value = value, on_delivery = delivered)
+            self.in_flight += 1
+        except BufferError:
+            # The producer's local queue is full: try again shortly, without counting an attempt
+            heapq.heappush(self.retries, (time.monotonic() + self.backoff, segment_id, offset, attempt))
+
+    def report(self, segment_id, offset, attempt, err, msg):
+        # Runs in producer.poll(), which only the sender thread calls
+        self.in_flight -= 1
+        if err is None:
+            self.spool.ack(segment_id, offset)
+            self.delivered += 1
+            if self.failing:
+                logging.info(f"Error log delivery recovered after {self.failures} failed attempts")
+                self.failing = False
+            if self.on_delivery:
+                self.on_delivery(err, msg)
+            return
+        self.failures += 1
+        if not self.failing:
+            logging.error(f"Error log delivery failed, retrying from the spool: {err}")
+            self.failing = True
+        delay = min(self.backoff * 2 ** attempt, self.backoff_max) * random.uniform(0.5, 1.0)
+        due = time.monotonic() + delay
+        heapq.heappush(self.retries, (due, segment_id, offset, attempt + 1))
+        # New messages wait as well, so a failing broker is probed by retries instead of flooded
+        self.resume_at = max(self.resume_at, due)
+
+    def run(self):
+        while not self.stopping.is_set() or (self.spool.pending and not self.abandon):
+            now = time.monotonic()
+            while self.retries and self.retries[0][0] <= now and self.in_flight < self.max_in_flight:
+                _, segment_id, offset, attempt = heapq.heappop(self.retries)
+                self.send(segment_id, offset, *self.spool.read(segment_id, offset), attempt)
+            if now >= self.resume_at:
+                while self.in_flight < self.max_in_flight:
+                    record = self.spool.next_record()
+                    if record is None:
+                        break
+                    self.send(*record, 0)
+            self.producer.poll(0.01 if self.in_flight or self.retries else 0.05)
+
+    def close(self, timeout = 10):
+        # Gives the sender up to `timeout` seconds to drain the spool; whatever is left is sent on restart
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.abandon = True
+        self.thread.join()
+        self.spool.close()
@@ -0,0 +1,95 @@
+import datetime
+import time
+
+import numpy as np
+
+
+def peak_hour_rate(base_rate, peak_factor, utcnow=datetime.datetime.utcnow):
+    # Same semantics as the original loop: base_rate is multiplied by peak_factor between 09:00 and 18:00 UTC
+    def rate():
+        return base_rate * (peak_factor if 9 <= utcnow().hour < 18 else 1.0)
+    return rate
+
+
+class PoissonPacer:
+    # Poisson arrival schedule against an absolute clock. Arrival times are drawn a batch at a time
+    # and everything that is due is released together, so sleep granularity only delays events
+    # (by at most `resolution`) instead of lowering the achieved rate.
+    def __init__(self, rate_fn, rng=None, clock=time.monotonic, sleep=time.sleep, horizon=0.25,
+                 resolution=0.001, max_sleep=0.5, max_lag=5.0, max_burst=10000):
+        self.rate_fn = rate_fn
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.clock = clock
+        self.sleep = sleep
+        self.horizon = horizon
+        self.resolution = resolution
+        self.max_sleep = max_sleep
+        self.max_lag = max_lag
+        self.max_burst = max_burst
+
+        self.started = self.last_now = clock()
+        self.rate = 0.0
+        self.arrivals = np.empty(0)
+        self.position = 0
+        self.next_start = self.started
+        self.emitted = 0
+        self.expected = 0.0
+        self.dropped = 0
+        self.lag = 0.0
+
+    def refill(self):
+        self.rate = float(self.rate_fn())
+        if self.rate <= 0:
+            raise ValueError(f"Event rate must be positive, got {self.rate}")
+        size = min(max(int(self.rate * self.horizon) + 1, 16), 65536)
+        self.arrivals = self.next_start + np.cumsum(self.rng.exponential(1 / self.rate, size))
+        self.next_start = self.arrivals[-1]
+        self.position = 0
+
+    def take_due(self, now):
+        # Number of arrivals scheduled at or before now, capped at max_burst
+        self.expected += self.rate * (now - self.last_now)
+        self.last_now = now
+        due = 0
+        while due < self.max_burst:
+            if self.position == len(self.arrivals):
+                self.refill()
+            if self.arrivals[self.position] > now:
+                break
+            if now - self.arrivals[self.position] > self.max_lag:
+                # Too far behind (paused process, stalled sink): drop the backlog instead of flooding
+                end = int(np.searchsorted(self.arrivals, now - self.max_lag, side="right"))
+                self.dropped += end - self.position
+                self.position = end
+                continue
+            end = min(int(np.searchsorted(self.arrivals, now, side="right")),
+                      self.position + self.max_burst - due)
+            self.lag = now - self.arrivals[self.position]
+            due += end - self.position
+            self.position = end
+        self.emitted += due
+        return due
+
+    def wait(self):
+        # Returns the number of events due now; sleeps first when none are (then may return 0)
+        now = self.clock()
+        due = self.take_due(now)
+        if due:
+            return due
+        self.sleep(self.next_delay(now))
+        return self.take_due(self.clock())
+
+    def next_delay(self, now):
+        # Time until the next arrival, bounded so sleeps stay coarse but responsive
+        return min(max(self.arrivals[self.position] - now, self.resolution), self.max_sleep)
+
+    def stats(self):
+        elapsed = self.last_now - self.started
+        return {
+            "elapsed": elapsed,
+            "emitted": self.emitted,
+            "dropped": self.dropped,
+            "target_rate": self.expected / elapsed if elapsed > 0 else 0.0,
+            "achieved_rate": self.emitted / elapsed if elapsed > 0 else 0.0,
+            "lag": self.lag,
+        }
@@ -0,0 +1,178 @@
+import collections
+import glob
+import gzip
+import logging
+import os
+
+from metrics import REGISTRY
+
+
+DELIVERY_SAMPLE = 64  # Bulk writes time the delivery of every n-th event only
+
+EVENTS = REGISTRY.counter("producer_events_total", "Events handed to the Kafka producer")
+DELIVERY_FAILURES = REGISTRY.counter("producer_delivery_failures_total", "Events the broker did not acknowledge")
+DELIVERY_SECONDS = REGISTRY.histogram("producer_delivery_seconds", "Event delivery latency, produce to acknowledgement")
+
+
+def as_bytes(value):
+    return value if isinstance(value, bytes) else value.encode()
+
+
+class KafkaSink:
+    def __init__(self, producer, topic, on_delivery=None):
+        self.producer = producer
+        self.topic = topic
+        self.on_delivery = on_delivery or self.count_failures
+        self.failures = 0
+
+    def count_failures(self, err, msg):
+        if err is not None:
+            self.failures += 1
+            DELIVERY_FAILURES.inc()
+            logging.error(f"Message delivery failed: {err}")
+
+    def timed_delivery(self, err, msg):
+        if err is None and msg.latency() is not None:
+            DELIVERY_SECONDS.record(msg.latency())
+        self.on_delivery(err, msg)
+
+    def write(self, key, value, on_delivery=None):
+        on_delivery = on_delivery or self.timed_delivery
+        while True:
+            try:
+                self.producer.produce(self.topic, key=key, value=value, on_delivery=on_delivery)
+                break
+            except BufferError:
+                # Local queue is full: serve delivery reports to make room and retry
+                self.producer.poll(0.1)
+        EVENTS.inc()
+
+    def write_many(self, keys, values):
+        for i, (key, value) in enumerate(zip(keys, values)):
+            self.write(key, value, None if i % DELIVERY_SAMPLE == 0 else self.on_delivery)
+        self.producer.poll(0)
+
+    def poll(self):
+        self.producer.poll(0)
+
+    def flush(self):
+        self.producer.flush()
+
+    def close(self):
+        self.flush()
+
+
+class NdjsonFileSink:
+    # Keys are not stored: replay derives them from the events again
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+
+    def write(self, key, value):
+        self.file.write(as_bytes(value) + b"\n")
+
+    def write_many(self, keys, values):
+        if values:
+            self.file.write(b"\n".join(map(as_bytes, values)) + b"\n")
+
+    def poll(self):
+        pass
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class SegmentFileSink(NdjsonFileSink):
+    # Rolls over to a new gzip segment every segment_events events
+    def __init__(self, directory, segment_events=1000000, compresslevel=1):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_events = segment_events
+        self.compresslevel = compresslevel
+        existing = sorted(glob.glob(os.path.join(directory, "segment-*.ndjson.gz")))
+        self.segment = len(existing)
+        self.file = None
+        self.open_segment()
+
+    def open_segment(self):
+        if self.file:
+            self.file.close()
+        self.path = os.path.join(self.directory, f"segment-{self.segment:06d}.ndjson.gz")
+        self.file = gzip.open(self.path, "ab", compresslevel=self.compresslevel)
+        self.segment += 1
+        self.segment_count = 0
+
+    def write(self, key, value):
+        if self.segment_count >= self.segment_events:
+            self.open_segment()
+        super().write(key, value)
+        self.segment_count += 1
+
+    def write_many(self, keys, values):
+        values = list(values)
+        while values:
+            if self.segment_count >= self.segment_events:
+                self.open_segment()
+            room = self.segment_events - self.segment_count
+            super().write_many(None, values[:room])
+            self.segment_count += len(values[:room])
+            values = values[room:]
+
+
+class MemoryRingSink:
+    def __init__(self, capacity=100000):
+        self.events = collections.deque(maxlen=capacity)
+        self.total = 0
+
+    def write(self, key, value):
+        self.events.append((key, value))
+        self.total += 1
+
+    def write_many(self, keys, values):
+        self.events.extend(zip(keys, values))
+        self.total += len(values)
+
+    def poll(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_sink(spec, producer=None, topic="darooghe.transactions", on_delivery=None):
+    # spec is "kafka", "file:PATH", "segments:DIR" or "memory[:CAPACITY]"; a kafka sink writes to the
+    # caller's producer, which also carries the broker address
+    kind, _, target = spec.partition(":")
+    if kind == "kafka":
+        if producer is None or target:
+            raise ValueError(f"Sink '{spec}' needs a Kafka producer: use 'kafka' and set the broker with KAFKA_BROKER")
+        return KafkaSink(producer, topic, on_delivery)
+    if kind == "file":
+        return NdjsonFileSink(target)
+    if kind == "segments":
+        return SegmentFileSink(target)
+    if kind == "memory":
+        return MemoryRingSink(int(target) if target else 100000)
+    raise ValueError(f"Unknown sink '{spec}' (expected kafka, file:PATH, segments:DIR or memory[:N])")
+
+
+def read_events(path):
+    # Yields the raw event lines of an NDJSON file, a .gz segment or a directory of segments
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, "segment-*.ndjson.gz")))
+    else:
+        paths = [path]
+    for p in paths:
+        opener = gzip.open if p.endswith(".gz") else open
+        with opener(p, "rb") as f:
+            for line in f:
+                line = line.rstrip(b"\n")
+                if line:
+                    yield line
+        logging.debug(f"Finished reading {p}")
@@ -0,0 +1,331 @@
+"""In-process stand-ins for confluent_kafka's Consumer and Producer.
+
+Only the calls used by the Darooghe scripts are implemented. The producer
+models the broker round trip so that flush-heavy code paths cost what they
+would against a real cluster.
+"""
+import json
+import random
+import threading
+import time
+import types
+import uuid
+import zlib
+from datetime import datetime, timedelta
+
+
+class FakeMessage:
+    def __init__(self, topic, partition, offset, key, value, error = None, timestamp = None):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._key = key
+        self._value = value
+        self._error = error
+        self._latency = None
+        self._timestamp = timestamp
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def key(self):
+        return self._key
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return self._error
+
+    def latency(self):
+        return self._latency
+
+    def timestamp(self):
+        # (TIMESTAMP_CREATE_TIME, epoch ms) like confluent_kafka, or (TIMESTAMP_NOT_AVAILABLE, -1)
+        return (1, self._timestamp) if self._timestamp is not None else (0, -1)
+
+
+class FakeConsumer:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.position = 0
+        self.committed_offsets = {}
+        self.committed_position = 0
+        self.commit_count = 0
+        self.closed = False
+        self.topics = []
+
+    def subscribe(self, topics, on_assign = None, on_revoke = None):
+        self.topics = topics
+
+    def list_topics(self, topic = None, timeout = -1):
+        return types.SimpleNamespace(topics = {topic: None for topic in self.topics})
+
+    def assign(self, partitions):
+        pass
+
+    def unassign(self):
+        pass
+
+    def exhausted(self):
+        return self.position >= len(self.messages)
+
+    def poll(self, timeout = None):
+        if self.exhausted():
+            return None
+        msg = self.messages[self.position]
+        self.position += 1
+        return msg
+
+    def consume(self, num_messages = 1, timeout = -1):
+        batch = self.messages[self.position:self.position + num_messages]
+        self.position += len(batch)
+        return batch
+
+    def commit(self, message = None, offsets = None, asynchronous = True):
+        self.commit_count += 1
+        for msg in self.messages[self.committed_position:self.position]:
+            self.committed_offsets[(msg.topic(), msg.partition())] = msg.offset() + 1
+        self.committed_position = self.position
+
+    def committed(self, partitions, timeout = None):
+        # OFFSET_INVALID (-1001) like confluent_kafka for partitions without a committed offset
+        return [types.SimpleNamespace(topic = p.topic, partition = p.partition,
+                                      offset = self.committed_offsets.get((p.topic, p.partition), -1001))
+                for p in partitions]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeProducer:
+    def __init__(self, round_trip_ms = 2.0):
+        self.round_trip = round_trip_ms / 1000
+        self.pending = []
+        self.delivered = []
+        self.flush_count = 0
+
+    def produce(self, topic, value = None, key = None, callback = None, on_delivery = None):
+        msg = FakeMessage(topic, 0, len(self.delivered) + len(self.pending), key, value)
+        self.pending.append((time.perf_counter(), msg, callback or on_delivery))
+
+    def _deliver(self, now):
+        ready = 0
+        while ready < len(self.pending) and now - self.pending[ready][0] >= self.round_trip:
+            ready += 1
+        for sent, msg, callback in self.pending[:ready]:
+            msg._latency = now - sent
+            self.delivered.append(msg)
+            if callback:
+                callback(None, msg)
+        del self.pending[:ready]
+        return ready
+
+    def poll(self, timeout = 0):
+        return self._deliver(time.perf_counter())
+
+    def flush(self, timeout = None):
+        self.flush_count += 1
+        if self.pending:
+            # Wait for the newest in-flight message to be acknowledged
+            remaining = self.pending[-1][0] + self.round_trip - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            self._deliver(time.perf_counter())
+        return len(self.pending)
+
+    def __len__(self):
+        return len(self.pending)
+
+
+class FlakyProducer(FakeProducer):
+    # Fails a share of deliveries at random, and every delivery while an outage is on (set_outage)
+    def __init__(self, round_trip_ms = 2.0, failure_rate = 0.0, seed = 0):
+        super().__init__(round_trip_ms)
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.outage_until = 0.0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def set_outage(self, seconds):
+        self.outage_until = time.perf_counter() + seconds
+
+    def produce(self, topic, value = None, key = None, callback = None, on_delivery = None):
+        with self.lock:
+            super().produce(topic, value = value, key = key, callback = callback, on_delivery = on_delivery)
+
+    def _deliver(self, now):
+        with self.lock:
+            ready = 0
+            while ready < len(self.pending) and now - self.pending[ready][0] >= self.round_trip:
+                ready += 1
+            due = self.pending[:ready]
+            del self.pending[:ready]
+        for sent, msg, callback in due:
+            if now < self.outage_until or self.random.random() < self.failure_rate:
+                self.failed += 1
+                if callback:
+                    callback("Broker: Request timed out", msg)
+                continue
+            msg._latency = now - sent
+            self.delivered.append(msg)
+            if callback:
+                callback(None, msg)
+        return len(due)
+
+
+class FakeBroker:
+    # Shared, thread-safe topic log connecting BrokerProducers to BrokerConsumers
+    def __init__(self, partitions = 1):
+        self.partitions = partitions
+        self.topics = {}
+        self.condition = threading.Condition()
+
+    def log(self, topic):
+        if topic not in self.topics:
+            self.topics[topic] = [[] for _ in range(self.partitions)]
+        return self.topics[topic]
+
+    def append(self, topic, key, value):
+        with self.condition:
+            key_bytes = key.encode() if isinstance(key, str) else key or b''
+            partition = zlib.crc32(key_bytes) % self.partitions
+            log = self.log(topic)[partition]
+            msg = FakeMessage(topic, partition, len(log), key, value, timestamp = int(time.time() * 1000))
+            log.append(msg)
+            self.condition.notify_all()
+        return msg
+
+    def size(self, topic):
+        with self.condition:
+            return sum(len(log) for log in self.log(topic))
+
+
+class BrokerProducer(FakeProducer):
+    # Messages are visible to consumers at once; delivery reports still take round_trip_ms
+    def __init__(self, broker, round_trip_ms = 2.0):
+        super().__init__(round_trip_ms)
+        self.broker = broker
+
+    def produce(self, topic, value = None, key = None, callback = None, on_delivery = None):
+        msg = self.broker.append(topic, key, value)
+        self.pending.append((time.perf_counter(), msg, callback or on_delivery))
+
+
+class BrokerConsumer:
+    # Reads every partition of the subscribed topics; fetch_ms and commit_ms model the broker round
+    # trips of a fetch and of a synchronous commit
+    def __init__(self, broker, fetch_ms = 0.0, commit_ms = 0.0):
+        self.broker = broker
+        self.fetch = fetch_ms / 1000
+        self.commit_wait = commit_ms / 1000
+        self.topics = []
+        self.positions = {}
+        self.committed_offsets = {}
+        self.commit_count = 0
+        self.closed = False
+        self.on_revoke = None
+
+    def subscribe(self, topics, on_assign = None, on_revoke = None):
+        self.topics = topics
+        self.on_revoke = on_revoke
+
+    def fetch_available(self, num_messages):
+        batch = []
+        for topic in self.topics:
+            for partition, log in enumerate(self.broker.log(topic)):
+                position = self.positions.get((topic, partition), 0)
+                taken = log[position:position + num_messages - len(batch)]
+                self.positions[(topic, partition)] = position + len(taken)
+                batch.extend(taken)
+        return batch
+
+    def consume(self, num_messages = 1, timeout = -1):
+        if self.fetch:
+            time.sleep(self.fetch)
+        deadline = time.perf_counter() + (timeout if timeout >= 0 else 3600)
+        with self.broker.condition:
+            while True:
+                batch = self.fetch_available(num_messages)
+                remaining = deadline - time.perf_counter()
+                if batch or remaining <= 0:
+                    return batch
+                self.broker.condition.wait(remaining)
+
+    def lag(self):
+        with self.broker.condition:
+            return sum(len(log) - self.positions.get((topic, partition), 0)
+                       for topic in self.topics for partition, log in enumerate(self.broker.log(topic)))
+
+    def commit(self, message = None, offsets = None, asynchronous = True):
+        self.commit_count += 1
+        if not asynchronous and self.commit_wait:
+            time.sleep(self.commit_wait)
+        if offsets is None:
+            self.committed_offsets.update(self.positions)
+        else:
+            for tp in offsets:
+                self.committed_offsets[(tp.topic, tp.partition)] = tp.offset
+
+    def committed(self, partitions, timeout = None):
+        # OFFSET_INVALID (-1001) like confluent_kafka for partitions without a committed offset
+        return [types.SimpleNamespace(topic = p.topic, partition = p.partition,
+                                      offset = self.committed_offsets.get((p.topic, p.partition), -1001))
+                for p in partitions]
+
+    def unassign(self):
+        pass
+
+    def close(self):
+        # Like confluent_kafka, leaving the group revokes every partition first
+        if self.on_revoke and not self.closed:
+            self.on_revoke(self, [types.SimpleNamespace(topic = topic, partition = partition)
+                                  for topic in self.topics for partition in range(self.broker.partitions)])
+        self.closed = True
+
+
+def sample_transaction(index, now, invalid = False):
+    amount = 50000 + index % 1950000
+    vat_amount = int(amount * 0.09)
+    transaction = {
+        "transaction_id": str(uuid.UUID(int = index)),
+        "timestamp": (now - timedelta(minutes = index % 600)).isoformat() + "Z",
+        "customer_id": f"cust_{index % 1000 + 1}",
+        "merchant_id": f"merch_{index % 50 + 1}",
+        "merchant_category": "retail",
+        "payment_method": "mobile",
+        "amount": amount,
+        "location": {"lat": 35.7219, "lng": 51.3347},
+        "device_info": {"os": "Android", "app_version": "2.4.1", "device_model": "Google Pixel 6"},
+        "status": "approved",
+        "commission_type": "flat",
+        "commission_amount": 0,
+        "vat_amount": vat_amount,
+        "total_amount": amount + vat_amount,
+        "customer_type": "individual",
+        "risk_level": 1,
+        "failure_reason": None,
+    }
+    if invalid:
+        transaction["total_amount"] += 1
+    return transaction
+
+
+def transaction_messages(count, invalid_ratio = 0.1, partitions = 1, topic = 'darooghe.transactions',
+                         now = None):
+    now = now or datetime.utcnow()
+    invalid_every = round(1 / invalid_ratio) if invalid_ratio else 0
+    messages = []
+    for i in range(count):
+        invalid = bool(invalid_every) and i % invalid_every == 0
+        transaction = sample_transaction(i, now, invalid)
+        messages.append(FakeMessage(topic, i % partitions, i // partitions, transaction["customer_id"],
+                                    json.dumps(transaction).encode()))
+    return messages
@@ -0,0 +1,308 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime
+import logging
+import math
+import os
+
+import numpy as np
+
+from columnar_validator import parse_timestamps
+from darooghe_codec import encode
+
+
+FRAUD_TOPIC = 'darooghe.fraud_alerts'
+WINDOWS = (60, 300, 3600)  # seconds; every window is a suffix of the 1 h one
+WINDOW_NAMES = ('1m', '5m', '1h')
+EARTH_RADIUS_KM = 6371.0088
+EPOCH = datetime(1970, 1, 1)
+
+FEATURE_TTL = float(os.getenv('FEATURE_TTL', 3600))
+FEATURE_MAX_CUSTOMERS = int(os.getenv('FEATURE_MAX_CUSTOMERS', 2000000))
+VELOCITY_MAX_1M = int(os.getenv('VELOCITY_MAX_1M', 5))
+AMOUNT_MAX_1H = float(os.getenv('AMOUNT_MAX_1H', 20000000))
+MERCHANTS_MAX_5M = int(os.getenv('MERCHANTS_MAX_5M', 4))
+DISTANCE_MAX_KM = float(os.getenv('DISTANCE_MAX_KM', 50))
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def event_seconds(timestamp):
+    # Fallback for timestamps parse_timestamps does not decode; naive times are UTC like everywhere else
+    moment = datetime.fromisoformat(timestamp.replace('Z', ''))
+    if moment.tzinfo is not None:
+        return moment.timestamp()
+    return (moment - EPOCH).total_seconds()
+
+
+class CustomerWindows:
+    # The customer's events of the last hour live in parallel lists addressed by absolute index
+    # (list position + base). Each window keeps a head index and running aggregates, so adding an
+    # event and expiring old ones is O(1) amortized.
+    __slots__ = ('base', 'times', 'amounts', 'merchants', 'distances', 'heads', 'sums', 'distinct',
+                 'last_index', 'max_candidates', 'last_time', 'last_lat', 'last_lng')
+
+    def __init__(self):
+        self.base = 0
+        self.times = []
+        self.amounts = []
+        self.merchants = []
+        self.distances = []
+        self.heads = [0, 0, 0]
+        self.sums = [0, 0, 0]
+        # An event counts towards distinct merchants while it is its merchant's latest event
+        self.distinct = [0, 0, 0]
+        self.last_index = {}
+        # Indices whose distance is larger than every later one: the window max is the first one inside it
+        self.max_candidates = []
+        self.last_time = None
+        self.last_lat = self.last_lng = None
+
+    def add(self, time, amount, merchant, lat = None, lng = None):
+        if lat is None or self.last_lat is None:
+            distance = 0.0
+        else:
+            distance = haversine_km(self.last_lat, self.last_lng, lat, lng)
+        if lat is not None:
+            self.last_lat, self.last_lng = lat, lng
+        self.push(time, amount, merchant, distance)
+
+    def push(self, time, amount, merchant, distance):
+        self.last_time = time
+        index = self.base + len(self.times)
+        self.times.append(time)
+        self.amounts.append(amount)
+        self.merchants.append(merchant)
+        self.distances.append(distance)
+        previous = self.last_index.get(merchant)
+        for w in range(len(WINDOWS)):
+            self.sums[w] += amount
+            if previous is None or previous < self.heads[w]:
+                self.distinct[w] += 1
+        self.last_index[merchant] = index
+        candidates = self.max_candidates
+        while candidates and self.distances[candidates[-1] - self.base] <= distance:
+            candidates.pop()
+        candidates.append(index)
+        self.expire(time)
+
+    def expire(self, now):
+        end = self.base + len(self.times)
+        for w, span in enumerate(WINDOWS):
+            head = self.heads[w]
+            cutoff = now - span
+            while head < end and self.times[head - self.base] <= cutoff:
+                i = head - self.base
+                self.sums[w] -= self.amounts[i]
+                if self.last_index[self.merchants[i]] == head:
+                    self.distinct[w] -= 1
+                    if w == len(WINDOWS) - 1:
+                        del self.last_index[self.merchants[i]]
+                head += 1
+            self.heads[w] = head
+
+        head = self.heads[-1]
+        stale = bisect_left(self.max_candidates, head)
+        if stale:
+            del self.max_candidates[:stale]
+        drop = head - self.base
+        if drop and drop * 2 >= len(self.times):
+            del self.times[:drop], self.amounts[:drop], self.merchants[:drop], self.distances[:drop]
+            self.base = head
+
+    def count(self, w):
+        return self.base + len(self.times) - self.heads[w]
+
+    def max_distance(self, w):
+        k = bisect_left(self.max_candidates, self.heads[w])
+        return self.distances[self.max_candidates[k] - self.base] if k < len(self.max_candidates) else 0.0
+
+    def features(self):
+        features = {'distance_km': round(self.distances[-1], 3) if self.distances else 0.0}
+        for w, name in enumerate(WINDOW_NAMES):
+            features[f'count_{name}'] = self.count(w)
+            features[f'amount_{name}'] = self.sums[w]
+            features[f'merchants_{name}'] = self.distinct[w]
+            features[f'max_distance_km_{name}'] = round(self.max_distance(w), 3)
+        return features
+
+
+class CustomerFeatureStore:
+    name = 'fraud_features'
+
+    def __init__(self, ttl = FEATURE_TTL, max_customers = FEATURE_MAX_CUSTOMERS, velocity_max_1m = VELOCITY_MAX_1M,
+                 amount_max_1h = AMOUNT_MAX_1H, merchants_max_5m = MERCHANTS_MAX_5M,
+                 distance_max_km = DISTANCE_MAX_KM):
+        self.ttl = ttl
+        self.max_customers = max_customers
+        self.velocity_max_1m = velocity_max_1m
+        self.amount_max_1h = amount_max_1h
+        self.merchants_max_5m = merchants_max_5m
+        self.distance_max_km = distance_max_km
+        # Least recently updated customers first
+        self.customers = OrderedDict()
+        self.stream_time = 0.0
+        self.evicted = 0
+        self.late = 0
+
+    def __len__(self):
+        return len(self.customers)
+
+    def update(self, customer_id, time, amount, merchant, lat = None, lng = None):
+        state = self.customers.get(customer_id)
+        if state is None:
+            state = self.customers[customer_id] = CustomerWindows()
+        else:
+            if time < state.last_time:
+                if time <= state.last_time - WINDOWS[-1]:
+                    # Older than anything the windows still hold: nothing to score it against
+                    self.late += 1
+                    return None
+                # Slightly out of order: count it at the customer's latest time
+                time = state.last_time
+            self.customers.move_to_end(customer_id)
+        state.add(time, amount, merchant, lat, lng)
+        if time > self.stream_time:
+            self.stream_time = time
+        return state
+
+    def evict(self):
+        # TTL is measured in event time, so replays and backfills expire state the same way as live traffic
+        cutoff = self.stream_time - self.ttl
+        customers = self.customers
+        while customers:
+            customer_id, state = next(iter(customers.items()))
+            if state.last_time > cutoff and len(customers) <= self.max_customers:
+                break
+            del customers[customer_id]
+            self.evicted += 1
+
+    def get_state(self):
+        # Columnar copy of the windows: each customer's events of the last hour plus its last location.
+        # Heads, sums and distinct counts are rebuilt from the events on restore.
+        customer_ids, counts, times, amounts, merchants, distances = [], [], [], [], [], []
+        last_time, last_lat, last_lng = [], [], []
+        for customer_id, state in self.customers.items():
+            start = state.heads[-1] - state.base
+            customer_ids.append(customer_id)
+            counts.append(len(state.times) - start)
+            times.extend(state.times[start:])
+            amounts.extend(state.amounts[start:])
+            merchants.extend(state.merchants[start:])
+            distances.extend(state.distances[start:])
+            last_time.append(state.last_time)
+            last_lat.append(state.last_lat)
+            last_lng.append(state.last_lng)
+        return {
+            "customer_ids": customer_ids,
+            "counts": np.array(counts, dtype = np.int64),
+            "times": np.array(times, dtype = np.float64),
+            "amounts": amounts,
+            "merchants": merchants,
+            "distances": np.array(distances, dtype = np.float64),
+            "last_time": np.array(last_time, dtype = np.float64),
+            "last_lat": np.array(last_lat, dtype = np.float64),
+            "last_lng": np.array(last_lng, dtype = np.float64),
+            "stream_time": self.stream_time,
+            "evicted": self.evicted,
+            "late": self.late,
+        }
+
+    def set_state(self, snapshot):
+        self.customers = OrderedDict()
+        times, distances = snapshot["times"].tolist(), snapshot["distances"].tolist()
+        amounts, merchants = snapshot["amounts"], snapshot["merchants"]
+        last_time = snapshot["last_time"].tolist()
+        last_lat, last_lng = snapshot["last_lat"].tolist(), snapshot["last_lng"].tolist()
+        end = 0
+        for i, (customer_id, count) in enumerate(zip(snapshot["customer_ids"], snapshot["counts"].tolist())):
+            state = self.customers[customer_id] = CustomerWindows()
+            for j in range(end, end + count):
+                state.push(times[j], amounts[j], merchants[j], distances[j])
+            end += count
+            state.last_time = last_time[i]
+            # NaN marks a customer that never sent a location
+            if last_lat[i] == last_lat[i]:
+                state.last_lat, state.last_lng = last_lat[i], last_lng[i]
+        self.stream_time = snapshot["stream_time"]
+        self.evicted = snapshot["evicted"]
+        self.late = snapshot["late"]
+
+    def check(self, state):
+        flags = []
+        if state.count(0) > self.velocity_max_1m:
+            flags.append({
+                "code" : "FRAUD_VELOCITY",
+                "message" : f'{state.count(0)} transactions in the last minute (limit {self.velocity_max_1m})'
+            })
+        if state.sums[2] > self.amount_max_1h:
+            flags.append({
+                "code" : "FRAUD_AMOUNT",
+                "message" : f'{state.sums[2]} spent in the last hour (limit {self.amount_max_1h:.0f})'
+            })
+        if state.distinct[1] > self.merchants_max_5m:
+            flags.append({
+                "code" : "FRAUD_MERCHANTS",
+                "message" : f'{state.distinct[1]} distinct merchants in the last 5 minutes (limit {self.merchants_max_5m})'
+            })
+        if state.distances[-1] > self.distance_max_km and state.count(2) > 1:
+            flags.append({
+                "code" : "FRAUD_GEO",
+                "message" : f'{state.distances[-1]:.1f} km from the previous transaction (limit {self.distance_max_km:.0f} km)'
+            })
+        return flags
+
+    def score(self, transactions):
+        # Updates the windows with valid transactions and returns (transaction, flags, state) for flagged ones
+        epoch_us, needs_fallback = parse_timestamps([t['timestamp'] for t in transactions])
+        times = (epoch_us / 1e6).tolist()
+        fallback = needs_fallback.tolist()
+        alerts = []
+        for i, transaction in enumerate(transactions):
+            customer_id = transaction.get('customer_id')
+            if customer_id is None:
+                continue
+            time = times[i]
+            if fallback[i]:
+                try:
+                    time = event_seconds(transaction['timestamp'])
+                except (TypeError, ValueError, AttributeError):
+                    continue
+            location = transaction.get('location') or {}
+            state = self.update(customer_id, time, transaction['amount'], transaction.get('merchant_id'),
+                                location.get('lat'), location.get('lng'))
+            if state is None:
+                continue
+            flags = self.check(state)
+            if flags:
+                alerts.append((transaction, flags, state))
+        self.evict()
+        return alerts
+
+    def process(self, transactions, producer):
+        alerts = self.score(transactions)
+        for transaction, flags, state in alerts:
+            publish_alert(producer, transaction, flags, state.features())
+        if alerts:
+            logging.debug(f"{len(alerts)} fraud alerts, {len(self.customers)} customers tracked")
+        return len(alerts)
+
+
+def publish_alert(producer, transaction, flags, features):
+    alert = {
+        "transaction_id": transaction['transaction_id'],
+        "customer_id": transaction['customer_id'],
+        "timestamp": transaction['timestamp'],
+        "flags": flags,
+        "features": features,
+    }
+    while True:
+        try:
+            producer.produce(FRAUD_TOPIC, key = transaction['customer_id'], value = encode(alert))
+            return
+        except BufferError:
+            producer.poll(0.5)
@@ -0,0 +1,262 @@
+from collections import OrderedDict
+import json
+import logging
+import math
+import os
+
+import numpy as np
+
+from fraud_features import EARTH_RADIUS_KM, haversine_km, publish_alert
+from window_aggregates import event_times
+
+
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+GEO_CELL_DEG = float(os.getenv('GEO_CELL_DEG', 0.002))  # About 220 m of latitude
+MERCHANT_RADIUS_KM = float(os.getenv('MERCHANT_RADIUS_KM', 2))
+MERCHANT_MIN_SAMPLES = int(os.getenv('MERCHANT_MIN_SAMPLES', 5))
+TRAVEL_MAX_KMH = float(os.getenv('TRAVEL_MAX_KMH', 900))
+TRAVEL_MIN_KM = float(os.getenv('TRAVEL_MIN_KM', 5))  # Shorter jumps are GPS noise, not travel
+GEO_MAX_CUSTOMERS = int(os.getenv('GEO_MAX_CUSTOMERS', 2000000))
+MERCHANT_LOCATIONS = os.getenv('MERCHANT_LOCATIONS', '')  # Optional JSON file: {merchant_id: {"lat", "lng"}}
+
+
+def haversine_km_array(lat1, lng1, lat2, lng2):
+    # fraud_features.haversine_km over NumPy arrays (or scalars broadcast against them); NaN in, NaN out
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(x, dtype = np.float64)) for x in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GridIndex:
+    # Uniform grid of cell_deg x cell_deg cells, each holding the keys located in it. Nearby and
+    # nearest lookups only visit the rings of cells around the query point, so their cost depends on
+    # the local density, not on the number of points indexed.
+    def __init__(self, cell_deg = GEO_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.cells = {}
+        self.points = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def cell(self, lat, lng):
+        return math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg)
+
+    def insert(self, key, lat, lng):
+        previous = self.points.get(key)
+        cell = self.cell(lat, lng)
+        if previous is not None:
+            old_cell = self.cell(*previous)
+            if old_cell == cell:
+                self.points[key] = (lat, lng)
+                return
+            members = self.cells[old_cell]
+            members.discard(key)
+            if not members:
+                del self.cells[old_cell]
+        self.points[key] = (lat, lng)
+        self.cells.setdefault(cell, set()).add(key)
+
+    def ring(self, row, col, radius):
+        # Cells at Chebyshev distance `radius` from (row, col)
+        if radius == 0:
+            yield row, col
+            return
+        for c in range(col - radius, col + radius + 1):
+            yield row - radius, c
+            yield row + radius, c
+        for r in range(row - radius + 1, row + radius):
+            yield r, col - radius
+            yield r, col + radius
+
+    def ring_km(self, lat, radius):
+        # Lower bound of the distance from a point in the centre cell to anything beyond ring `radius`;
+        # longitude cells are narrowest on the side closer to the pole
+        edge = min(abs(lat) + (radius + 1) * self.cell_deg, 89.9)
+        return radius * self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(edge))
+
+    def cells_around(self, lat, lng, radius_km):
+        # Occupied cells that can hold points within radius_km, ring by ring (closest rings first).
+        # Yields (cells of the ring, lower bound of the distance to anything beyond it).
+        row, col = self.cell(lat, lng)
+        radius = 0
+        while True:
+            if (2 * radius + 1) ** 2 > len(self.cells):
+                # Sparse grid: cheaper to walk the occupied cells than the empty rings
+                cos_edge = max(math.cos(math.radians(min(abs(lat) + radius_km / KM_PER_DEGREE + self.cell_deg, 89.9))), 1e-3)
+                reach = math.ceil(radius_km / (self.cell_deg * KM_PER_DEGREE * cos_edge)) + 1
+                yield [cell for cell in self.cells
+                       if radius <= max(abs(cell[0] - row), abs(cell[1] - col)) <= reach], math.inf
+                return
+            yield self.ring(row, col, radius), self.ring_km(lat, radius)
+            radius += 1
+
+    def nearby(self, lat, lng, radius_km):
+        # (distance, key) of every indexed point within radius_km, closest first
+        found = []
+        for cells, beyond_km in self.cells_around(lat, lng, radius_km):
+            for cell in cells:
+                for key in self.cells.get(cell, ()):
+                    distance = haversine_km(lat, lng, *self.points[key])
+                    if distance <= radius_km:
+                        found.append((distance, key))
+            if beyond_km > radius_km:
+                break
+        return sorted(found)
+
+    def nearest(self, lat, lng, max_km = 50):
+        # (distance, key) of the closest indexed point within max_km, or None
+        best = None
+        for cells, beyond_km in self.cells_around(lat, lng, max_km):
+            for cell in cells:
+                for key in self.cells.get(cell, ()):
+                    distance = haversine_km(lat, lng, *self.points[key])
+                    if distance <= max_km and (best is None or distance < best[0]):
+                        best = (distance, key)
+            if beyond_km > (best[0] if best else max_km):
+                break
+        return best
+
+
+class MerchantLocations:
+    # Expected location of every merchant: the running centroid of its transaction locations.
+    # Locations further than radius_km from a trusted centroid are not folded into it.
+    def __init__(self, radius_km = MERCHANT_RADIUS_KM, min_samples = MERCHANT_MIN_SAMPLES, cell_deg = GEO_CELL_DEG):
+        self.radius_km = radius_km
+        self.min_samples = min_samples
+        self.sums = {}  # merchant -> [lat sum, lng sum, samples]
+        self.grid = GridIndex(cell_deg)
+
+    def __len__(self):
+        return len(self.sums)
+
+    def expected(self, merchant):
+        # (lat, lng) once the merchant has min_samples locations, else None
+        sums = self.sums.get(merchant)
+        if sums is None or sums[2] < self.min_samples:
+            return None
+        return sums[0] / sums[2], sums[1] / sums[2]
+
+    def load(self, locations):
+        # Known base locations, e.g. {merchant: {"lat": ..., "lng": ...}}, trusted from the start
+        for merchant, location in locations.items():
+            self.sums[merchant] = [location['lat'] * self.min_samples, location['lng'] * self.min_samples,
+                                   self.min_samples]
+            self.grid.insert(merchant, location['lat'], location['lng'])
+
+    def observe(self, merchant, lat, lng, distance):
+        sums = self.sums.get(merchant)
+        if sums is None:
+            sums = self.sums[merchant] = [0.0, 0.0, 0]
+        elif sums[2] >= self.min_samples and not distance <= self.radius_km:
+            return
+        sums[0] += lat
+        sums[1] += lng
+        sums[2] += 1
+        self.grid.insert(merchant, sums[0] / sums[2], sums[1] / sums[2])
+
+
+class GeoChecks:
+    # Flags transactions made far from their merchant's expected location, and customers whose
+    # consecutive transactions imply an impossible travel speed. Both are O(1) per event: a merchant
+    # lookup and the customer's last position, with the distances computed for the whole batch at once.
+    name = 'geo'
+
+    def __init__(self, radius_km = MERCHANT_RADIUS_KM, min_samples = MERCHANT_MIN_SAMPLES,
+                 max_speed_kmh = TRAVEL_MAX_KMH, min_travel_km = TRAVEL_MIN_KM, max_customers = GEO_MAX_CUSTOMERS,
+                 cell_deg = GEO_CELL_DEG, merchant_locations = MERCHANT_LOCATIONS):
+        self.merchants = MerchantLocations(radius_km, min_samples, cell_deg)
+        if merchant_locations:
+            with open(merchant_locations) as f:
+                self.merchants.load(json.load(f))
+        self.max_speed_kmh = max_speed_kmh
+        self.min_travel_km = min_travel_km
+        self.max_customers = max_customers
+        # customer -> (time, lat, lng), least recently seen first
+        self.customers = OrderedDict()
+
+    def score(self, transactions, times):
+        # times: event seconds per transaction (None when unreadable). Returns (transaction, flags, features).
+        nan = math.nan
+        columns = [[nan] * len(transactions) for _ in range(7)]
+        lat, lng, base_lat, base_lng, prev_lat, prev_lng, elapsed = columns
+        customers = self.customers
+        for i, transaction in enumerate(transactions):
+            location = transaction.get('location') or {}
+            if location.get('lat') is None or location.get('lng') is None or times[i] is None:
+                continue
+            lat[i], lng[i] = location['lat'], location['lng']
+            expected = self.merchants.expected(transaction.get('merchant_id'))
+            if expected is not None:
+                base_lat[i], base_lng[i] = expected
+            customer = transaction.get('customer_id')
+            previous = customers.get(customer)
+            if previous is not None:
+                elapsed[i] = times[i] - previous[0]
+                prev_lat[i], prev_lng[i] = previous[1], previous[2]
+                customers.move_to_end(customer)
+            customers[customer] = (times[i], lat[i], lng[i])
+        while len(customers) > self.max_customers:
+            customers.popitem(last = False)
+        lat, lng, base_lat, base_lng, prev_lat, prev_lng, elapsed = (np.array(c, dtype = np.float64) for c in columns)
+
+        merchant_km = haversine_km_array(lat, lng, base_lat, base_lng)
+        travel_km = haversine_km_array(prev_lat, prev_lng, lat, lng)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            # Out-of-order events (negative elapsed) are judged on the absolute gap
+            speed_kmh = travel_km / (np.abs(elapsed) / 3600)
+        far = merchant_km > self.merchants.radius_km
+        impossible = (travel_km > self.min_travel_km) & (speed_kmh > self.max_speed_kmh)
+
+        located = np.flatnonzero(np.isfinite(lat))
+        for i, event_lat, event_lng, distance in zip(located.tolist(), lat[located].tolist(), lng[located].tolist(),
+                                                     merchant_km[located].tolist()):
+            self.merchants.observe(transactions[i].get('merchant_id'), event_lat, event_lng, distance)
+
+        alerts = []
+        for i in np.flatnonzero(far | impossible).tolist():
+            flags = []
+            if far[i]:
+                flags.append({
+                    "code" : "FRAUD_MERCHANT_LOCATION",
+                    "message" : f'{merchant_km[i]:.1f} km from the merchant\'s usual location (limit {self.merchants.radius_km:.0f} km)'
+                })
+            if impossible[i]:
+                flags.append({
+                    "code" : "FRAUD_TRAVEL_SPEED",
+                    "message" : f'{travel_km[i]:.1f} km from the previous transaction in {abs(elapsed[i]):.0f}s (limit {self.max_speed_kmh:.0f} km/h)'
+                })
+            # Which known merchant the transaction was actually made at, if any
+            nearest = self.merchants.grid.nearest(lat[i], lng[i], self.merchants.radius_km)
+            alerts.append((transactions[i], flags, {
+                "merchant_distance_km": round(float(merchant_km[i]), 3) if np.isfinite(merchant_km[i]) else None,
+                "travel_km": round(float(travel_km[i]), 3) if np.isfinite(travel_km[i]) else None,
+                "speed_kmh": round(float(speed_kmh[i]), 1) if np.isfinite(speed_kmh[i]) else None,
+                "nearest_merchant": nearest[1] if nearest else None,
+            }))
+        return alerts
+
+    def process(self, transactions, producer):
+        alerts = self.score(transactions, event_times(transactions))
+        for transaction, flags, features in alerts:
+            publish_alert(producer, transaction, flags, features)
+        if alerts:
+            logging.debug(f"{len(alerts)} geo alerts, {len(self.merchants)} merchants located")
+        return len(alerts)
+
+    def get_state(self):
+        merchants = list(self.merchants.sums)
+        sums = np.array(list(self.merchants.sums.values()), dtype = np.float64).reshape(-1, 3)
+        customers = list(self.customers)
+        last = np.array(list(self.customers.values()), dtype = np.float64).reshape(-1, 3)
+        return {"merchants": merchants, "merchant_sums": sums, "customers": customers, "customer_last": last}
+
+    def set_state(self, snapshot):
+        self.merchants.sums = {}
+        self.merchants.grid = GridIndex(self.merchants.grid.cell_deg)
+        for merchant, (lat_sum, lng_sum, samples) in zip(snapshot["merchants"], snapshot["merchant_sums"].tolist()):
+            self.merchants.sums[merchant] = [lat_sum, lng_sum, int(samples)]
+            self.merchants.grid.insert(merchant, lat_sum / samples, lng_sum / samples)
+        self.customers = OrderedDict(
+            (customer, tuple(last)) for customer, last in zip(snapshot["customers"], snapshot["customer_last"].tolist()))
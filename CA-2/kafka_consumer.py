@@ -1,14 +1,40 @@
 from confluent_kafka import Producer, Consumer, TopicPartition
 import json
 import logging
-from datetime import datetime, timedelta
+import os
+from datetime import datetime
 import time
 
+from columnar_validator import validate_batch
+from darooghe_codec import decode_transaction, encode
+from dedup_index import DEDUP_ENABLED, DedupIndex
+from error_spool import ERROR_SPOOL_DIR, SpooledProducer
+from fraud_features import CustomerFeatureStore, event_seconds
+from geo_index import GeoChecks
+from metrics import REGISTRY
+from parquet_archive import ARCHIVE_DIR, ParquetArchive
+from rule_engine import VALIDATION_RULES, RuleFile
+from state_checkpoint import PartitionStates
+from transaction_validation import validate_transaction
+from window_aggregates import WindowAggregator
+
 
 logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(levelname)s %(message)s")
 
+KAFKA_BROKER = os.getenv('KAFKA_BROKER', 'kafka:9092')
+TRANSACTIONS_TOPIC = 'darooghe.transactions'
+ERROR_TOPIC = 'darooghe.error_logs'
+
+CONSUMER_MODE = os.getenv('CONSUMER_MODE', 'batch').lower()  # Options: batch, single
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', 500))
+BATCH_LINGER_MS = int(os.getenv('BATCH_LINGER_MS', 100))
+FLUSH_TIMEOUT = float(os.getenv('FLUSH_TIMEOUT', 10))
+FRAUD_FEATURES = os.getenv('FRAUD_FEATURES', 'on').lower() == 'on'
+WINDOW_AGGREGATES = os.getenv('WINDOW_AGGREGATES', 'on').lower() == 'on'
+GEO_CHECKS = os.getenv('GEO_CHECKS', 'off').lower() == 'on'
+
 conf = {
-    'bootstrap.servers': 'kafka:9092', 
+    'bootstrap.servers': KAFKA_BROKER,
     'group.id': 'transaction_consumer-group',
     'auto.offset.reset': 'earliest',
     # 'api.version.request': False, # depricated
@@ -16,132 +42,298 @@ conf = {
     'security.protocol': 'PLAINTEXT',
 }
 
-consumer = Consumer(conf)
-consumer.subscribe(['darooghe.transactions'])
+# In batch mode offsets are committed by hand once the batch's error logs are delivered
+batch_conf = {**conf, 'enable.auto.commit': False}
+
+# Compiled rules from VALIDATION_RULES replace the hand-written checks and are reloaded when the file changes
+RULES = RuleFile(VALIDATION_RULES) if VALIDATION_RULES else None
+
+METRICS_E2E_SAMPLE = max(int(os.getenv('METRICS_E2E_SAMPLE', 16)), 1)  # End-to-end latency from every n-th transaction
+
+MESSAGES = REGISTRY.counter('consumer_messages_total', 'Transactions consumed')
+INVALID = REGISTRY.counter('consumer_invalid_total', 'Invalid transactions by error code', ('code',))
+DECODE_SECONDS = REGISTRY.histogram('consumer_decode_seconds', 'Time to decode a batch')
+VALIDATE_SECONDS = REGISTRY.histogram('consumer_validate_seconds', 'Time to validate a batch and queue its error logs')
+STAGE_SECONDS = REGISTRY.histogram('consumer_stage_seconds', 'Time a stage spends on one partition of a batch', ('stage',))
+COMMIT_SECONDS = REGISTRY.histogram('consumer_commit_seconds', 'Time to drain error logs and commit a batch')
+PRODUCE_SECONDS = REGISTRY.histogram('consumer_produce_seconds', 'Error log delivery latency, produce to acknowledgement')
+END_TO_END_SECONDS = REGISTRY.histogram('consumer_end_to_end_seconds', 'Event timestamp to end of processing, sampled')
+
+# What the validators raise on a field of the wrong type, e.g. amount "100" or device_info null
+MALFORMED = (KeyError, TypeError, ValueError, AttributeError)
+
 
+def wait_for_topic(consumer, topic = TRANSACTIONS_TOPIC):
+    for _ in range(10):  # Wait up to 50 seconds
+        topics = consumer.list_topics().topics
+        if topic in topics:
+            break
+        logging.info("Waiting for topic...")
+        time.sleep(5)
 
-    
-err_producer = Producer({'bootstrap.servers': 'kafka:9092'})
 
-for _ in range(10):  # Wait up to 50 seconds
-    topics = consumer.list_topics().topics
-    if 'darooghe.transactions' in topics:
-        break
-    logging.info("Waiting for topic...")
-    time.sleep(5)
-    
-    
 def delivery_report(err, msg):
     if err:
         logging.error(f"Message delivery failed: {err}")
-    else:   
+    else:
+        latency = msg.latency()
+        if latency is not None:
+            PRODUCE_SECONDS.record(latency)
         logging.debug(f"Error logged to {msg.topic()} [Partition: {msg.partition()}]")
-        
-def validate_amount(transaction):
-    total_amount_expected = transaction['amount'] + transaction['vat_amount']
-    + transaction['commission_amount']
-    
-    return total_amount_expected, transaction['total_amount'] == total_amount_expected
 
 
-def validate_time(transaction, errors):
-    try:
-        transaction_time = datetime.fromisoformat(transaction['timestamp'].replace('Z',
-            ''))
-    
-        current_time = datetime.utcnow()
-        time_diff = current_time - transaction_time
-
-        if transaction_time > current_time:
-            errors.append({
-                "code" : "ERR_TIME",
-                "message" : f'Transaction time is in the future. Transaction time: {transaction_time}, Current time: {current_time}'
-            })
-
-        elif time_diff > timedelta(days = 1):
-            errors.append({
-                "code" : "ERR_TIME",
-                "message" : f'Transaction time is older than 24 hours. Transaction time: {transaction_time}, Current time: {current_time}'
-            })
-    except Exception as e:
-        errors.append({
-            "code" : "ERR_TIME",
-            "message" : f'Invalid timestamp format: {e}'
-        })
-    
-def validate_device(transaction):
-    if transaction['payment_method'] == 'mobile':
-        if 'device_info' not in transaction or transaction['device_info'].get('os') not in ['iOS', 'Android']:
-            return False
-    return True
-
-
-def validate_transaction(transaction):
-    errors = []
-    
-    total_amount_expected, is_amount_validated = validate_amount(transaction)
-    
-    if not is_amount_validated:
-        errors.append({
-            "code" : "ERR_AMOUNT",
-            "message" : f'Total amount mismatch. Expected {total_amount_expected}, got {transaction["total_amount"]}'
-        }
-        )
-        
-    validate_time(transaction, errors)    
-    
-    is_device_valid = validate_device(transaction)
-    if not is_device_valid:
-        errors.append({
-            "code" : "ERR_DEVICE",
-            "message" : f'Invalid device information for payment method {transaction["payment_method"]}'
-        })
-    return errors
-
-   
-def process_transaction(msg):
+def publish_errors(producer, transaction, errors):
+    error_message = {
+        "transaction_id": transaction['transaction_id'],
+        "errors": errors,
+        "original_data": transaction
+    }
+    while True:
+        try:
+            producer.produce(
+                ERROR_TOPIC,
+                key=str(transaction['transaction_id']),
+                value=encode(error_message),
+                callback=delivery_report
+            )
+            return
+        except BufferError:
+            # Local queue is full: serve delivery reports to make room and retry
+            producer.poll(0.5)
+
+
+def process_transaction(msg, producer):
     try:
-        transaction = json.loads(msg.value())
+        transaction = decode_transaction(msg.value())
         logging.debug(f"Processing transaction: {transaction['transaction_id']}")
-        
-       
-        errors = validate_transaction(transaction)
-        
+
+
+        try:
+            errors = RULES.validate(transaction) if RULES else validate_transaction(transaction)
+        except MALFORMED as e:
+            errors = malformed_errors(e)
+
         if errors:
-            
-            error_message = {
-                "transaction_id": transaction['transaction_id'],
-                "errors": errors,
-                "original_data": transaction
-            }
-            err_producer.produce(
-                'darooghe.error_logs',
-                key=transaction['transaction_id'],
-                value=json.dumps(error_message),
-                callback=delivery_report
-            )
-            err_producer.flush()
+            publish_errors(producer, transaction, errors)
+            producer.flush()
             #logging.warning(f"Invalid transaction detected: {transaction['transaction_id']}")
         else:
             logging.debug(f"Valid transaction: {transaction['transaction_id']}")
-    
+
     except json.JSONDecodeError:
         logging.error("Failed to decode message")
     except KeyError as e:
         logging.error(f"Missing field in transaction: {e}")
 
 
-try:
-    while True:
-        msg = consumer.poll(1.0)  
+def build_stages():
+    # Stateful stages run after validation on the batch's valid transactions; stages with an
+    # admit() method also filter the batch before validation
+    stages = []
+    if DEDUP_ENABLED:
+        stages.append(DedupIndex())
+    if FRAUD_FEATURES:
+        stages.append(CustomerFeatureStore())
+    if GEO_CHECKS:
+        stages.append(GeoChecks())
+    if WINDOW_AGGREGATES:
+        stages.append(WindowAggregator())
+    if ARCHIVE_DIR:
+        stages.append(ParquetArchive())
+    return stages
+
+
+def record_end_to_end(transactions):
+    now = time.time()
+    for transaction in transactions[::METRICS_E2E_SAMPLE]:
+        try:
+            END_TO_END_SECONDS.record(now - event_seconds(transaction['timestamp']))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            pass  # Already reported as ERR_TIME by validation
+
+
+def malformed_errors(error):
+    return [{
+        "code" : "ERR_TYPE",
+        "message" : f'Malformed transaction field: {error!r}'
+    }]
+
+
+def validate_records(transactions, current_time):
+    # {batch index: errors} for the whole batch. A record with a field of the wrong type makes the
+    # batch validators raise; the batch is then validated record by record and that record is
+    # reported as ERR_TYPE, so one bad message never stops the consumer.
+    try:
+        if RULES:
+            return RULES.validate_batch(transactions, current_time)
+        return validate_batch(transactions, current_time)
+    except MALFORMED:
+        pass
+    batch_errors = {}
+    for i, transaction in enumerate(transactions):
+        try:
+            if RULES:
+                errors = RULES.validate(transaction, current_time)
+            else:
+                errors = validate_transaction(transaction, current_time)
+        except MALFORMED as e:
+            errors = malformed_errors(e)
+        if errors:
+            batch_errors[i] = errors
+    return batch_errors
+
+
+class DiscardProducer:
+    # Stands in for the producer while replaying messages whose outputs were already delivered
+    def produce(self, topic, value = None, key = None, callback = None, on_delivery = None):
+        pass
+
+    def poll(self, timeout = 0):
+        return 0
+
+    def flush(self, timeout = None):
+        return 0
+
+
+def process_batch(msgs, producer, state = None):
+    if state is not None:
+        replayed, msgs = state.split_replayed(msgs)
+        if replayed:
+            # Messages between a restored snapshot and the committed offset only rebuild the state
+            process_messages(replayed, DiscardProducer(), state)
+    return process_messages(msgs, producer, state)
+
+
+def process_messages(msgs, producer, state = None):
+    current_time = datetime.utcnow()
+    started = time.perf_counter()
+    transactions = []
+    sources = []
+    for msg in msgs:
+        if msg.error():
+            logging.error(f"Consumer error: {msg.error()}")
+            continue
+        if state is not None:
+            state.record(msg.topic(), msg.partition(), msg.offset())
+        try:
+            transactions.append(decode_transaction(msg.value()))
+            sources.append((msg.topic(), msg.partition()))
+        except json.JSONDecodeError:
+            logging.error("Failed to decode message")
+        except KeyError as e:
+            logging.error(f"Missing field in transaction: {e}")
+
+    if state is not None:
+        # Redelivered transactions (rebalances, producer retries) are dropped before validation
+        transactions, sources = state.admit(transactions, sources)
+    decoded = time.perf_counter()
+    DECODE_SECONDS.record(decoded - started)
+    MESSAGES.inc(len(transactions))
+
+    if RULES:
+        RULES.maybe_reload()
+    batch_errors = validate_records(transactions, current_time)
+
+    invalid_count = 0
+    valid = {}
+    rejected = {}
+    for i, transaction in enumerate(transactions):
+        errors = batch_errors.get(i)
+        if errors:
+            publish_errors(producer, transaction, errors)
+            invalid_count += 1
+            for error in errors:
+                INVALID.labels(error['code']).inc()
+            if state is not None:
+                state.get(*sources[i]).counters['invalid'] += 1
+                rejected_transactions, rejected_errors = rejected.setdefault(sources[i], ([], []))
+                rejected_transactions.append(transaction)
+                rejected_errors.append(errors)
+        else:
+            valid.setdefault(sources[i], []).append(transaction)
+        # Serve delivery callbacks without blocking on the broker
+        producer.poll(0)
+    VALIDATE_SECONDS.record(time.perf_counter() - decoded)
+    if state is not None:
+        for (topic, partition), batch in valid.items():
+            for stage in state.get(topic, partition).stages:
+                stage_started = time.perf_counter()
+                stage.process(batch, producer)
+                STAGE_SECONDS.labels(stage.name).record(time.perf_counter() - stage_started)
+        # Stages with a reject() method also see the invalid transactions with their errors
+        for (topic, partition), (batch, errors) in rejected.items():
+            for stage in state.get(topic, partition).stages:
+                if hasattr(stage, 'reject'):
+                    stage.reject(batch, errors)
+    if REGISTRY.enabled:
+        record_end_to_end(transactions)
+    return invalid_count
+
+
+def commit_batch(consumer, producer):
+    # Offsets are only committed once every error log of the batch is acknowledged
+    started = time.perf_counter()
+    while producer.flush(FLUSH_TIMEOUT) > 0:
+        logging.warning("Error log delivery still pending, waiting before commit...")
+    consumer.commit(asynchronous = False)
+    COMMIT_SECONDS.record(time.perf_counter() - started)
+
+
+def run_single_consumer(consumer, producer, should_stop = lambda: False):
+    while not should_stop():
+        msg = consumer.poll(1.0)
         if msg is None:
             continue
         if msg.error():
             logging.error(f"Consumer error: {msg.error()}")
         else:
-            process_transaction(msg)
-except KeyboardInterrupt:
-    logging.info("Shutting down consumer...")
-finally:
-    consumer.close()   
-        
\ No newline at end of file
+            process_transaction(msg, producer)
+
+
+def run_batch_consumer(consumer, producer, batch_size = BATCH_SIZE, linger_ms = BATCH_LINGER_MS,
+                       should_stop = lambda: False, on_batch = None, state = None):
+    while not should_stop():
+        msgs = consumer.consume(num_messages = batch_size, timeout = linger_ms / 1000)
+        if not msgs:
+            continue
+        started = time.perf_counter()
+        invalid_count = process_batch(msgs, producer, state)
+        commit_batch(consumer, producer)
+        if state is not None:
+            state.committed()
+            state.maybe_checkpoint()
+        REGISTRY.maybe_log()
+        logging.debug(f"Batch of {len(msgs)} messages committed, {invalid_count} invalid")
+        if on_batch:
+            on_batch(len(msgs), invalid_count, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    batch_mode = CONSUMER_MODE == 'batch'
+    REGISTRY.serve()
+    consumer = Consumer(REGISTRY.client_conf(batch_conf if batch_mode else conf))
+    state = PartitionStates(build_stages)
+    if batch_mode:
+        consumer.subscribe([TRANSACTIONS_TOPIC], on_assign = state.on_assign, on_revoke = state.on_revoke)
+    else:
+        consumer.subscribe([TRANSACTIONS_TOPIC])
+    err_producer = Producer(REGISTRY.client_conf({'bootstrap.servers': KAFKA_BROKER}))
+    if ERROR_SPOOL_DIR:
+        # Error logs go through a local spool: commits wait for the spool, not for the broker
+        err_producer = SpooledProducer(err_producer, ERROR_SPOOL_DIR, on_delivery = delivery_report)
+    wait_for_topic(consumer)
+
+    try:
+        if batch_mode:
+            logging.info(f"Consuming in batch mode (size {BATCH_SIZE}, linger {BATCH_LINGER_MS}ms)")
+            run_batch_consumer(consumer, err_producer, state = state)
+        else:
+            run_single_consumer(consumer, err_producer)
+    except KeyboardInterrupt:
+        logging.info("Shutting down consumer...")
+    finally:
+        err_producer.flush()
+        if ERROR_SPOOL_DIR:
+            err_producer.close(FLUSH_TIMEOUT)
+        state.close()
+        consumer.close()
@@ -0,0 +1,331 @@
+"""Load-test the Darooghe producer, consumer and the two together.
+
+Every combination of the swept parameters runs in its own process, so CPU time
+and peak RSS belong to that run alone. Components:
+
+    producer  darooghe_pulse's generator writing through KafkaSink; latency is the
+              delivery latency (produce to acknowledgement)
+    consumer  kafka_consumer's batch loop over a preloaded topic, error logs included;
+              latency is the time to process and commit one batch
+    pipeline  both at once: a producer thread paced at --rates feeds the consumer;
+              latency is end to end, from the broker's append timestamp to the commit
+
+By default everything runs against fake_kafka's in-process broker (with simulated
+round trips); --broker HOST:PORT uses a real Kafka cluster instead, creating a
+topic per run. Results are written as JSON; --compare checks them against an
+earlier results file and exits with status 1 on a regression.
+
+    python load_test.py --components consumer pipeline --batch-sizes 100 500 --partitions 1 4 \\
+        --output results.json
+    python load_test.py --output new.json --compare results.json --tolerance 0.1
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+import kafka_consumer
+from darooghe_pulse import TransactionGenerator, serialize_event_block
+from event_pacer import PoissonPacer
+from event_sinks import KafkaSink
+from fake_kafka import BrokerConsumer, BrokerProducer, FakeBroker
+from metrics import Histogram
+from state_checkpoint import PartitionStates
+
+COMPONENTS = ('producer', 'consumer', 'pipeline')
+# Parameters that identify a run when results are compared
+KEY_FIELDS = ('component', 'rate', 'batch_size', 'partitions', 'invalid_ratio', 'events', 'broker')
+BLOCK_SIZE = 1000
+
+
+class Cluster:
+    # The fake broker, or a real one reached through confluent_kafka with a topic of its own
+    def __init__(self, config):
+        self.config = config
+        self.topic = f"loadtest.{uuid.uuid4().hex[:8]}"
+        self.broker = config['broker']
+        if self.broker:
+            from confluent_kafka.admin import AdminClient, NewTopic
+            self.admin = AdminClient({'bootstrap.servers': self.broker})
+            futures = self.admin.create_topics([NewTopic(self.topic, config['partitions'], 1)])
+            for future in futures.values():
+                future.result()
+        else:
+            self.fake = FakeBroker(config['partitions'])
+
+    def producer(self, bulk = False):
+        if self.broker:
+            from confluent_kafka import Producer
+            from darooghe_pulse import BULK_PRODUCER_CONF
+            return Producer({'bootstrap.servers': self.broker, **(BULK_PRODUCER_CONF if bulk else {})})
+        return BrokerProducer(self.fake, round_trip_ms = self.config['round_trip_ms'])
+
+    def consumer(self):
+        if self.broker:
+            from confluent_kafka import Consumer
+            consumer = Consumer({**kafka_consumer.batch_conf, 'bootstrap.servers': self.broker,
+                                 'group.id': f'{self.topic}-group'})
+        else:
+            consumer = BrokerConsumer(self.fake, fetch_ms = self.config['round_trip_ms'],
+                                      commit_ms = self.config['round_trip_ms'])
+        consumer.subscribe([self.topic])
+        return consumer
+
+    def close(self):
+        if self.broker:
+            for future in self.admin.delete_topics([self.topic]).values():
+                future.result()
+
+
+class CountingSink(KafkaSink):
+    # KafkaSink recording the delivery latency of every event
+    def __init__(self, producer, topic):
+        super().__init__(producer, topic)
+        self.latency = Histogram()
+        self.on_delivery = self.delivered
+
+    def delivered(self, err, msg):
+        if err is not None:
+            self.failures += 1
+        elif msg.latency() is not None:
+            self.latency.record(msg.latency())
+
+    def write_many(self, keys, values):
+        for key, value in zip(keys, values):
+            self.write(key, value, self.on_delivery)
+        self.producer.poll(0)
+
+
+class TimedConsumer:
+    # Wraps a consumer so every commit records, for each message of the batch, the time since the
+    # broker appended it
+    def __init__(self, consumer, latency):
+        self.consumer = consumer
+        self.latency = latency
+        self.batch = []
+        self.consumed = 0
+
+    def consume(self, num_messages = 1, timeout = -1):
+        self.batch = self.consumer.consume(num_messages = num_messages, timeout = timeout)
+        self.consumed += len(self.batch)
+        return self.batch
+
+    def commit(self, *args, **kwargs):
+        result = self.consumer.commit(*args, **kwargs)
+        now_ms = time.time() * 1000
+        appended = np.array([msg.timestamp()[1] for msg in self.batch if msg.timestamp()[0]], dtype = np.float64)
+        self.latency.record_many((now_ms - appended) / 1000)
+        return result
+
+    def __getattr__(self, attribute):
+        return getattr(self.consumer, attribute)
+
+
+def produce_events(sink, generator, count, rate = 0, invalid_ratio = 1.0, stop = None):
+    # Generated totals include the commission, which validation rejects; zeroing it for the valid share
+    # of each block gives the requested invalid ratio
+    pacer = PoissonPacer(lambda: rate, generator.np_rng) if rate else None
+    produced = 0
+    while produced < count and not (stop and stop.is_set()):
+        due = min(pacer.wait() if pacer else BLOCK_SIZE, count - produced)
+        if not due:
+            continue
+        now = datetime.utcnow()
+        block = generator.event_block(due, now, now)
+        valid = generator.np_rng.random(due) >= invalid_ratio
+        block['commission_amount'] = np.where(valid, 0, block['commission_amount'])
+        sink.write_many(*serialize_event_block(block))
+        produced += due
+    sink.flush()
+    return produced
+
+
+def run_producer(config, cluster):
+    sink = CountingSink(cluster.producer(bulk = True), cluster.topic)
+    produced = produce_events(sink, TransactionGenerator(seed = config['seed']), config['events'], config['rate'],
+                              config['invalid_ratio'])
+    return produced, sink.latency, 'delivery'
+
+
+def preload(config, cluster):
+    sink = CountingSink(cluster.producer(bulk = True), cluster.topic)
+    produce_events(sink, TransactionGenerator(seed = config['seed']), config['events'], 0, config['invalid_ratio'])
+
+
+def consume(config, cluster, consumer, producer, should_stop, on_batch = None):
+    state = PartitionStates(kafka_consumer.build_stages, directory = None)
+    kafka_consumer.run_batch_consumer(consumer, producer, batch_size = config['batch_size'], linger_ms = 10,
+                                      should_stop = should_stop, on_batch = on_batch, state = state)
+    producer.flush()
+
+
+def run_consumer(config, cluster):
+    latency = Histogram()
+    invalid = 0
+    consumer = TimedConsumer(cluster.consumer(), Histogram())
+
+    def on_batch(count, invalid_count, elapsed):
+        nonlocal invalid
+        invalid += invalid_count
+        latency.record(elapsed)
+
+    consume(config, cluster, consumer, cluster.producer(), lambda: consumer.consumed >= config['events'], on_batch)
+    consumer.close()
+    return consumer.consumed, latency, 'batch', invalid
+
+
+def run_pipeline(config, cluster):
+    consumer = TimedConsumer(cluster.consumer(), Histogram())
+    sink = CountingSink(cluster.producer(), cluster.topic)
+    stop = threading.Event()
+    thread = threading.Thread(target = produce_events, daemon = True,
+                              args = (sink, TransactionGenerator(seed = config['seed']), config['events'],
+                                      config['rate'], config['invalid_ratio'], stop))
+    invalid = 0
+
+    def on_batch(count, invalid_count, elapsed):
+        nonlocal invalid
+        invalid += invalid_count
+
+    thread.start()
+    try:
+        # Also stops if the producer thread ends early and everything it wrote has been consumed
+        consume(config, cluster, consumer, cluster.producer(), on_batch = on_batch,
+                should_stop = lambda: consumer.consumed >= config['events'] or not thread.is_alive() and not consumer.batch)
+    finally:
+        stop.set()
+        thread.join()
+    consumer.close()
+    return consumer.consumed, consumer.latency, 'end_to_end', invalid
+
+
+def run_one(config):
+    logging.getLogger().setLevel(logging.WARNING)
+    cluster = Cluster(config)
+    runner = {'producer': run_producer, 'consumer': run_consumer, 'pipeline': run_pipeline}[config['component']]
+    try:
+        if config['component'] == 'consumer':
+            preload(config, cluster)
+        wall, cpu = time.perf_counter(), time.process_time()
+        events, latency, latency_kind, *invalid = runner(config, cluster)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    finally:
+        cluster.close()
+    p50, p99 = latency.quantiles((0.5, 0.99)) if latency.count else (None, None)
+    return {
+        **config,
+        "events_done": events,
+        "seconds": round(wall, 3),
+        "throughput": round(events / wall, 1),
+        "latency_kind": latency_kind,
+        "latency_p50_ms": round(p50 * 1000, 3) if p50 is not None else None,
+        "latency_p99_ms": round(p99 * 1000, 3) if p99 is not None else None,
+        "cpu_seconds": round(cpu, 3),
+        "cpu_percent": round(100 * cpu / wall, 1),
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10), 1),
+        "invalid": invalid[0] if invalid else None,
+    }
+
+
+def sweep(args):
+    seen = set()
+    for component, rate, batch_size, partitions, invalid_ratio in itertools.product(
+            args.components, args.rates, args.batch_sizes, args.partitions, args.invalid_ratios):
+        # Parameters a component ignores are pinned so it runs once per meaningful combination
+        config = {
+            "component": component,
+            "rate": rate if component != 'consumer' else 0,
+            "batch_size": batch_size if component != 'producer' else 0,
+            "partitions": partitions,
+            "invalid_ratio": invalid_ratio if component != 'producer' else 0.0,
+            "events": args.events,
+            "broker": args.broker,
+            "round_trip_ms": args.round_trip_ms,
+            "seed": args.seed,
+        }
+        if run_key(config) not in seen:
+            seen.add(run_key(config))
+            yield config
+
+
+def run_key(run):
+    return tuple(run.get(field) for field in KEY_FIELDS)
+
+
+def compare(runs, baseline_path, tolerance, latency_tolerance):
+    with open(baseline_path) as f:
+        baseline = {run_key(run): run for run in json.load(f)["runs"]}
+    regressions = 0
+    for run in runs:
+        old = baseline.get(run_key(run))
+        if old is None:
+            continue
+        throughput = run["throughput"] / old["throughput"] - 1
+        p99 = (run["latency_p99_ms"] / old["latency_p99_ms"] - 1
+               if run["latency_p99_ms"] and old["latency_p99_ms"] else 0.0)
+        regressed = throughput < -tolerance or p99 > latency_tolerance
+        regressions += regressed
+        print(f"{'REGRESSION' if regressed else 'ok':>10}  {run['component']:>8} rate={run['rate']} "
+              f"batch={run['batch_size']} partitions={run['partitions']} invalid={run['invalid_ratio']}: "
+              f"throughput {throughput:+.1%}, p99 {p99:+.1%}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Sweep load tests over the Darooghe pipeline")
+    parser.add_argument('--components', nargs = '+', choices = COMPONENTS, default = list(COMPONENTS))
+    parser.add_argument('--rates', type = float, nargs = '+', default = [0],
+                        help = "producer rates in events/s (0 = as fast as possible)")
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [500])
+    parser.add_argument('--partitions', type = int, nargs = '+', default = [1, 4])
+    parser.add_argument('--invalid-ratios', type = float, nargs = '+', default = [0.1])
+    parser.add_argument('--events', type = int, default = 20000)
+    parser.add_argument('--round-trip-ms', type = float, default = 1.0, help = "simulated broker round trip")
+    parser.add_argument('--broker', default = None, help = "use this Kafka cluster instead of the in-process broker")
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--output', default = None, help = "write the results to this JSON file")
+    parser.add_argument('--compare', default = None, help = "earlier results to check for regressions")
+    parser.add_argument('--tolerance', type = float, default = 0.1, help = "allowed throughput drop")
+    parser.add_argument('--latency-tolerance', type = float, default = 0.25, help = "allowed p99 increase")
+    parser.add_argument('--run', default = None, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_one(json.loads(args.run))))
+        raise SystemExit(0)
+
+    runs = []
+    for config in sweep(args):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', json.dumps(config)],
+                                check = True, capture_output = True, text = True).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+        runs.append(run)
+        p99 = f"{run['latency_p99_ms']:.1f}" if run['latency_p99_ms'] is not None else '-'
+        print(f"{run['component']:>8} rate={run['rate']:<6g} batch={run['batch_size']:<5} partitions={run['partitions']} "
+              f"invalid={run['invalid_ratio']}: {run['throughput']:>9,.0f} events/s, {run['latency_kind']} p99 "
+              f"{p99} ms, CPU {run['cpu_percent']:.0f}%, RSS {run['rss_mb']:.0f} MB")
+
+    results = {
+        "started": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "runs": runs,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+    if args.compare and compare(runs, args.compare, args.tolerance, args.latency_tolerance):
+        raise SystemExit(1)
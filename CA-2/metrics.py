@@ -0,0 +1,290 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+
+METRICS_ENABLED = os.getenv('METRICS', 'on').lower() == 'on'
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # 0: no HTTP endpoint
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', 60))  # 0: no log summaries
+KAFKA_STATS_INTERVAL_MS = int(os.getenv('KAFKA_STATS_INTERVAL_MS', 0))  # 0: librdkafka statistics off
+
+SUB_BUCKET_BITS = 7  # 128 linear sub-buckets per power of two: values are kept within 1%
+MAX_VALUE_BITS = 40  # Values are microseconds; anything above ~12 days lands in the last bucket
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(micros):
+    # HDR-style log-linear bucketing of a non-negative integer
+    if micros < 2 << SUB_BUCKET_BITS:
+        return micros
+    shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+    return ((shift + 1) << SUB_BUCKET_BITS) + (micros >> shift) - (1 << SUB_BUCKET_BITS)
+
+
+def bucket_indices(micros):
+    micros = np.asarray(micros, dtype = np.int64)
+    shift = np.maximum(np.floor(np.log2(np.maximum(micros, 1))).astype(np.int64) - SUB_BUCKET_BITS, 0)
+    linear = micros < (2 << SUB_BUCKET_BITS)
+    indices = ((shift + 1) << SUB_BUCKET_BITS) + (micros >> shift) - (1 << SUB_BUCKET_BITS)
+    return np.where(linear, micros, indices)
+
+
+def bucket_value(index):
+    # Lowest value that falls into bucket `index`
+    if index < 2 << SUB_BUCKET_BITS:
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    return ((index & ((1 << SUB_BUCKET_BITS) - 1)) + (1 << SUB_BUCKET_BITS)) << shift
+
+
+BUCKET_COUNT = bucket_index((1 << MAX_VALUE_BITS) - 1) + 1
+MAX_MICROS = (1 << MAX_VALUE_BITS) - 1
+
+
+def escape_label(value):
+    # Label values come from outside (rule codes from the rules file): escape them as the text format requires
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    # Latencies in seconds, bucketed in microseconds with ~1% relative error and fixed memory
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        # bucket_index inlined: this runs for every delivery report
+        micros = int(seconds * 1e6)
+        if micros < 2 << SUB_BUCKET_BITS:
+            index = micros if micros > 0 else 0
+        else:
+            shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+            index = min(((shift + 1) << SUB_BUCKET_BITS) + (micros >> shift) - (1 << SUB_BUCKET_BITS), BUCKET_COUNT - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def record_many(self, seconds):
+        # Vectorized record() for an array of values, e.g. a batch's end-to-end latencies
+        seconds = np.asarray(seconds, dtype = np.float64)
+        if not len(seconds):
+            return
+        micros = np.clip((seconds * 1e6).astype(np.int64), 0, MAX_MICROS)
+        indices, hits = np.unique(bucket_indices(micros), return_counts = True)
+        counts = self.counts
+        for index, hit in zip(indices.tolist(), hits.tolist()):
+            counts[index] += hit
+        self.count += len(seconds)
+        self.total += float(seconds.sum())
+        self.max = max(self.max, float(seconds.max()))
+
+    def quantiles(self, quantiles = QUANTILES):
+        # Upper-bound-free estimate: the midpoint of the bucket holding each quantile, in seconds
+        results = []
+        targets = [q * self.count for q in quantiles]
+        seen = 0
+        position = 0
+        for index, hits in enumerate(self.counts):
+            if not hits:
+                continue
+            seen += hits
+            while position < len(targets) and seen >= targets[position]:
+                low, high = bucket_value(index), bucket_value(index + 1)
+                results.append(min((low + high) / 2 / 1e6, self.max))
+                position += 1
+            if position == len(targets):
+                break
+        return results + [self.max] * (len(targets) - len(results))
+
+
+class NullMetric:
+    # Stands in for every metric when METRICS=off
+    value = 0
+    count = 0
+
+    def inc(self, amount = 1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def record(self, seconds):
+        pass
+
+    def record_many(self, seconds):
+        pass
+
+    def labels(self, *values):
+        return self
+
+
+class Family:
+    # A named metric and its children, one per combination of label values
+    def __init__(self, kind, name, help_text, label_names, factory):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.factory = factory
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+
+class MetricsRegistry:
+    def __init__(self, enabled = METRICS_ENABLED):
+        self.enabled = enabled
+        self.families = {}
+        self.last_log = time.monotonic()
+
+    def register(self, kind, name, help_text, labels, factory):
+        # Labelled metrics return their family (use .labels(...)); unlabelled ones the metric itself
+        if not self.enabled:
+            return NullMetric()
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(kind, name, help_text, tuple(labels), factory)
+        return family if family.label_names else family.labels()
+
+    def counter(self, name, help_text, labels = ()):
+        return self.register('counter', name, help_text, labels, Counter)
+
+    def gauge(self, name, help_text, labels = ()):
+        return self.register('gauge', name, help_text, labels, Gauge)
+
+    def histogram(self, name, help_text, labels = ()):
+        return self.register('summary', name, help_text, labels, Histogram)
+
+    def render(self):
+        # Prometheus text format; histograms are exposed as summaries with fixed quantiles
+        lines = []
+        for family in list(self.families.values()):
+            lines.append(f'# HELP {family.name} {family.help}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            for values, child in list(family.children.items()):
+                if family.kind == 'summary':
+                    for q, value in zip(QUANTILES, child.quantiles()):
+                        labels = label_text(family.label_names + ('quantile',), values + (q,))
+                        lines.append(f'{family.name}{labels} {value:.6g}')
+                    labels = label_text(family.label_names, values)
+                    lines.append(f'{family.name}_sum{labels} {child.total:.6g}')
+                    lines.append(f'{family.name}_count{labels} {child.count}')
+                else:
+                    lines.append(f'{family.name}{label_text(family.label_names, values)} {child.value:.6g}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # One compact line: counters and gauges as values, histograms as p50/p99 in milliseconds
+        parts = []
+        for family in list(self.families.values()):
+            for values, child in list(family.children.items()):
+                name = family.name + ('[' + ','.join(map(str, values)) + ']' if values else '')
+                if family.kind == 'summary':
+                    if child.count:
+                        p50, p99 = child.quantiles((0.5, 0.99))
+                        parts.append(f'{name} p50={p50 * 1e3:.2f}ms p99={p99 * 1e3:.2f}ms n={child.count}')
+                else:
+                    parts.append(f'{name}={child.value:g}')
+        return ' | '.join(parts)
+
+    def maybe_log(self, interval = METRICS_LOG_INTERVAL):
+        if not self.enabled or not interval:
+            return
+        now = time.monotonic()
+        if now - self.last_log >= interval:
+            self.last_log = now
+            logging.info(f"Metrics: {self.summary()}")
+
+    def serve(self, port = METRICS_PORT, host = '0.0.0.0'):
+        # /metrics on a daemon thread; returns the server, or None when disabled
+        if not self.enabled or not port:
+            return None
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target = server.serve_forever, name = 'metrics-http', daemon = True).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+    def kafka_stats(self, stats_json):
+        # librdkafka statistics callback (stats_cb): queue depth, broker round trips and consumer lag
+        try:
+            stats = json.loads(stats_json)
+        except ValueError:
+            return
+        client = stats.get('name', 'client')
+        self.gauge('kafka_queue_messages', 'Messages waiting in the client queue', ('client',)) \
+            .labels(client).set(stats.get('msg_cnt', 0))
+        self.gauge('kafka_queue_bytes', 'Bytes waiting in the client queue', ('client',)) \
+            .labels(client).set(stats.get('msg_size', 0))
+        rtt = [broker['rtt']['avg'] for broker in stats.get('brokers', {}).values()
+               if broker.get('rtt', {}).get('cnt')]
+        if rtt:
+            self.gauge('kafka_broker_rtt_seconds', 'Average broker round trip', ('client',)) \
+                .labels(client).set(max(rtt) / 1e6)
+        if stats.get('type') == 'consumer':
+            lag = self.gauge('kafka_consumer_lag', 'Messages behind the partition end', ('topic', 'partition'))
+            for topic, topic_stats in stats.get('topics', {}).items():
+                for partition, partition_stats in topic_stats.get('partitions', {}).items():
+                    if partition != '-1' and partition_stats.get('consumer_lag', -1) >= 0:
+                        lag.labels(topic, partition).set(partition_stats['consumer_lag'])
+
+    def client_conf(self, conf, interval_ms = KAFKA_STATS_INTERVAL_MS):
+        # Adds the statistics callback to a confluent_kafka client configuration when enabled
+        if not self.enabled or not interval_ms:
+            return conf
+        return {**conf, 'statistics.interval.ms': interval_ms, 'stats_cb': self.kafka_stats}
+
+
+REGISTRY = MetricsRegistry()
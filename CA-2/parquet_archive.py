@@ -0,0 +1,301 @@
+from datetime import datetime, timezone
+import glob
+import logging
+import math
+import os
+import time
+import uuid
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from columnar_validator import parse_timestamps
+from fraud_features import event_seconds
+
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', '')  # Empty: no archive
+ARCHIVE_ROW_GROUP = int(os.getenv('ARCHIVE_ROW_GROUP', 50000))  # Rows buffered before a write
+ARCHIVE_FILE_MB = float(os.getenv('ARCHIVE_FILE_MB', 128))
+ARCHIVE_FLUSH_SECONDS = float(os.getenv('ARCHIVE_FLUSH_SECONDS', 300))  # Max age of a row not in a finished file
+
+KINDS = ('transactions', 'errors')
+HOUR_US = 3600 * 10**6
+INTEGERS = ('amount', 'commission_amount', 'vat_amount', 'total_amount', 'risk_level')
+NO_HOUR = np.iinfo(np.int64).min  # Hour key of rows without a readable timestamp
+# Hive's name for a null partition value: pyarrow reads it back as null
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def archive_schema(kind):
+    # Low-cardinality strings are dictionary-encoded in memory and in the files
+    categorical = pa.dictionary(pa.int32(), pa.string())
+    fields = [
+        ('transaction_id', pa.string()),
+        ('timestamp', pa.timestamp('us', tz = 'UTC')),
+        ('customer_id', pa.string()),
+        ('merchant_id', pa.string()),
+        ('merchant_category', categorical),
+        ('payment_method', categorical),
+        ('amount', pa.int64()),
+        ('location_lat', pa.float64()),
+        ('location_lng', pa.float64()),
+        ('device_os', categorical),
+        ('device_app_version', categorical),
+        ('device_model', categorical),
+        ('status', categorical),
+        ('commission_type', categorical),
+        ('commission_amount', pa.int64()),
+        ('vat_amount', pa.int64()),
+        ('total_amount', pa.int64()),
+        ('customer_type', categorical),
+        ('risk_level', pa.int64()),
+        ('failure_reason', categorical),
+    ]
+    if kind == 'errors':
+        # The error codes replace the error log's embedded copy of the transaction
+        fields += [('error_codes', pa.list_(pa.string())), ('error_messages', pa.list_(pa.string()))]
+    return pa.schema(fields)
+
+
+def as_int(value):
+    # Amounts may arrive as floats from other producers; the archive keeps whole rials. NaN, infinities
+    # (JSON's Infinity) and values beyond int64 are archived as null.
+    if not isinstance(value, (int, float)) or (isinstance(value, float) and not math.isfinite(value)):
+        return None
+    value = int(value)
+    return value if -2**63 <= value < 2**63 else None
+
+
+def as_float(value):
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+def timestamps_us(transactions):
+    epoch_us, needs_fallback = parse_timestamps([t.get('timestamp') for t in transactions])
+    times = epoch_us.astype(np.int64)
+    valid = np.ones(len(transactions), dtype = bool)
+    for i in needs_fallback.nonzero()[0].tolist():
+        try:
+            times[i] = round(event_seconds(transactions[i]['timestamp']) * 10**6)
+        except (TypeError, ValueError, AttributeError):
+            valid[i] = False
+    return times, valid
+
+
+def flatten(transactions, errors = None):
+    # Column lists for the archive schema. Rows without a readable timestamp are kept with a null one
+    # (`timestamp_valid` is False): they are the rejected rows the errors archive most needs.
+    times, valid = timestamps_us(transactions)
+    rows = range(len(transactions))
+    columns = {'timestamp': np.where(valid, times, 0), 'timestamp_valid': valid}
+    for name in ('transaction_id', 'customer_id', 'merchant_id', 'merchant_category', 'payment_method',
+                 'status', 'commission_type', 'customer_type', 'failure_reason'):
+        columns[name] = [transactions[i].get(name) for i in rows]
+    for name in INTEGERS:
+        columns[name] = [as_int(transactions[i].get(name)) for i in rows]
+    locations = [transactions[i].get('location') or {} for i in rows]
+    columns['location_lat'] = [as_float(location.get('lat')) for location in locations]
+    columns['location_lng'] = [as_float(location.get('lng')) for location in locations]
+    devices = [transactions[i].get('device_info') or {} for i in rows]
+    columns['device_os'] = [device.get('os') for device in devices]
+    columns['device_app_version'] = [device.get('app_version') for device in devices]
+    columns['device_model'] = [device.get('device_model') for device in devices]
+    if errors is not None:
+        columns['error_codes'] = [[e['code'] for e in errors[i]] for i in rows]
+        columns['error_messages'] = [[e['message'] for e in errors[i]] for i in rows]
+    return columns
+
+
+def to_table(columns, schema):
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, pa.string()).dictionary_encode())
+        elif field.name == 'timestamp':
+            arrays.append(pa.array(values, pa.int64(), mask = ~columns['timestamp_valid']).cast(field.type))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.Table.from_arrays(arrays, schema = schema)
+
+
+def partition_dir(hour):
+    if hour == NO_HOUR:
+        return f'date={NULL_PARTITION}/hour={NULL_PARTITION}'
+    moment = datetime.fromtimestamp(hour * 3600, tz = timezone.utc)
+    return f'date={moment:%Y-%m-%d}/hour={moment.hour:02d}'
+
+
+class ArchiveFile:
+    def __init__(self, directory, schema, opened):
+        os.makedirs(directory, exist_ok = True)
+        name = f'part-{uuid.uuid4().hex}.parquet'
+        self.path = os.path.join(directory, name)
+        # Written under a hidden name and renamed on close: readers only ever see complete files
+        self.tmp_path = os.path.join(directory, f'.{name}.tmp')
+        self.writer = pq.ParquetWriter(self.tmp_path, schema, compression = 'zstd',
+                                       use_dictionary = True, write_statistics = True)
+        self.opened = opened
+        self.rows = 0
+
+    def size(self):
+        return os.path.getsize(self.tmp_path)
+
+    def write(self, table):
+        self.writer.write_table(table)
+        self.rows += table.num_rows
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+
+class ParquetArchive:
+    # Buffers valid transactions and rejected ones with their error codes, and writes them to
+    # <directory>/<kind>/date=YYYY-MM-DD/hour=HH/part-*.parquet by event time. Files roll at
+    # `file_mb`. A row reaches a finished file at the latest `flush_seconds` after it was buffered
+    # (checked whenever a batch arrives), and on every checkpoint, so a snapshot never points past
+    # rows that are not on disk yet.
+    name = 'archive'
+
+    def __init__(self, directory = ARCHIVE_DIR, row_group = ARCHIVE_ROW_GROUP, file_mb = ARCHIVE_FILE_MB,
+                 flush_seconds = ARCHIVE_FLUSH_SECONDS, clock = time.monotonic):
+        if pa is None:
+            raise ImportError("The Parquet archive needs pyarrow (pip install pyarrow)")
+        self.directory = directory
+        self.row_group = row_group
+        self.file_bytes = file_mb * 2**20
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+        self.schemas = {kind: archive_schema(kind) for kind in KINDS}
+        self.buffers = {kind: [] for kind in KINDS}
+        self.buffered = {kind: 0 for kind in KINDS}
+        self.buffered_since = {kind: None for kind in KINDS}  # When the oldest buffered row arrived
+        self.files = {}  # (kind, hour) -> ArchiveFile
+        self.rows_written = 0
+        self.files_written = 0
+
+    def append(self, kind, columns):
+        count = len(columns['timestamp'])
+        if not count:
+            return
+        if not self.buffered[kind]:
+            self.buffered_since[kind] = self.clock()
+        self.buffers[kind].append(columns)
+        self.buffered[kind] += count
+        if self.buffered[kind] >= self.row_group:
+            self.write(kind)
+
+    def write(self, kind):
+        if not self.buffered[kind]:
+            return
+        parts = self.buffers[kind]
+        columns = {name: np.concatenate([part[name] for part in parts]) if isinstance(parts[0][name], np.ndarray)
+                   else [value for part in parts for value in part[name]] for name in parts[0]}
+        since = self.buffered_since[kind]
+        self.buffers[kind], self.buffered[kind], self.buffered_since[kind] = [], 0, None
+        table = to_table(columns, self.schemas[kind])
+        hours = np.where(columns['timestamp_valid'], columns['timestamp'] // HOUR_US, NO_HOUR)
+        distinct = np.unique(hours).tolist()
+        for hour in distinct:
+            rows = table.filter(pa.array(hours == hour)) if len(distinct) > 1 else table
+            key = (kind, hour)
+            archive_file = self.files.get(key)
+            if archive_file is None:
+                # A file is as old as the oldest row in it, which may have waited in the buffer
+                archive_file = self.files[key] = ArchiveFile(
+                    os.path.join(self.directory, kind, partition_dir(hour)), self.schemas[kind], since)
+            archive_file.write(rows)
+            self.rows_written += rows.num_rows
+            if archive_file.size() >= self.file_bytes:
+                self.finish([key])
+
+    def finish(self, keys = None):
+        for key in list(self.files) if keys is None else keys:
+            archive_file = self.files.pop(key)
+            archive_file.close()
+            self.files_written += 1
+            logging.debug(f"Archived {archive_file.rows} rows to {archive_file.path}")
+
+    def flush(self):
+        for kind in KINDS:
+            self.write(kind)
+        self.finish()
+
+    def maybe_flush(self):
+        # A slow stream never fills a row group: its buffers are written once their oldest row is
+        # `flush_seconds` old, into files that are then stale and finished at once
+        now = self.clock()
+        for kind in KINDS:
+            if self.buffered[kind] and now - self.buffered_since[kind] >= self.flush_seconds:
+                self.write(kind)
+        stale = [key for key, archive_file in self.files.items() if now - archive_file.opened >= self.flush_seconds]
+        if stale:
+            self.finish(stale)
+
+    def process(self, transactions, producer):
+        self.append('transactions', flatten(transactions))
+        self.maybe_flush()
+        return 0
+
+    def reject(self, transactions, errors):
+        self.append('errors', flatten(transactions, errors))
+        self.maybe_flush()
+
+    def close(self):
+        self.flush()
+
+    def get_state(self):
+        self.flush()
+        return {"rows_written": self.rows_written, "files_written": self.files_written}
+
+    def set_state(self, snapshot):
+        self.rows_written = snapshot["rows_written"]
+        self.files_written = snapshot["files_written"]
+
+
+def hour_filter(start, end):
+    # Partition pruning: only date=/hour= directories that can overlap [start, end) are opened
+    expression = None
+    if start is not None:
+        day, hour = f'{start:%Y-%m-%d}', start.hour
+        expression = (ds.field('date') > day) | ((ds.field('date') == day) & (ds.field('hour') >= hour))
+    if end is not None:
+        day, hour = f'{end:%Y-%m-%d}', end.hour
+        upper = (ds.field('date') < day) | ((ds.field('date') == day) & (ds.field('hour') <= hour))
+        expression = upper if expression is None else expression & upper
+    return expression
+
+
+def utc(moment):
+    return moment.replace(tzinfo = timezone.utc) if moment.tzinfo is None else moment.astimezone(timezone.utc)
+
+
+def scan(directory, kind = 'transactions', start = None, end = None, columns = None, filter = None):
+    # Reads rows with start <= timestamp < end (naive datetimes are UTC) as an Arrow table. `filter` is
+    # an extra pyarrow.dataset expression, e.g. ds.field('status') == 'declined'; the timestamp and
+    # filter predicates are pushed down to Parquet row-group statistics. Rows archived without a readable
+    # timestamp only come back without start and end, e.g. with filter = ds.field('timestamp').is_null().
+    if pa is None:
+        raise ImportError("Reading the Parquet archive needs pyarrow (pip install pyarrow)")
+    root = os.path.join(directory, kind)
+    if not glob.glob(os.path.join(root, '*', '*', '*.parquet')):
+        return archive_schema(kind).empty_table()
+    partitioning = ds.partitioning(pa.schema([('date', pa.string()), ('hour', pa.int32())]), flavor = 'hive')
+    dataset = ds.dataset(root, format = 'parquet', partitioning = partitioning)
+    start = utc(start) if start is not None else None
+    end = utc(end) if end is not None else None
+    expression = hour_filter(start, end)
+    if start is not None:
+        expression = expression & (ds.field('timestamp') >= pa.scalar(start, pa.timestamp('us', tz = 'UTC')))
+    if end is not None:
+        expression = expression & (ds.field('timestamp') < pa.scalar(end, pa.timestamp('us', tz = 'UTC')))
+    if filter is not None:
+        expression = filter if expression is None else expression & filter
+    return dataset.to_table(columns = columns, filter = expression)
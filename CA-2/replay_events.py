@@ -0,0 +1,76 @@
+import os
+import time
+import argparse
+import datetime
+import logging
+from confluent_kafka import Producer
+
+from darooghe_codec import decode
+from darooghe_pulse import BULK_PRODUCER_CONF
+from event_sinks import KafkaSink, open_sink, read_events
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(
+    level=getattr(logging, log_level_str, logging.INFO),
+    format="%(asctime)s %(levelname)s %(message)s",
+)
+
+POLL_EVERY = 10000
+
+
+def parse_timestamp(value):
+    return datetime.datetime.fromisoformat(value.rstrip("Z"))
+
+
+def replay(lines, sink, speed=1.0, limit=None, clock=time.monotonic, sleep=time.sleep):
+    # speed 1 keeps the captured gaps between events, N compresses them N times, 0 sends as fast as possible.
+    # Events earlier than the first one (an unsorted capture) are sent immediately.
+    started = first_time = None
+    count = 0
+    for line in lines:
+        if limit is not None and count >= limit:
+            break
+        event = decode(line)
+        if speed > 0:
+            event_time = parse_timestamp(event["timestamp"])
+            if first_time is None:
+                first_time, started = event_time, clock()
+            delay = started + (event_time - first_time).total_seconds() / speed - clock()
+            if delay > 0:
+                sleep(delay)
+        sink.write(event.get("customer_id"), line)
+        count += 1
+        if count % POLL_EVERY == 0:
+            sink.poll()
+    sink.flush()
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured Darooghe events")
+    parser.add_argument("path", help="NDJSON file, .gz segment or directory of segments")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 = original timing, N = N times faster, 0 = as fast as possible")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--sink", default="kafka", help="kafka, file:PATH, segments:DIR or memory[:N]")
+    parser.add_argument("--topic", default="darooghe.transactions")
+    args = parser.parse_args()
+
+    if args.sink == "kafka":
+        conf = {"bootstrap.servers": os.getenv("KAFKA_BROKER", "kafka:9092")}
+        sink = KafkaSink(Producer({**conf, **BULK_PRODUCER_CONF}), args.topic)
+    else:
+        try:
+            sink = open_sink(args.sink)
+        except ValueError as e:
+            parser.error(str(e))
+
+    logging.info(f"Replaying {args.path} into {args.sink} at speed {args.speed or 'max'}...")
+    started = time.perf_counter()
+    try:
+        count = replay(read_events(args.path), sink, args.speed, args.limit)
+    finally:
+        sink.close()
+    elapsed = time.perf_counter() - started
+    logging.info(f"Replayed {count} events in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} events/s, "
+                 f"{getattr(sink, 'failures', 0)} delivery failures).")
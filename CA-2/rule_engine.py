@@ -0,0 +1,234 @@
+from datetime import datetime, timedelta
+from string import Formatter
+import json
+import logging
+import os
+import time
+
+
+VALIDATION_RULES = os.getenv('VALIDATION_RULES', '')  # Empty: the hand-written checks of transaction_validation
+RULES_RELOAD_INTERVAL = float(os.getenv('RULES_RELOAD_INTERVAL', 5))  # Seconds between checks of the rule file
+
+# Operators with any number of operands, and the Python they compile to
+VARIADIC = {'add': ' + ', 'sub': ' - ', 'mul': ' * ', 'div': ' / ', 'and': ' and ', 'or': ' or '}
+BINARY = {'eq': '==', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>=', 'in': 'in', 'not_in': 'not in'}
+DURATIONS = ('days', 'hours', 'minutes', 'seconds')
+CONVERSIONS = {'r': 'repr', 's': 'str', 'a': 'ascii'}
+EMPTY = {}
+
+
+class RuleError(ValueError):
+    pass
+
+
+def parse_time(timestamp):
+    # Same parsing as validate_time: naive ISO 8601, a trailing Z is UTC
+    return datetime.fromisoformat(timestamp.replace('Z', ''))
+
+
+class RuleCompiler:
+    # Turns the JSON rule list into the source of one function, validate(t, now) -> errors, so a
+    # transaction runs straight-line Python with no per-rule dispatch. Operands are JSON literals,
+    # "$field" references or single-key operator objects:
+    #   "$amount"          t['amount'], a missing field raises KeyError like the hand-written checks
+    #   "$device_info.os"  nested fields, where missing keys read as null
+    #   "$now"             the validation time; "$<name>" also refers to the rule's "let" values
+    #   {"add": [...]}     add/sub/mul/div/and/or over any number of operands
+    #   {"gt": [a, b]}     eq/ne/lt/le/gt/ge, and in/not_in against a list
+    #   {"not": a}, {"time": a} (ISO timestamp to datetime), {"days": 1} (also hours/minutes/seconds)
+    #   {"value": a}       a literal, for strings starting with "$"
+    def __init__(self):
+        self.constants = {}
+        self.lines = []
+
+    def constant(self, value):
+        name = f'c{len(self.constants)}'
+        self.constants[name] = value
+        return name
+
+    def reference(self, name, scope):
+        if name == 'now':
+            return 'now'
+        if name in scope:
+            return f'v_{name}'
+        first, *rest = name.split('.')
+        if not rest:
+            return f't[{first!r}]'
+        source = f't.get({first!r}, EMPTY)'
+        for i, key in enumerate(rest):
+            source += f'.get({key!r})' if i == len(rest) - 1 else f'.get({key!r}, EMPTY)'
+        return source
+
+    def expression(self, node, scope):
+        if isinstance(node, str):
+            return self.reference(node[1:], scope) if node.startswith('$') else repr(node)
+        if node is None or isinstance(node, (bool, int, float)):
+            return repr(node)
+        if isinstance(node, list):
+            return self.constant(tuple(node))
+        if not isinstance(node, dict) or len(node) != 1:
+            raise RuleError(f"Expected a value, a $field or a single-key operator, got {node!r}")
+        (op, operands), = node.items()
+        if op == 'value':
+            return self.constant(operands)
+        if op in DURATIONS:
+            if isinstance(operands, bool) or not isinstance(operands, (int, float)):
+                raise RuleError(f"Duration {op!r} takes a number, got {operands!r}")
+            try:
+                return self.constant(timedelta(**{op: operands}))
+            except OverflowError as e:
+                raise RuleError(f"Duration {op!r} out of range: {operands!r}") from e
+        if op == 'not':
+            return f'(not {self.expression(operands, scope)})'
+        if op == 'time':
+            return f'parse_time({self.expression(operands, scope)})'
+        if not isinstance(operands, list):
+            raise RuleError(f"Operator {op!r} takes a list of operands")
+        if op in VARIADIC and operands:
+            return '(' + VARIADIC[op].join(self.expression(o, scope) for o in operands) + ')'
+        if op in BINARY and len(operands) == 2:
+            left, right = (self.expression(o, scope) for o in operands)
+            return f'({left} {BINARY[op]} {right})'
+        raise RuleError(f"Unknown operator or wrong operand count: {op!r}")
+
+    def message(self, template, scope, extra = ()):
+        if not isinstance(template, str):
+            raise RuleError(f"Expected a message template, got {template!r}")
+        parts = []
+        try:
+            fields = list(Formatter().parse(template))
+        except ValueError as e:
+            raise RuleError(f"Invalid message template {template!r}: {e}") from e
+        for literal, field, spec, conversion in fields:
+            if conversion and conversion not in CONVERSIONS:
+                raise RuleError(f"Unknown conversion !{conversion} in message template {template!r}")
+            if literal:
+                parts.append(repr(literal))
+            if field is not None:
+                source = field if field in extra else self.reference(field, scope)
+                if conversion:
+                    source = f'{CONVERSIONS[conversion]}({source})'
+                parts.append(f'format({source}, {spec!r})')
+        return "''.join((" + ', '.join(parts) + ",))" if parts else "''"
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def rule(self, rule):
+        if not isinstance(rule, dict):
+            raise RuleError(f"Expected a rule object, got {rule!r}")
+        code = rule.get('code')
+        if not isinstance(code, str):
+            raise RuleError(f"Rule without a code: {rule!r}")
+        cases = rule.get('cases') or [{'when': rule.get('when'), 'message': rule.get('message', code)}]
+        if not isinstance(cases, list) or not all(isinstance(case, dict) for case in cases):
+            raise RuleError(f"Rule {code}: cases must be a list of objects")
+        lets = rule.get('let', {})
+        if not isinstance(lets, dict):
+            raise RuleError(f"Rule {code}: let must be an object of names to values")
+        for name in lets:
+            if not name.isidentifier() or name == 'now':
+                raise RuleError(f"Rule {code}: invalid let name {name!r}")
+
+        depth = 1
+        self.emit(depth, f'# {code!r}')
+        if rule.get('invalid') is not None:
+            # Any exception while evaluating the rule becomes its "invalid" error, like validate_time
+            self.emit(depth, 'try:')
+            depth += 1
+        scope = set()
+        for name, node in lets.items():
+            self.emit(depth, f'v_{name} = {self.expression(node, scope)}')
+            scope.add(name)
+        for i, case in enumerate(cases):
+            if case.get('when') is None:
+                raise RuleError(f"Rule {code}: case without a condition")
+            keyword = 'if' if i == 0 else 'elif'
+            self.emit(depth, f'{keyword} {self.expression(case["when"], scope)}:')
+            message = self.message(case.get('message', code), scope)
+            self.emit(depth + 1, f'errors.append({{"code" : {code!r}, "message" : {message}}})')
+        if rule.get('invalid') is not None:
+            self.emit(depth - 1, 'except Exception as error:')
+            message = self.message(rule['invalid'], scope, extra = ('error',))
+            self.emit(depth, f'errors.append({{"code" : {code!r}, "message" : {message}}})')
+
+    def compile(self, rules):
+        if not isinstance(rules, list):
+            raise RuleError("A rule file holds a list of rules")
+        self.emit(0, 'def validate(t, now):')
+        self.emit(1, 'errors = []')
+        for rule in rules:
+            self.rule(rule)
+        self.emit(1, 'return errors')
+        source = '\n'.join(self.lines) + '\n'
+        namespace = {'EMPTY': EMPTY, 'parse_time': parse_time, **self.constants}
+        try:
+            exec(compile(source, '<validation rules>', 'exec'), namespace)
+        except SyntaxError as e:
+            raise RuleError(f"Rules compile to invalid Python: {e}") from e
+        return namespace['validate'], source
+
+
+class RuleSet:
+    # A compiled rule list with the interface of transaction_validation and columnar_validator
+    def __init__(self, rules):
+        self.rules = rules
+        self.function, self.source = RuleCompiler().compile(rules)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def validate(self, transaction, current_time = None):
+        return self.function(transaction, current_time or datetime.utcnow())
+
+    def validate_batch(self, transactions, current_time = None):
+        # {batch index: errors}, like columnar_validator.validate_batch
+        function = self.function
+        now = current_time or datetime.utcnow()
+        results = {}
+        for i, transaction in enumerate(transactions):
+            errors = function(transaction, now)
+            if errors:
+                results[i] = errors
+        return results
+
+
+class RuleFile:
+    # Recompiles the rule file when its modification time changes, checked at most every `interval`
+    # seconds. A file that fails to load or compile is logged and the previous rules stay in force.
+    def __init__(self, path = VALIDATION_RULES, interval = RULES_RELOAD_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.mtime = os.stat(path).st_mtime_ns
+        self.rules = RuleSet.load(path)
+        self.checked = time.monotonic()
+        self.reloads = 0
+        logging.info(f"Loaded {len(self.rules.rules)} validation rules from {path}")
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now - self.checked < self.interval:
+            return False
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return False
+            self.mtime = mtime
+            self.rules = RuleSet.load(self.path)
+        except Exception as e:
+            # RuleCompiler reports malformed rules as RuleError; whatever it misses must not stop
+            # the consumer either
+            logging.error(f"Keeping the current validation rules, {self.path} could not be loaded: {e}")
+            return False
+        self.reloads += 1
+        logging.info(f"Reloaded {len(self.rules.rules)} validation rules from {self.path}")
+        return True
+
+    def validate(self, transaction, current_time = None):
+        return self.rules.validate(transaction, current_time)
+
+    def validate_batch(self, transactions, current_time = None):
+        return self.rules.validate_batch(transactions, current_time)
@@ -0,0 +1,297 @@
+from confluent_kafka import KafkaException, TopicPartition
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+
+CHECKPOINT_DIR = os.getenv('CHECKPOINT_DIR', '')  # Empty: keep state in memory only
+CHECKPOINT_INTERVAL = float(os.getenv('CHECKPOINT_INTERVAL', 60))
+# Without checkpoints, stages marked `handover` (the dedup index) pass their state to a partition's
+# next owner through this directory on revoke; consumers on other hosts need it on a shared volume
+HANDOVER_DIR = os.getenv('HANDOVER_DIR', os.path.join(tempfile.gettempdir(), 'darooghe-handover'))
+SNAPSHOT_VERSION = 1
+COMMITTED_TIMEOUT = 10.0
+
+
+def write_snapshot(path, snapshot):
+    # Write-then-rename, so a crash leaves either the previous snapshot or the new one, never half of one
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol = pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def read_snapshot(path):
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        logging.warning(f"Ignoring snapshot {path} with an unknown format")
+        return None
+    return snapshot
+
+
+class PartitionState:
+    def __init__(self, stages):
+        self.stages = stages
+        # Stages with an admit() method filter transactions before validation
+        self.filters = [stage for stage in stages if hasattr(stage, 'admit')]
+        self.offset = None  # Next offset to consume, once a processed batch was committed
+        self.pending = None  # Next offset after the batch being processed, until it is committed
+        self.replay_until = None  # Offsets below this were committed by a previous owner after the snapshot
+        self.counters = {'messages': 0, 'invalid': 0, 'duplicates': 0}
+
+
+class PartitionStates:
+    # Stateful stages are kept per partition: a partition's state then moves with the partition
+    # and its snapshot pairs the state with the exact offset it reflects.
+    def __init__(self, stage_factory, directory = CHECKPOINT_DIR, interval = CHECKPOINT_INTERVAL,
+                 incremental = False, clock = time.monotonic, handover_directory = HANDOVER_DIR):
+        self.stage_factory = stage_factory
+        self.directory = directory
+        # With checkpoints the snapshot written on revoke already hands every stage over
+        self.handover_directory = handover_directory if not directory else ''
+        self.interval = interval
+        self.incremental = incremental
+        self.clock = clock
+        self.partitions = {}
+        self.replaying = set()
+        self.last_checkpoint = clock()
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+
+    def build(self, topic, partition):
+        stages = self.stage_factory()
+        # Stages with an assign() method learn which partition they keep state for
+        for stage in stages:
+            if hasattr(stage, 'assign'):
+                stage.assign(topic, partition)
+        return stages
+
+    def get(self, topic, partition):
+        state = self.partitions.get((topic, partition))
+        if state is None:
+            state = self.partitions[(topic, partition)] = PartitionState(self.build(topic, partition))
+        return state
+
+    def record(self, topic, partition, offset):
+        state = self.get(topic, partition)
+        state.pending = offset + 1
+        state.counters['messages'] += 1
+
+    def committed(self, offsets = None):
+        # Called once a batch's offsets are committed (all recorded ones, or these TopicPartitions):
+        # only then may its partitions' state reach a snapshot
+        if offsets is None:
+            for state in self.partitions.values():
+                if state.pending is not None:
+                    state.offset, state.pending = state.pending, None
+            return
+        for tp in offsets:
+            state = self.partitions.get((tp.topic, tp.partition))
+            if state is None:
+                continue
+            state.offset = tp.offset
+            if state.pending is not None and state.pending <= tp.offset:
+                state.pending = None
+
+    def admit(self, transactions, sources):
+        # Runs each partition's filters over its transactions, keeping the batch order
+        by_source = {}
+        for i, source in enumerate(sources):
+            by_source.setdefault(source, []).append(i)
+        kept = []
+        for source, indices in by_source.items():
+            state = self.get(*source)
+            for stage in state.filters:
+                admitted = stage.admit([transactions[i] for i in indices])
+                state.counters['duplicates'] += len(indices) - sum(admitted)
+                indices = [i for i, keep in zip(indices, admitted) if keep]
+            kept.extend(indices)
+        if len(kept) == len(transactions):
+            return transactions, sources
+        kept.sort()
+        return [transactions[i] for i in kept], [sources[i] for i in kept]
+
+    def path(self, topic, partition):
+        return os.path.join(self.directory, f'{topic}-{partition}.snapshot')
+
+    def checkpoint(self, keys = None):
+        if not self.directory:
+            return
+        started = time.perf_counter()
+        written = 0
+        skipped = 0
+        for key in list(self.partitions) if keys is None else keys:
+            state = self.partitions.get(key)
+            if state is None or state.offset is None:
+                continue
+            if state.pending is not None:
+                # A batch was interrupted (or is not committed yet): the stages may hold part of it,
+                # so the partition keeps its previous snapshot and replays from there
+                skipped += 1
+                continue
+            write_snapshot(self.path(*key), {
+                'version': SNAPSHOT_VERSION,
+                'topic': key[0],
+                'partition': key[1],
+                'offset': state.offset,
+                'counters': state.counters,
+                'stages': {stage.name: stage.get_state() for stage in state.stages},
+            })
+            written += 1
+        self.last_checkpoint = self.clock()
+        if written:
+            logging.info(f"Checkpointed {written} partitions in {time.perf_counter() - started:.2f}s")
+        if skipped:
+            logging.warning(f"Not checkpointing {skipped} partitions with an uncommitted batch")
+
+    def checkpoint_due(self):
+        return bool(self.directory) and self.clock() - self.last_checkpoint >= self.interval
+
+    def maybe_checkpoint(self):
+        if self.checkpoint_due():
+            self.checkpoint()
+
+    def restore(self, topic, partition):
+        # Returns the offset to resume from, or None to fall back to the group's committed offset
+        if not self.directory:
+            return None
+        snapshot = read_snapshot(self.path(topic, partition))
+        if snapshot is None:
+            return None
+        started = time.perf_counter()
+        stages = self.build(topic, partition)
+        for stage in stages:
+            if stage.name in snapshot['stages']:
+                stage.set_state(snapshot['stages'][stage.name])
+        state = self.partitions[(topic, partition)] = PartitionState(stages)
+        state.offset = snapshot['offset']
+        state.counters.update(snapshot['counters'])
+        logging.info(f"Restored {topic} [{partition}] at offset {state.offset} "
+                     f"in {time.perf_counter() - started:.2f}s")
+        return state.offset
+
+    def handover_path(self, topic, partition):
+        return os.path.join(self.handover_directory, f'{topic}-{partition}.handover')
+
+    def hand_over(self, keys):
+        # Like a checkpoint of the `handover` stages only. The next owner resumes from the committed
+        # offset, so a partition with an uncommitted batch keeps the previous handover
+        if not self.handover_directory:
+            return
+        for key in keys:
+            state = self.partitions.get(key)
+            if state is None or state.offset is None or state.pending is not None:
+                continue
+            stages = {stage.name: stage.get_state() for stage in state.stages if getattr(stage, 'handover', False)}
+            if not stages:
+                continue
+            os.makedirs(self.handover_directory, exist_ok = True)
+            write_snapshot(self.handover_path(*key), {
+                'version': SNAPSHOT_VERSION,
+                'topic': key[0],
+                'partition': key[1],
+                'offset': state.offset,
+                'stages': stages,
+            })
+
+    def take_over(self, topic, partition):
+        if not self.handover_directory:
+            return
+        snapshot = read_snapshot(self.handover_path(topic, partition))
+        if snapshot is None:
+            return
+        stages = self.build(topic, partition)
+        for stage in stages:
+            if stage.name in snapshot['stages']:
+                stage.set_state(snapshot['stages'][stage.name])
+        self.partitions[(topic, partition)] = PartitionState(stages)
+        logging.info(f"Took over {topic} [{partition}] handed over at offset {snapshot['offset']}")
+
+    def mark_replay(self, consumer, partitions):
+        # A snapshot is usually older than the group's committed offset. The messages in between are
+        # replayed to rebuild the state, but their error logs, alerts and windows were already
+        # delivered by the previous owner: process_batch publishes nothing for them
+        try:
+            committed = consumer.committed(partitions, timeout = COMMITTED_TIMEOUT)
+        except KafkaException as e:
+            logging.warning(f"Could not read the committed offsets, replayed messages will be published again: {e}")
+            return
+        for tp in committed:
+            state = self.partitions.get((tp.topic, tp.partition))
+            if state is not None and state.offset is not None and tp.offset > state.offset:
+                state.replay_until = tp.offset
+                self.replaying.add((tp.topic, tp.partition))
+                logging.info(f"Replaying {tp.topic} [{tp.partition}] from {state.offset} to the committed offset {tp.offset}")
+
+    def split_replayed(self, msgs):
+        # (replayed, live) messages of a batch, each in the batch's order
+        if not self.replaying:
+            return [], msgs
+        replayed, live = [], []
+        for msg in msgs:
+            key = (msg.topic(), msg.partition())
+            if key in self.replaying and not msg.error():
+                state = self.partitions[key]
+                if msg.offset() < state.replay_until:
+                    replayed.append(msg)
+                    continue
+                state.replay_until = None
+                self.replaying.discard(key)
+            live.append(msg)
+        return replayed, live
+
+    def on_assign(self, consumer, partitions):
+        assigned = []
+        restored = []
+        for p in partitions:
+            offset = self.restore(p.topic, p.partition)
+            if offset is None:
+                self.take_over(p.topic, p.partition)
+            else:
+                restored.append(TopicPartition(p.topic, p.partition))
+            assigned.append(TopicPartition(p.topic, p.partition, offset) if offset is not None else p)
+        if restored:
+            self.mark_replay(consumer, restored)
+        if self.incremental:
+            consumer.incremental_assign(assigned)
+        else:
+            consumer.assign(assigned)
+
+    def close(self, keys = None):
+        # Lets stages holding files or buffers (the archive) finish them
+        for key in list(self.partitions) if keys is None else keys:
+            state = self.partitions.get(key)
+            for stage in state.stages if state is not None else []:
+                if hasattr(stage, 'close'):
+                    stage.close()
+
+    def on_revoke(self, consumer, partitions):
+        # Partitions whose last batch did not commit (close() after an error) are not checkpointed
+        keys = [(p.topic, p.partition) for p in partitions]
+        self.checkpoint(keys)
+        self.hand_over(keys)
+        self.close(keys)
+        for key in keys:
+            self.partitions.pop(key, None)
+            self.replaying.discard(key)
+        if self.incremental:
+            consumer.incremental_unassign(partitions)
+        else:
+            consumer.unassign()
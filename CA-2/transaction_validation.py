@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+
+def validate_amount(transaction):
+    total_amount_expected = transaction['amount'] + transaction['vat_amount']
+    + transaction['commission_amount']
+
+    return total_amount_expected, transaction['total_amount'] == total_amount_expected
+
+
+def validate_time(transaction, errors, current_time = None):
+    try:
+        transaction_time = datetime.fromisoformat(transaction['timestamp'].replace('Z',
+            ''))
+
+        if current_time is None:
+            current_time = datetime.utcnow()
+        time_diff = current_time - transaction_time
+
+        if transaction_time > current_time:
+            errors.append({
+                "code" : "ERR_TIME",
+                "message" : f'Transaction time is in the future. Transaction time: {transaction_time}, Current time: {current_time}'
+            })
+
+        elif time_diff > timedelta(days = 1):
+            errors.append({
+                "code" : "ERR_TIME",
+                "message" : f'Transaction time is older than 24 hours. Transaction time: {transaction_time}, Current time: {current_time}'
+            })
+    except Exception as e:
+        errors.append({
+            "code" : "ERR_TIME",
+            "message" : f'Invalid timestamp format: {e}'
+        })
+
+def validate_device(transaction):
+    if transaction['payment_method'] == 'mobile':
+        if 'device_info' not in transaction or transaction['device_info'].get('os') not in ['iOS', 'Android']:
+            return False
+    return True
+
+
+def validate_transaction(transaction, current_time = None):
+    errors = []
+
+    total_amount_expected, is_amount_validated = validate_amount(transaction)
+
+    if not is_amount_validated:
+        errors.append({
+            "code" : "ERR_AMOUNT",
+            "message" : f'Total amount mismatch. Expected {total_amount_expected}, got {transaction["total_amount"]}'
+        }
+        )
+
+    validate_time(transaction, errors, current_time)
+
+    is_device_valid = validate_device(transaction)
+    if not is_device_valid:
+        errors.append({
+            "code" : "ERR_DEVICE",
+            "message" : f'Invalid device information for payment method {transaction["payment_method"]}'
+        })
+    return errors
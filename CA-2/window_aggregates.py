@@ -0,0 +1,210 @@
+from datetime import timedelta
+import logging
+import math
+import os
+
+from columnar_validator import parse_timestamps
+from darooghe_codec import encode
+from fraud_features import EPOCH, event_seconds
+
+
+AGGREGATES_TOPIC = 'darooghe.window_aggregates'
+DIMENSIONS = ('merchant_id', 'merchant_category', 'commission_type', 'payment_method')
+FIELDS = ('count', 'approved', 'amount', 'commission', 'vat')
+
+WINDOW_SIZE = float(os.getenv('WINDOW_SIZE', 300))
+WINDOW_HOP = float(os.getenv('WINDOW_HOP', WINDOW_SIZE))  # equal to WINDOW_SIZE: tumbling windows
+WINDOW_LATENESS = float(os.getenv('WINDOW_LATENESS', 60))
+
+
+def window_starts(time, size, hop):
+    # Starts of every window [start, start + size) containing time; starts are multiples of hop
+    start = math.floor(time / hop) * hop
+    starts = []
+    while start > time - size:
+        starts.append(start)
+        start -= hop
+    return starts
+
+
+def event_times(transactions):
+    epoch_us, needs_fallback = parse_timestamps([t['timestamp'] for t in transactions])
+    times = (epoch_us / 1e6).tolist()
+    for i in needs_fallback.nonzero()[0].tolist():
+        try:
+            times[i] = event_seconds(transactions[i]['timestamp'])
+        except (TypeError, ValueError, AttributeError):
+            times[i] = None
+    return times
+
+
+def isoformat(seconds):
+    return (EPOCH + timedelta(seconds = seconds)).isoformat() + 'Z'
+
+
+class WindowAggregator:
+    # Per-window totals for each value of each dimension. A window closes once the watermark (the
+    # newest event time minus `lateness`) passes its end; events for closed windows are counted as
+    # late and left out of them. Memory grows with the number of open windows and distinct dimension values,
+    # never with the number of events.
+    name = 'window_aggregates'
+
+    def __init__(self, size = WINDOW_SIZE, hop = WINDOW_HOP, lateness = WINDOW_LATENESS):
+        if hop <= 0 or hop > size:
+            raise ValueError(f"Window hop must be in (0, {size}], got {hop}")
+        self.size = size
+        self.hop = hop
+        self.lateness = lateness
+        # window start -> dimension -> value -> [count, approved, amount, commission, vat]
+        self.windows = {}
+        self.max_time = -math.inf
+        self.watermark = -math.inf
+        self.late = 0
+        self.closed = 0
+        self.partition = None
+
+    def assign(self, topic, partition):
+        # Results name the partition they cover: each partition publishes its own partial windows
+        self.partition = partition
+
+    def add(self, time, transaction):
+        # Late events still count towards the windows that are open; `late` counts events that missed any
+        starts = window_starts(time, self.size, self.hop)
+        if starts[-1] + self.size <= self.watermark:
+            self.late += 1
+            starts = [start for start in starts if start + self.size > self.watermark]
+            if not starts:
+                return False
+        approved = transaction.get('status') == 'approved'
+        amount = transaction.get('amount') or 0
+        commission = transaction.get('commission_amount') or 0
+        vat = transaction.get('vat_amount') or 0
+        for start in starts:
+            window = self.windows.get(start)
+            if window is None:
+                window = self.windows[start] = {dimension: {} for dimension in DIMENSIONS}
+            for dimension in DIMENSIONS:
+                values = window[dimension]
+                key = transaction.get(dimension)
+                totals = values.get(key)
+                if totals is None:
+                    values[key] = [1, int(approved), amount, commission, vat]
+                else:
+                    totals[0] += 1
+                    totals[1] += approved
+                    totals[2] += amount
+                    totals[3] += commission
+                    totals[4] += vat
+        if time > self.max_time:
+            self.max_time = time
+        return True
+
+    def advance(self):
+        # Moves the watermark and returns the results of the windows it closed, oldest first
+        self.watermark = max(self.watermark, self.max_time - self.lateness)
+        return self.close_windows(lambda start: start + self.size <= self.watermark)
+
+    def flush(self):
+        # Closes every open window, e.g. at the end of a finite replay
+        return self.close_windows(lambda start: True)
+
+    def close_windows(self, due):
+        results = []
+        for start in sorted(start for start in self.windows if due(start)):
+            results.append(self.result(start, self.windows.pop(start)))
+        self.closed += len(results)
+        return results
+
+    def result(self, start, window):
+        dimensions = {}
+        for dimension, values in window.items():
+            dimensions[dimension] = {
+                str(key): {**dict(zip(FIELDS, totals)), 'approval_rate': round(totals[1] / totals[0], 4)}
+                for key, totals in values.items()
+            }
+        return {
+            "window_start": isoformat(start),
+            "window_end": isoformat(start + self.size),
+            "partition": self.partition,
+            "watermark": isoformat(self.watermark) if math.isfinite(self.watermark) else None,
+            "count": sum(totals[0] for totals in window[DIMENSIONS[0]].values()),
+            "dimensions": dimensions,
+        }
+
+    def aggregate(self, transactions):
+        for transaction, time in zip(transactions, event_times(transactions)):
+            if time is not None:
+                self.add(time, transaction)
+        return self.advance()
+
+    def process(self, transactions, producer):
+        results = self.aggregate(transactions)
+        for result in results:
+            publish_window(producer, result)
+        if results:
+            logging.debug(f"{len(results)} windows closed, {len(self.windows)} open, {self.late} late events")
+        return len(results)
+
+    def get_state(self):
+        return {
+            "windows": self.windows,
+            "max_time": self.max_time,
+            "watermark": self.watermark,
+            "late": self.late,
+            "closed": self.closed,
+        }
+
+    def set_state(self, snapshot):
+        self.windows = snapshot["windows"]
+        self.max_time = snapshot["max_time"]
+        self.watermark = snapshot["watermark"]
+        self.late = snapshot["late"]
+        self.closed = snapshot["closed"]
+
+
+def merge_windows(results):
+    # Combines the partial results of each window (one per partition) into one result per window:
+    # totals add up across partitions and approval rates are recomputed from them
+    merged = {}
+    for result in results:
+        window = merged.get(result['window_start'])
+        if window is None:
+            window = merged[result['window_start']] = {
+                "window_start": result['window_start'],
+                "window_end": result['window_end'],
+                "partitions": [],
+                "count": 0,
+                "dimensions": {dimension: {} for dimension in DIMENSIONS},
+            }
+        window["partitions"].append(result['partition'])
+        window["count"] += result['count']
+        for dimension, values in result['dimensions'].items():
+            merged_values = window["dimensions"].setdefault(dimension, {})
+            for key, stats in values.items():
+                totals = merged_values.get(key)
+                if totals is None:
+                    merged_values[key] = {field: stats[field] for field in FIELDS}
+                else:
+                    for field in FIELDS:
+                        totals[field] += stats[field]
+    for window in merged.values():
+        for values in window["dimensions"].values():
+            for stats in values.values():
+                stats['approval_rate'] = round(stats['approved'] / stats['count'], 4)
+    return [merged[start] for start in sorted(merged)]
+
+
+def window_key(result):
+    # One message per window and partition; partials of a window share the "<window_start>/" prefix
+    if result['partition'] is None:
+        return result['window_start']
+    return f"{result['window_start']}/{result['partition']}"
+
+
+def publish_window(producer, result):
+    while True:
+        try:
+            producer.produce(AGGREGATES_TOPIC, key = window_key(result), value = encode(result))
+            return
+        except BufferError:
+            producer.poll(0.5)
@@ -1,6 +1,76 @@
-import subprocess
+import argparse
+import os
+import sys
 
-subprocess.run(["python", "scripts/import_to_db.py"])
-subprocess.run(["python", "scripts/load_data.py"])
-subprocess.run(["python", "scripts/preprocess.py"])
-subprocess.run(["python", "scripts/feature_engineering.py"])
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+from config import TXT, RAW_DATA_CSV, PREPROCESSED_CSV, FEATURE_ENGINEERED_CSV, TFIDF_DIR, STAGE_CACHE, STAGE_CACHE_MB
+from stage_graph import StageGraph, StageError
+from stage_cache import StageCache
+from feature_store import TfidfWriter, MAX_FEATURES
+import feature_store
+import import_to_db
+import load_data
+import preprocess
+import normalizer
+import feature_engineering
+
+INTERMEDIATES = {"raw": RAW_DATA_CSV, "preprocessed": PREPROCESSED_CSV}
+
+
+def build_graph(text=TXT, chunksize=load_data.CHUNK_SIZE, materialize=(), output=FEATURE_ENGINEERED_CSV,
+                cache=None, force=False, tfidf="vocabulary", tfidf_dir=TFIDF_DIR):
+    def import_stage():
+        import_to_db.import_text_to_db(text)
+
+    graph = StageGraph(cache, force)
+    graph.add("import_to_db", import_stage, up_to_date=lambda: import_to_db.is_up_to_date(text))
+    graph.add("load_data", lambda: load_data.iter_chunks(chunksize), code=[load_data],
+              fingerprint=load_data.table_fingerprint,
+              materialize=RAW_DATA_CSV if "raw" in materialize else None)
+    graph.add("preprocess", preprocess.preprocess_chunk, input="load_data", code=[preprocess, normalizer],
+              reads=["line"], writes=["clean_line"],
+              materialize=PREPROCESSED_CSV if "preprocessed" in materialize else None, index=True)
+    graph.add("feature_engineering", feature_engineering.feature_engineering, input="preprocess",
+              code=[feature_engineering], reads=["clean_line"], writes=["line_length"], materialize=output)
+    if tfidf != "none":
+        graph.add("tfidf", lambda chunk: chunk, input="feature_engineering", code=[feature_store],
+                  params={"mode": tfidf, "max_features": MAX_FEATURES},
+                  materialize=TfidfWriter(tfidf_dir, "clean_line", mode=tfidf))
+    return graph
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Phase 2 stages in one process")
+    parser.add_argument("--text", default=TXT)
+    parser.add_argument("--chunk-size", type=int, default=load_data.CHUNK_SIZE)
+    parser.add_argument("--materialize", nargs="*", choices=sorted(INTERMEDIATES), default=[],
+                        help="also write these intermediate stages to their CSVs")
+    parser.add_argument("--output", default=FEATURE_ENGINEERED_CSV)
+    parser.add_argument("--tfidf", choices=["vocabulary", "hashing", "none"], default="vocabulary",
+                        help="TF-IDF features: top terms like TfidfVectorizer, or hashed terms without a vocabulary")
+    parser.add_argument("--tfidf-dir", default=TFIDF_DIR)
+    parser.add_argument("--cache", default=STAGE_CACHE)
+    parser.add_argument("--cache-mb", type=int, default=STAGE_CACHE_MB, help="size bound of the stage cache")
+    parser.add_argument("--no-cache", action="store_true", help="recompute every stage, without the stage cache")
+    parser.add_argument("--force", action="store_true", help="recompute every stage and refresh the stage cache")
+    parser.add_argument("--dry-run", action="store_true", help="only show which stages would run")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else StageCache(args.cache, args.cache_mb << 20)
+    graph = build_graph(args.text, args.chunk_size, args.materialize, args.output, cache, args.force,
+                        args.tfidf, args.tfidf_dir)
+    try:
+        if args.dry_run:
+            for name, status in graph.plan():
+                print(f"{name:<22}{status}")
+            sys.exit(0)
+        graph.run()
+    except StageError as e:
+        print(e, file=sys.stderr)
+        print(graph.report(), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if cache:
+            cache.close()
+    print(graph.report())
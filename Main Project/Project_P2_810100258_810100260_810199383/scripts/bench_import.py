@@ -0,0 +1,93 @@
+"""Compare the streaming import with the old list-based one and check re-runs.
+
+The corpus is `--copies` concatenated copies of the book. Each import runs in its own
+process, so the reported peak RSS belongs to that import alone; the streaming import's
+should stay flat as the corpus grows. A re-run of an unchanged file must import nothing,
+and after appending to the file only the new lines may be imported.
+
+    python bench_import.py --copies 1 10 50
+"""
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+BOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Phase 1", "Database Assets", "David_Copperfield.txt")
+
+
+def old_import(text_file_path, database):
+    # The previous import_to_db: the whole file as a list, one executemany, default journaling
+    conn = sqlite3.connect(database)
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS book_lines (id INTEGER PRIMARY KEY AUTOINCREMENT, line TEXT NOT NULL)")
+    with open(text_file_path, encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    cursor.executemany("INSERT INTO book_lines (line) VALUES (?)", [(line,) for line in lines])
+    conn.commit()
+    conn.close()
+    return len(lines)
+
+
+def run_import(mode, corpus, database):
+    # Runs one import in a child process and returns (rows, seconds, peak RSS in MB)
+    code = (
+        "import sys, time, resource, contextlib, io\n"
+        "import bench_import, import_to_db\n"
+        "start = time.perf_counter()\n"
+        "with contextlib.redirect_stdout(io.StringIO()):\n"
+        f"    rows = bench_import.old_import(sys.argv[1], sys.argv[2]) if {mode == 'old'} else import_to_db.import_text_to_db(sys.argv[1], sys.argv[2])\n"
+        "print(rows, time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)\n"
+    )
+    out = subprocess.run([sys.executable, "-c", code, corpus, database], check=True, capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    return int(out[0]), float(out[1]), float(out[2])
+
+
+def make_corpus(path, book, copies):
+    with open(path, "wb") as out:
+        for _ in range(copies):
+            out.write(book)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--book", default=BOOK)
+    args = parser.parse_args()
+    with open(args.book, "rb") as f:
+        book = f.read().rstrip(b"\n") + b"\n"  # Copies must not run into each other's first line
+
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = os.path.join(directory, "corpus.txt")
+        for copies in args.copies:
+            make_corpus(corpus, book, copies)
+            size = os.path.getsize(corpus) / 1e6
+            results = {}
+            for mode in ("old", "new"):
+                database = os.path.join(directory, f"{mode}-{copies}.db")
+                results[mode] = run_import(mode, corpus, database)
+                rows, elapsed, rss = results[mode]
+                print(f"{copies:>4} copies ({size:7.1f} MB) {mode}: {rows:>10,} rows in {elapsed:6.2f}s, "
+                      f"{rows / elapsed:9,.0f} rows/s, peak RSS {rss:6.1f} MB")
+            ok = results["old"][0] == results["new"][0] and ok
+
+            database = os.path.join(directory, f"new-{copies}.db")
+            rows, elapsed, _ = run_import("new", corpus, database)
+            print(f"{'':>26}re-run: {rows:>10,} rows in {elapsed:6.2f}s")
+            ok = rows == 0 and ok
+            with open(corpus, "ab") as out:
+                out.write(book)
+            rows, elapsed, _ = run_import("new", corpus, database)
+            print(f"{'':>22}appended copy: {rows:>10,} rows in {elapsed:6.2f}s")
+            ok = rows == results["new"][0] // copies and ok
+            conn = sqlite3.connect(database)
+            stored, unique = conn.execute("SELECT COUNT(*), COUNT(DISTINCT line_no) FROM book_lines").fetchone()
+            conn.close()
+            ok = stored == unique == results["new"][0] // copies * (copies + 1) and ok
+            os.remove(os.path.join(directory, f"old-{copies}.db"))
+            os.remove(database)
+    if not ok:
+        raise SystemExit(1)
@@ -0,0 +1,92 @@
+"""Compare the chunked book_lines reader with the old single read_sql_query.
+
+Builds a database of `--rows` lines (the book's lines repeated) for every size and reads it
+in its own process, so the reported peak RSS is the reader's alone:
+
+    old     SELECT * FROM book_lines into one DataFrame, as load_data used to
+    stream  load_data.iter_chunks, keeping nothing but the row count
+
+The stream's peak RSS should stay flat from the smallest to the largest table. The old read
+is only run up to `--old-max` rows, as it needs memory for the whole table.
+
+    python bench_load.py --rows 10000 100000 1000000 10000000
+"""
+import argparse
+import itertools
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+from import_to_db import create_tables
+
+BOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Phase 1", "Database Assets", "David_Copperfield.txt")
+BATCH = 100000
+
+
+def make_database(path, lines, rows):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    create_tables(conn)
+    conn.execute("INSERT INTO sources (path, bytes, lines, sha256, size, mtime_ns) VALUES ('bench', 0, ?, '', 0, 0)", (rows,))
+    numbered = ((1, n + 1, line) for n, line in enumerate(itertools.islice(itertools.cycle(lines), rows)))
+    while True:
+        batch = list(itertools.islice(numbered, BATCH))
+        if not batch:
+            break
+        conn.executemany("INSERT INTO book_lines (source_id, line_no, line) VALUES (?, ?, ?)", batch)
+    conn.commit()
+    conn.close()
+
+
+def run_read(mode, database, chunksize):
+    # Reads the table in a child process and returns (rows, seconds, peak RSS in MB)
+    code = (
+        "import sys, time, resource, sqlite3\n"
+        "import pandas as pd, load_data\n"
+        "start = time.perf_counter()\n"
+        f"if {mode == 'old'}:\n"
+        "    conn = sqlite3.connect(sys.argv[1])\n"
+        "    rows = len(pd.read_sql_query('SELECT * FROM book_lines', conn))\n"
+        "    conn.close()\n"
+        "else:\n"
+        "    rows = sum(len(chunk) for chunk in load_data.iter_chunks(int(sys.argv[2]), sys.argv[1]))\n"
+        "print(rows, time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)\n"
+    )
+    out = subprocess.run([sys.executable, "-c", code, database, str(chunksize)], check=True, capture_output=True,
+                         text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    return int(out[0]), float(out[1]), float(out[2])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000, 10000000])
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    parser.add_argument("--old-max", type=int, default=1000000)
+    parser.add_argument("--book", default=BOOK)
+    args = parser.parse_args()
+
+    with open(args.book, encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    ok = True
+    stream_rss = []
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.rows:
+            database = os.path.join(directory, f"bench_{rows}.db")
+            make_database(database, lines, rows)
+            print(f"{rows:>10,} rows, database {os.path.getsize(database) / 1e6:.0f} MB")
+            for mode in ("old", "stream"):
+                if mode == "old" and rows > args.old_max:
+                    print(f"{'':>6}{mode:<8}skipped (--old-max {args.old_max:,})")
+                    continue
+                count, seconds, rss = run_read(mode, database, args.chunk_size)
+                print(f"{'':>6}{mode:<8}{seconds:8.2f}s, {count / seconds:12,.0f} rows/s, peak RSS {rss:7.1f} MB")
+                ok = ok and count == rows
+                if mode == "stream":
+                    stream_rss.append(rss)
+            os.remove(database)
+    print(f"stream peak RSS from {min(stream_rss):.1f} to {max(stream_rss):.1f} MB")
+    if not ok:
+        raise SystemExit(1)
@@ -0,0 +1,66 @@
+"""Compare normalizer.normalize_column with preprocess_text applied row by row.
+
+The corpus is the book's non-blank lines replicated `--copies` times. Every mode must
+return exactly what preprocess_text returns; so must normalize() for every Unicode
+code point, checked first. Reported: lines/s of the best of `--repeat` runs.
+
+    python bench_normalize.py --copies 1 10 100 --workers 4
+"""
+import argparse
+import os
+import time
+
+import pandas as pd
+
+from normalizer import normalize_column, normalize_lines
+from preprocess import preprocess_text
+
+BOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Phase 1", "Database Assets", "David_Copperfield.txt")
+
+
+def check_code_points():
+    texts = [f"A b{chr(i)}C {chr(i)}\t{chr(i)}" for i in range(0x110000)]
+    expected = [preprocess_text(text) for text in texts]
+    mismatches = [hex(i) for i, (a, b) in enumerate(zip(normalize_lines(texts), expected)) if a != b]
+    print(f"code points: {len(mismatches)} mismatches {mismatches[:10]}")
+    return not mismatches
+
+
+def best(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--book", default=BOOK)
+    args = parser.parse_args()
+    with open(args.book, encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    ok = check_code_points()
+    modes = {
+        "apply(preprocess_text)": lambda s: s.apply(preprocess_text),
+        "normalize_column": lambda s: normalize_column(s, workers=1),
+        f"normalize_column, {args.workers} workers": lambda s: normalize_column(s, workers=args.workers, min_parallel=0),
+    }
+    for copies in args.copies:
+        series = pd.Series(lines * copies)
+        expected = None
+        for name, fn in modes.items():
+            seconds, result = best(lambda: fn(series), args.repeat)
+            if expected is None:
+                expected = result
+            same = result.tolist() == expected.tolist()
+            ok = same and ok
+            print(f"{copies:>4} copies, {len(series):>9,} lines, {name:<32}: {len(series) / seconds:>11,.0f} lines/s"
+                  + ("" if same else "  OUTPUT DIFFERS"))
+    if not ok:
+        raise SystemExit(1)
@@ -0,0 +1,72 @@
+"""Compare the in-process stage graph with the old pipeline of four scripts.
+
+The old pipeline runs import_to_db, load_data, preprocess and feature_engineering as
+separate interpreters that hand data over through CSVs; pipeline.py runs the same stages
+in one process and passes chunks between them. Both run on `--copies` concatenated
+copies of the book, against a fresh database and stage cache each time, and must
+produce the same features. Reported: median wall time over `--repeat` runs.
+
+    python bench_pipeline.py --copies 1 10 --repeat 3
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+PIPELINE = os.path.join(SCRIPTS, "..", "pipeline.py")
+STAGES = ["import_to_db.py", "load_data.py", "preprocess.py", "feature_engineering.py"]
+BOOK = os.path.join(SCRIPTS, "..", "..", "Phase 1", "Database Assets", "David_Copperfield.txt")
+
+
+def run_old(workdir, env):
+    for script in STAGES:
+        subprocess.run([sys.executable, os.path.join(SCRIPTS, script)], cwd=workdir, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+
+
+def run_new(workdir, env):
+    subprocess.run([sys.executable, PIPELINE], cwd=workdir, env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def timed(run, workdir, env):
+    for directory in ("database", "cache"):
+        shutil.rmtree(os.path.join(workdir, directory), ignore_errors=True)
+    start = time.perf_counter()
+    run(workdir, env)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--book", default=BOOK)
+    args = parser.parse_args()
+    with open(args.book, "rb") as f:
+        book = f.read().rstrip(b"\n") + b"\n"
+
+    ok = True
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, DATA_DIR=workdir)
+        features = os.path.join(workdir, "feature_engineered_data.csv")
+        for copies in args.copies:
+            with open(os.path.join(workdir, "David_Copperfield.txt"), "wb") as out:
+                for _ in range(copies):
+                    out.write(book)
+            results = {}
+            for name, run in (("old", run_old), ("new", run_new)):
+                seconds = statistics.median(timed(run, workdir, env) for _ in range(args.repeat))
+                results[name] = pd.read_csv(features, keep_default_na=False)[["id", "clean_line", "line_length"]]
+                print(f"{copies:>4} copies {name}: {seconds:6.2f}s, {len(results[name]):,} rows")
+            same = results["old"].equals(results["new"])
+            print(f"{'':>12}same features: {same}")
+            ok = same and ok
+    if not ok:
+        raise SystemExit(1)
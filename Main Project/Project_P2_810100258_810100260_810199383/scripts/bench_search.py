@@ -0,0 +1,89 @@
+"""Compare full-text queries on book_lines_fts with a pandas str.contains scan of the lines.
+
+The corpus is `--copies` concatenated copies of the book, imported with import_to_db (which
+builds the index). For every query the index is asked for the number of matching lines and
+for the best `--limit` lines by BM25 with snippets; the scan is str.contains over the lines
+already loaded into a DataFrame, with a regex that matches what the tokenizer matches. Both
+must find the same number of lines. Times are the median of `--repeat` runs.
+
+    python bench_search.py --copies 10 100
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import time
+
+import pandas as pd
+
+from database_connection import get_connection
+from import_to_db import import_text_to_db
+from search import LineSearch, phrase_query, prefix_query, term_query
+
+BOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Phase 1", "Database Assets", "David_Copperfield.txt")
+QUERIES = [
+    ("term", "micawber", term_query("micawber"), r"\bmicawber\b"),
+    ("term", "umbrella", term_query("umbrella"), r"\bumbrella\b"),
+    ("phrase", "my aunt", phrase_query("my aunt"), r"\bmy\W+aunt\b"),
+    ("phrase", "said mr micawber", phrase_query("said mr micawber"), r"\bsaid\W+mr\W+micawber\b"),
+    ("prefix", "murdst*", prefix_query("murdst"), r"\bmurdst"),
+]
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--book", default=BOOK)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.book, "rb") as f:
+        book = f.read()
+    if not book.endswith(b"\n"):
+        book += b"\n"
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        for copies in args.copies:
+            corpus = os.path.join(directory, "corpus.txt")
+            database = os.path.join(directory, f"bench_{copies}.db")
+            with open(corpus, "wb") as out:
+                for _ in range(copies):
+                    out.write(book)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                rows = import_text_to_db(corpus, database)
+            imported = time.perf_counter() - start
+            conn = get_connection(database)
+            lines = pd.read_sql_query("SELECT line FROM book_lines", conn)["line"]
+            conn.close()
+            print(f"{copies:>4} copies: {rows:,} lines, import with index {imported:.2f}s, "
+                  f"database {os.path.getsize(database) / 1e6:.0f} MB")
+            print(f"{'':>6}{'query':<26}{'lines':>9}{'count':>10}{'top':>10}{'scan':>10}{'speedup':>9}")
+            search = LineSearch(database)
+            for mode, text, match, pattern in QUERIES:
+                count, count_seconds = timed(lambda: search.count(match), args.repeat)
+                _, top_seconds = timed(lambda: search.search(match, args.limit), args.repeat)
+                found, scan_seconds = timed(lambda: int(lines.str.contains(pattern, case=False, regex=True).sum()),
+                                            args.repeat)
+                label = f"{mode} '{text}'"
+                print(f"{'':>6}{label:<26}{count:>9,}{count_seconds * 1000:>8.1f}ms{top_seconds * 1000:>8.1f}ms"
+                      f"{scan_seconds * 1000:>8.1f}ms{scan_seconds / top_seconds:>8.0f}x")
+                if count != found:
+                    print(f"{'':>8}the scan found {found:,} lines")
+                    ok = False
+            search.close()
+            os.remove(database)
+    if not ok:
+        raise SystemExit(1)
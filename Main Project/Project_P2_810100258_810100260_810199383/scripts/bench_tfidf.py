@@ -0,0 +1,107 @@
+"""Compare the TF-IDF feature store with re-fitting TfidfVectorizer from the features CSV.
+
+The corpus is the book's cleaned lines replicated `--copies` times, written as a features
+CSV like feature_engineering's. Each mode runs in its own process (so the peak RSS is its
+own) and reports:
+
+    refit       read the CSV, TfidfVectorizer(max_features=100).fit_transform
+    vocabulary  stream the CSV in chunks into a store with the same vocabulary
+    hashing     stream the CSV in chunks into a store of hashed terms
+    load        open the vocabulary store and sum every row of its memory-mapped matrix
+
+The vocabulary store must match the refit matrix (max abs difference ~1e-16).
+
+    python bench_tfidf.py --copies 1 10 50
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from feature_store import FeatureStore, TfidfBuilder
+from normalizer import normalize_lines
+
+BOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Phase 1", "Database Assets", "David_Copperfield.txt")
+CHUNK_SIZE = 50000
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def run(mode, csv, store):
+    start = time.perf_counter()
+    result = {}
+    if mode == "refit":
+        texts = pd.read_csv(csv, keep_default_na=False)["clean_line"].tolist()
+        matrix = TfidfVectorizer(max_features=100).fit_transform(texts)
+        result["nnz"] = matrix.nnz
+    elif mode in ("vocabulary", "hashing"):
+        builder = TfidfBuilder(store + "-" + mode, mode=mode)
+        for chunk in pd.read_csv(csv, keep_default_na=False, usecols=["clean_line"], chunksize=CHUNK_SIZE):
+            builder.add(chunk["clean_line"].tolist())
+        result["nnz"] = builder.finish().meta["nnz"]
+        result["bytes"] = directory_size(store + "-" + mode)
+    elif mode == "load":
+        features = FeatureStore(store + "-vocabulary")
+        features.rows(0, 1).toarray()
+        result["first_row_seconds"] = time.perf_counter() - start
+        result["nnz"] = int((features.matrix().sum(axis=1) > 0).sum())
+    result["seconds"] = time.perf_counter() - start
+    result["rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def in_child(mode, csv, store):
+    out = subprocess.run([sys.executable, __file__, "--run", mode, csv, store], check=True, capture_output=True,
+                         text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(out)
+
+
+def check(csv, store):
+    texts = pd.read_csv(csv, keep_default_na=False)["clean_line"].tolist()
+    vectorizer = TfidfVectorizer(max_features=100)
+    expected = vectorizer.fit_transform(texts)
+    features = FeatureStore(store + "-vocabulary")
+    same_vocabulary = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get) == features.vocabulary
+    return same_vocabulary, abs(features.matrix() - expected).max()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--book", default=BOOK)
+    parser.add_argument("--run", nargs=3, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        print(json.dumps(run(*args.run)))
+        raise SystemExit(0)
+
+    with open(args.book, encoding="utf-8") as f:
+        lines = [line for line in normalize_lines([line.strip() for line in f if line.strip()]) if line]
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        csv = os.path.join(directory, "features.csv")
+        store = os.path.join(directory, "tfidf")
+        for copies in args.copies:
+            df = pd.DataFrame({"clean_line": lines * copies})
+            df["line_length"] = df["clean_line"].str.len()
+            df.to_csv(csv, index=False)
+            print(f"{copies:>4} copies: {len(df):,} lines, CSV {os.path.getsize(csv) / 1e6:.1f} MB")
+            for mode in ("refit", "vocabulary", "hashing", "load"):
+                result = in_child(mode, csv, store)
+                size = f", on disk {result['bytes'] / 1e6:7.1f} MB" if "bytes" in result else ""
+                opened = f" (first row after {result['first_row_seconds'] * 1000:.1f} ms)" if mode == "load" else ""
+                print(f"{'':>6}{mode:<11}{result['seconds']:8.3f}s{opened}, peak RSS {result['rss_mb']:6.1f} MB{size}")
+            same_vocabulary, difference = check(csv, store)
+            print(f"{'':>6}same vocabulary: {same_vocabulary}, max abs difference {difference:.1e}")
+            ok = ok and same_vocabulary and difference < 1e-12
+    if not ok:
+        raise SystemExit(1)
@@ -2,10 +2,12 @@ import sqlite3
 import os
 from config import DATABASE
 
-def get_connection():
-    if not os.path.exists(DATABASE):
-        raise Exception(f"Database at {DATABASE} does not exist!")
-    conn = sqlite3.connect(DATABASE)
+def get_connection(database=DATABASE, create=False):
+    if create:
+        os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+    elif not os.path.exists(database):
+        raise Exception(f"Database at {database} does not exist!")
+    conn = sqlite3.connect(database)
     return conn
 
 
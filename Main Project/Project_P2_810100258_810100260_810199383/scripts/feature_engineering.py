@@ -1,24 +1,24 @@
 import pandas as pd
-import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from config import PREPROCESSED_CSV,FEATURE_ENGINEERED_CSV
-def feature_engineering(df):
-    
-    df['line_length'] = df['clean_line'].apply(len)
+from config import PREPROCESSED_CSV,FEATURE_ENGINEERED_CSV,TFIDF_DIR
+from feature_store import TfidfBuilder
 
-    vectorizer = TfidfVectorizer(max_features=100)
-    # tfidf_matrix = vectorizer.fit_transform(df['clean_line'])
+CHUNK_SIZE = 50000
 
-    # with open("E:/403-2/DS/Data-Science-Course-spring2025/Main Project/Phase 1/Database Assets/tfidf_vectorizer.pkl", "wb") as f:
-    #     pickle.dump(vectorizer, f)
-    # with open("E:/403-2/DS/Data-Science-Course-spring2025/Main Project/Phase 1/Database Assets/tfidf_features.pkl", "wb") as f:
-    #     pickle.dump(tfidf_matrix, f)
+def feature_engineering(df):
+    
+    df['line_length'] = df['clean_line'].str.len()
 
     return df
 
+def build_tfidf(texts, path=TFIDF_DIR, mode="vocabulary", chunksize=CHUNK_SIZE):
+    builder = TfidfBuilder(path, mode=mode)
+    for start in range(0, len(texts), chunksize):
+        builder.add(texts[start:start + chunksize])
+    return builder.finish()
+
 if __name__ == "__main__":
     df = pd.read_csv(PREPROCESSED_CSV)
     df =feature_engineering(df)
     df.to_csv(FEATURE_ENGINEERED_CSV, index=False)
-    print("Feature engineering completed and saved.")
-
+    store = build_tfidf(df['clean_line'].tolist())
+    print(f"Feature engineering completed and saved, TF-IDF matrix {store.shape} in {TFIDF_DIR}.")
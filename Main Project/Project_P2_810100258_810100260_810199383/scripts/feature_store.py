@@ -0,0 +1,246 @@
+import json
+import os
+import shutil
+from collections import Counter
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer, TfidfVectorizer
+
+MAX_FEATURES = 100
+HASH_FEATURES = 1 << 20
+BLOCK_ROWS = 100000  # Rows rewritten at a time when finishing the matrix
+ARRAYS = ("data", "indices", "indptr")
+
+# A TF-IDF matrix kept on disk as CSR: data.bin, indices.bin and indptr.bin are raw arrays that are
+# memory-mapped on load, next to meta.json (shape, dtypes, parameters, vocabulary) and idf.npy.
+# The text is read once: add() appends the term counts of every chunk of documents to the files,
+# finish() then keeps the top `max_features` terms (vocabulary mode), counts document frequencies
+# and applies idf and l2 normalization, a block of rows at a time. The
+# result matches TfidfVectorizer(max_features=...).fit_transform on the whole corpus, without ever
+# holding the corpus or the matrix in memory. Hashing mode skips the vocabulary: terms go to
+# HashingVectorizer columns, so nothing corpus-wide but the document frequencies is kept.
+
+
+def index_dtype(n):
+    return np.int32 if n < 2 ** 31 else np.int64
+
+
+def open_array(path, dtype, mode="r"):
+    # np.memmap cannot map an empty file
+    return np.memmap(path, dtype, mode) if os.path.getsize(path) else np.zeros(0, dtype)
+
+
+class TfidfBuilder:
+    def __init__(self, path, mode="vocabulary", max_features=MAX_FEATURES, n_features=HASH_FEATURES):
+        if mode not in ("vocabulary", "hashing"):
+            raise ValueError(f"Unknown TF-IDF mode '{mode}'")
+        self.path = path
+        self.mode = mode
+        self.max_features = max_features
+        self.n_features = n_features
+        self.tmp = path + ".partial"
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.makedirs(self.tmp)
+        self.files = {name: open(os.path.join(self.tmp, f"{name}.bin"), "wb") for name in ARRAYS}
+        self.files["indptr"].write(np.zeros(1, np.int64).tobytes())
+        self.rows = 0
+        self.nnz = 0
+        if mode == "hashing":
+            self.hasher = HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None)
+        else:
+            self.analyzer = TfidfVectorizer().build_analyzer()
+            self.vocabulary = {}
+            self.term_counts = np.zeros(0, np.int64)
+
+    def counts(self, texts):
+        # CSR term counts of a chunk, in this builder's (growing) column space
+        if self.mode == "hashing":
+            return self.hasher.transform(texts)
+        vocabulary, analyzer = self.vocabulary, self.analyzer
+        indices, data, indptr = [], [], [0]
+        for text in texts:
+            counter = Counter(analyzer(text))
+            indices.extend(vocabulary.setdefault(term, len(vocabulary)) for term in counter)
+            data.extend(counter.values())
+            indptr.append(len(indices))
+        return sp.csr_matrix((np.asarray(data, np.int64), np.asarray(indices, np.int64), np.asarray(indptr, np.int64)),
+                             shape=(len(indptr) - 1, len(vocabulary)))
+
+    def add(self, texts):
+        x = self.counts(texts)
+        if self.mode == "vocabulary":
+            grown = np.zeros(len(self.vocabulary), np.int64)
+            grown[:len(self.term_counts)] = self.term_counts
+            self.term_counts = grown + np.bincount(x.indices, weights=x.data, minlength=len(self.vocabulary)).astype(np.int64)
+        self.files["data"].write(x.data.astype(np.float64).tobytes())
+        self.files["indices"].write(x.indices.astype(np.int64).tobytes())
+        self.files["indptr"].write((x.indptr[1:].astype(np.int64) + self.nnz).tobytes())
+        self.rows += x.shape[0]
+        self.nnz += x.nnz
+
+    def select_columns(self):
+        # Maps every counted term to its final column (or -1), as TfidfVectorizer's max_features does:
+        # the most frequent terms over the corpus, ranked among the terms in alphabetical order
+        terms = sorted(self.vocabulary)
+        order = np.fromiter((self.vocabulary[term] for term in terms), np.int64, len(terms))
+        keep = np.ones(len(terms), bool)
+        if self.max_features is not None and len(terms) > self.max_features:
+            keep[:] = False
+            keep[(-self.term_counts[order]).argsort()[:self.max_features]] = True
+        remap = np.full(len(terms), -1, np.int64)
+        remap[order[keep]] = np.arange(keep.sum())
+        return remap, [term for term, kept in zip(terms, keep) if kept]
+
+    def finish(self):
+        for f in self.files.values():
+            f.close()
+        if self.mode == "vocabulary":
+            remap, vocabulary = self.select_columns()
+            n_columns = len(vocabulary)
+        else:
+            remap, vocabulary, n_columns = None, None, self.n_features
+        idx_dtype = index_dtype(max(self.nnz, n_columns))
+        nnz, document_frequency = self.rewrite(remap, n_columns, idx_dtype)
+
+        idf = np.log((1 + self.rows) / (1 + document_frequency)) + 1
+        np.save(os.path.join(self.tmp, "idf.npy"), idf)
+        meta = {"mode": self.mode, "shape": [self.rows, n_columns], "nnz": nnz, "index_dtype": np.dtype(idx_dtype).name,
+                "max_features": self.max_features, "n_features": self.n_features, "vocabulary": vocabulary}
+        with open(os.path.join(self.tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        self.normalize(idf)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp, self.path)
+        return FeatureStore(self.path)
+
+    def rewrite(self, remap, n_columns, idx_dtype):
+        # Copies the counts into the final arrays block by block, keeping only the selected columns
+        # (under their new indices), and counts document frequencies on the way
+        old = {name: open_array(os.path.join(self.tmp, f"{name}.bin"), np.float64 if name == "data" else np.int64)
+               for name in ARRAYS}
+        out = {name: open(os.path.join(self.tmp, f"{name}.final"), "wb") for name in ARRAYS}
+        out["indptr"].write(np.zeros(1, idx_dtype).tobytes())
+        nnz = 0
+        document_frequency = np.zeros(n_columns, np.int64)
+        for start in range(0, self.rows, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, self.rows)
+            begin, end = int(old["indptr"][start]), int(old["indptr"][stop])
+            indices = np.array(old["indices"][begin:end])
+            data = np.array(old["data"][begin:end])
+            row_ends = np.array(old["indptr"][start + 1:stop + 1]) - begin
+            if remap is not None:
+                indices = remap[indices]
+                kept = indices >= 0
+                row_ends = np.concatenate(([0], np.cumsum(kept)))[row_ends]
+                indices, data = indices[kept], data[kept]
+            document_frequency += np.bincount(indices, minlength=n_columns)
+            out["data"].write(data.tobytes())
+            out["indices"].write(indices.astype(idx_dtype).tobytes())
+            out["indptr"].write((row_ends + nnz).astype(idx_dtype).tobytes())
+            nnz += len(indices)
+        del old  # Unmaps the count files before they are replaced
+        for name in ARRAYS:
+            out[name].close()
+            os.replace(os.path.join(self.tmp, f"{name}.final"), os.path.join(self.tmp, f"{name}.bin"))
+        return nnz, document_frequency
+
+    def normalize(self, idf):
+        # tf * idf, then every row scaled to unit length, in place
+        data, indices, indptr = FeatureStore(self.tmp, mode="r+").arrays()
+        for start in range(0, self.rows, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, self.rows)
+            begin, end = int(indptr[start]), int(indptr[stop])
+            block = data[begin:end]
+            block *= idf[indices[begin:end]]
+            starts = np.array(indptr[start:stop]) - begin
+            starts = starts[starts < np.array(indptr[start + 1:stop + 1]) - begin]
+            if len(starts):
+                norms = np.sqrt(np.add.reduceat(block ** 2, starts))
+                block /= np.repeat(norms, np.diff(np.append(starts, end - begin)))
+            del block
+        if isinstance(data, np.memmap):
+            data.flush()
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+class FeatureStore:
+    # Read side: the arrays are memory-mapped when first used, so opening a store costs one small
+    # JSON read and rows(start, stop) only touches the pages of those rows.
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.shape = tuple(self.meta["shape"])
+        self._arrays = None
+        self._idf = None
+
+    def arrays(self):
+        if self._arrays is None:
+            index = np.dtype(self.meta["index_dtype"])
+            self._arrays = tuple(open_array(os.path.join(self.path, f"{name}.bin"), np.float64 if name == "data" else index,
+                                            self.mode) for name in ARRAYS)
+        return self._arrays
+
+    @property
+    def idf(self):
+        if self._idf is None:
+            self._idf = np.load(os.path.join(self.path, "idf.npy"))
+        return self._idf
+
+    @property
+    def vocabulary(self):
+        return self.meta["vocabulary"]
+
+    def matrix(self):
+        # The whole matrix as a csr_matrix over the memory-mapped arrays (nothing is copied)
+        data, indices, indptr = self.arrays()
+        return sp.csr_matrix((data, indices, indptr), shape=self.shape, copy=False)
+
+    def rows(self, start, stop):
+        data, indices, indptr = self.arrays()
+        stop = min(stop, self.shape[0])
+        begin, end = int(indptr[start]), int(indptr[stop])
+        return sp.csr_matrix((data[begin:end], indices[begin:end], np.asarray(indptr[start:stop + 1]) - begin),
+                             shape=(stop - start, self.shape[1]))
+
+    def transform(self, texts):
+        # TF-IDF rows for new documents, with the stored vocabulary (or hashing) and idf
+        if self.meta["mode"] == "hashing":
+            vectorizer = HashingVectorizer(n_features=self.meta["n_features"], alternate_sign=False, norm=None)
+        else:
+            vectorizer = CountVectorizer(vocabulary=self.vocabulary)
+        x = vectorizer.transform(texts).multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(x.multiply(x).sum(axis=1))).ravel()
+        norms[norms == 0] = 1
+        return sp.diags(1 / norms) @ x
+
+
+class TfidfWriter:
+    # Lets a StageGraph stage materialize its chunks' `column` into a feature store, like CsvWriter
+    def __init__(self, path, column, mode="vocabulary", max_features=MAX_FEATURES, n_features=HASH_FEATURES):
+        self.path = path
+        self.column = column
+        self.options = {"mode": mode, "max_features": max_features, "n_features": n_features}
+        self.builder = None
+        self.started = False
+        self.up_to_date = False
+
+    def write(self, df):
+        if self.builder is None:
+            self.builder = TfidfBuilder(self.path, **self.options)
+        self.builder.add(df[self.column].tolist())
+        self.started = True
+
+    def close(self, ok):
+        if self.builder is None:
+            return
+        if ok:
+            self.builder.finish()
+        else:
+            self.builder.abort()
@@ -1,27 +1,224 @@
-import pandas as pd
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
 from database_connection import get_connection
-from config import TXT
+from config import TXT, DATABASE
+import search
 
-def import_text_to_db(text_file_path):
-    conn = get_connection()
-    cursor = conn.cursor()
+BLOCK_SIZE = 4 << 20
 
-    cursor.execute('''
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",
+]
+
+INDEXES = {
+    "book_lines_source_line": "CREATE UNIQUE INDEX IF NOT EXISTS book_lines_source_line ON book_lines (source_id, line_no)",
+}
+
+INSERT_LINE = "INSERT INTO book_lines (source_id, line_no, line) VALUES (?, ?, ?)"
+
+
+def create_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sources (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            bytes INTEGER NOT NULL,
+            lines INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            imported_at TEXT
+        )
+    ''')
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS book_lines (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            line TEXT NOT NULL
+            id INTEGER PRIMARY KEY,
+            line TEXT NOT NULL,
+            source_id INTEGER REFERENCES sources (id),
+            line_no INTEGER
         )
     ''')
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(book_lines)")]
+    if "source_id" not in columns:
+        # Tables from the old import have no source, and a copy of the book for every run
+        legacy = conn.execute("SELECT COUNT(*) FROM book_lines").fetchone()[0]
+        conn.execute("ALTER TABLE book_lines ADD COLUMN source_id INTEGER REFERENCES sources (id)")
+        conn.execute("ALTER TABLE book_lines ADD COLUMN line_no INTEGER")
+        conn.execute("DELETE FROM book_lines")
+        print(f"Removed {legacy} rows without a source, they are imported again from their files.")
+    for sql in INDEXES.values():
+        conn.execute(sql)
+
+
+class LineReader:
+    # Streams a binary file in blocks and yields the (source_id, line_no, line) rows of each block's
+    # non-blank lines. Only complete lines move `offset`, `line_no` and the hash, so a last line
+    # without a newline is imported but read again on the next run, in case it is still being written.
+    def __init__(self, f, source_id, digest, offset=0, line_no=0, block_size=BLOCK_SIZE):
+        self.f = f
+        self.source_id = source_id
+        self.digest = digest
+        self.offset = offset
+        self.line_no = line_no
+        self.block_size = block_size
+
+    def rows(self, lines, start):
+        source_id = self.source_id
+        return [(source_id, line_no, line) for line_no, line in enumerate(map(str.strip, lines), start) if line]
+
+    def __iter__(self):
+        pending = b""
+        while True:
+            block = self.f.read(self.block_size)
+            if not block:
+                break
+            block = pending + block
+            end = block.rfind(b"\n") + 1
+            pending = block[end:]
+            if not end:
+                continue
+            complete = block[:end]
+            self.digest.update(complete)
+            self.offset += end
+            lines = complete.decode("utf-8").split("\n")
+            lines.pop()
+            start = self.line_no + 1
+            self.line_no += len(lines)
+            yield self.rows(lines, start)
+        if pending:
+            yield self.rows([pending.decode("utf-8")], self.line_no + 1)
+
+
+def hash_prefix(f, length, block_size=BLOCK_SIZE):
+    digest = hashlib.sha256()
+    while length > 0:
+        block = f.read(min(length, block_size))
+        if not block:
+            break
+        digest.update(block)
+        length -= len(block)
+    return digest, length == 0
+
+
+def import_source(conn, path, block_size=BLOCK_SIZE, force=False):
+    source = os.path.abspath(path)
+    stat = os.stat(path)
+    known = conn.execute("SELECT id, bytes, lines, sha256, size, mtime_ns FROM sources WHERE path = ?",
+                         (source,)).fetchone()
+    if known:
+        source_id, known = known[0], known[1:]
+        if not force and known[3] == stat.st_size and known[4] == stat.st_mtime_ns:
+            return 0, 0
+    else:
+        source_id = conn.execute("INSERT INTO sources (path, bytes, lines, sha256, size, mtime_ns) VALUES (?, 0, 0, '', 0, 0)",
+                                 (source,)).lastrowid
+
+    with open(path, "rb") as f:
+        offset = line_no = 0
+        digest = hashlib.sha256()
+        if known and not force:
+            # Resume after the imported lines if the file still starts with them (an appended corpus)
+            digest, complete = hash_prefix(f, known[0], block_size)
+            if complete and digest.hexdigest() == known[2]:
+                offset, line_no = known[0], known[1]
+            else:
+                digest = hashlib.sha256()
+                f.seek(0)
+
+        # Indexes are cheaper to build once after a load than to maintain row by row, unless the
+        # table already holds far more than this load adds
+        loaded = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM sources WHERE id != ?", (source_id,)).fetchone()[0]
+        rebuild = stat.st_size - offset >= loaded + offset
+        full_text = search.has_index(conn)
+        if rebuild:
+            for name in INDEXES:
+                conn.execute(f"DROP INDEX IF EXISTS {name}")
+            if full_text:
+                search.drop_triggers(conn)
+        conn.execute("DELETE FROM book_lines WHERE source_id = ? AND line_no > ?", (source_id, line_no))
+
+        reader = LineReader(f, source_id, digest, offset, line_no, block_size)
+        count = 0
+        for rows in reader:
+            conn.executemany(INSERT_LINE, rows)
+            count += len(rows)
+
+        if rebuild:
+            for sql in INDEXES.values():
+                conn.execute(sql)
+            if full_text:
+                search.rebuild_index(conn)
+                search.create_index(conn)
+        conn.execute(
+            "UPDATE sources SET bytes = ?, lines = ?, sha256 = ?, size = ?, mtime_ns = ?, imported_at = datetime('now') "
+            "WHERE id = ?",
+            (reader.offset, reader.line_no, reader.digest.hexdigest(), stat.st_size, stat.st_mtime_ns, source_id),
+        )
+    return count, reader.offset - offset
+
+
+def is_up_to_date(path, database=DATABASE):
+    # The same check import_source makes before reading a file
+    if not os.path.exists(database) or not os.path.exists(path):
+        return False
+    conn = get_connection(database)
+    try:
+        known = conn.execute("SELECT size, mtime_ns FROM sources WHERE path = ?", (os.path.abspath(path),)).fetchone()
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+    stat = os.stat(path)
+    return known is not None and known == (stat.st_size, stat.st_mtime_ns)
+
 
-    with open(text_file_path, encoding='utf-8') as f:
-        lines = [line.strip() for line in f if line.strip()]  
+def import_text_to_db(text_file_paths, database=DATABASE, block_size=BLOCK_SIZE, force=False):
+    if isinstance(text_file_paths, str):
+        text_file_paths = [text_file_paths]
+    conn = get_connection(database, create=True)
+    conn.isolation_level = None
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
 
-    cursor.executemany('INSERT INTO book_lines (line) VALUES (?)', [(line,) for line in lines])
+    start = time.perf_counter()
+    total = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        create_tables(conn)
+        if not search.create_index(conn):
+            print("This SQLite has no FTS5, the lines are imported without a full-text index.")
+        for path in text_file_paths:
+            file_start = time.perf_counter()
+            count, size = import_source(conn, path, block_size, force)
+            elapsed = time.perf_counter() - file_start
+            total += count
+            if size or count:
+                print(f"{path}: imported {count} lines ({size / 1e6:.1f} MB) in {elapsed:.2f}s, "
+                      f"{count / max(elapsed, 1e-9):,.0f} rows/s.")
+            else:
+                print(f"{path}: unchanged, nothing to import.")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
 
-    conn.commit()
-    conn.close()
+    elapsed = time.perf_counter() - start
+    print(f"Imported {total} lines into the database in {elapsed:.2f}s ({total / max(elapsed, 1e-9):,.0f} rows/s).")
+    return total
 
-    print(f"Imported {len(lines)} lines into the database.")
 
 if __name__ == "__main__":
-    import_text_to_db(TXT)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Import text files into book_lines, one row per non-blank line")
+    parser.add_argument("paths", nargs="*", default=[TXT])
+    parser.add_argument("--database", default=DATABASE)
+    parser.add_argument("--block-mb", type=int, default=BLOCK_SIZE >> 20, help="bytes read at a time, in MB")
+    parser.add_argument("--force", action="store_true", help="re-import files even if they are unchanged")
+    args = parser.parse_args()
+    import_text_to_db(args.paths, args.database, args.block_mb << 20, args.force)
@@ -1,15 +1,54 @@
+import hashlib
 import pandas as pd
 from database_connection import get_connection
-from config import RAW_DATA_CSV
+from config import DATABASE, RAW_DATA_CSV
 
-def load_data():
+CHUNK_SIZE = 50000
+# Column types of every chunk, so that they do not depend on the values a chunk happens to hold
+COLUMNS = {"id": "int64", "line": "str", "source_id": "int64", "line_no": "int64"}
+PAGE_QUERY = f"SELECT {', '.join(COLUMNS)} FROM book_lines WHERE id > ? ORDER BY id LIMIT ?"
+
+def iter_chunks(chunksize=CHUNK_SIZE, database=DATABASE):
+    # Reads book_lines a page of `chunksize` rows at a time, each page starting after the last id
+    # of the previous one. Every page is a short query that walks the primary key from where the
+    # last one stopped, so memory is bounded by one chunk however large the table is, and no read
+    # transaction stays open between chunks (an import can commit while the stages are working).
+    conn = get_connection(database)
+    try:
+        last_id = -1
+        start = 0
+        while True:
+            chunk = pd.read_sql_query(PAGE_QUERY, conn, params=(last_id, chunksize), dtype=COLUMNS)
+            if chunk.empty:
+                break
+            last_id = int(chunk["id"].iloc[-1])
+            # Number rows across chunks, as a single read would
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+            if len(chunk) < chunksize:
+                break
+    finally:
+        conn.close()
+
+def table_fingerprint():
+    # Changes whenever import_to_db changes book_lines
     conn = get_connection()
-    
-    query = "SELECT * FROM book_lines"
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-    print(f"Loaded {len(df)} rows from the database.")
-    df.to_csv(RAW_DATA_CSV, index=False)
+    try:
+        sources = conn.execute("SELECT id, sha256, bytes FROM sources ORDER BY id").fetchall()
+        lines = conn.execute("SELECT COUNT(*), MAX(id) FROM book_lines").fetchone()
+    finally:
+        conn.close()
+    return hashlib.sha256(repr((sources, lines)).encode()).hexdigest()
+
+def load_data(path=RAW_DATA_CSV, chunksize=CHUNK_SIZE, database=DATABASE):
+    rows = 0
+    for chunk in iter_chunks(chunksize, database):
+        chunk.to_csv(path, mode="a" if rows else "w", header=not rows, index=False)
+        rows += len(chunk)
+    if not rows:
+        pd.DataFrame(columns=list(COLUMNS)).to_csv(path, index=False)
+    print(f"Loaded {rows} rows from the database.")
 
 if __name__ == "__main__":
     load_data()
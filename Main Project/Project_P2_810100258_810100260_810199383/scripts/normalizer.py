@@ -0,0 +1,71 @@
+import os
+import re
+import string
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+# Same output as preprocess.preprocess_text, for a whole list of lines at a time. The lines are
+# joined with NUL (which preprocess_text would delete anyway), non-ASCII whitespace becomes a space,
+# and the UTF-8 bytes go through one precompiled bytes.translate: whitelisted characters stay (upper
+# case letters become lower case), ASCII whitespace becomes a space and every other byte, including
+# all bytes of non-ASCII characters, is deleted. Runs of spaces are then collapsed and the result is
+# split back into lines. Every step runs in C over the whole chunk instead of once per line.
+NORMALIZE_WORKERS = int(os.getenv("NORMALIZE_WORKERS", os.cpu_count() or 1))
+PARALLEL_MIN_LINES = 20000  # Smaller inputs are not worth sending to other processes
+
+SEPARATOR = "\x00"
+KEEP = (string.ascii_letters + string.digits + ",.!?;:'-").encode()
+# \s in a str pattern is str.isspace(): ASCII whitespace includes \x1c-\x1f, which bytes.split() does not know
+ASCII_SPACES = bytes(i for i in range(128) if chr(i).isspace())
+UNICODE_SPACES = re.compile("[" + "".join(chr(i) for i in range(128, 0x110000) if chr(i).isspace()) + "]")
+TABLE = bytes(
+    ord(chr(i).lower()) if i in KEEP else 32 if i in ASCII_SPACES else i
+    for i in range(256)
+)
+DELETE = bytes(i for i in range(256) if i not in KEEP and i not in ASCII_SPACES and i != ord(SEPARATOR))
+
+_pool = None
+_pool_workers = 0
+
+
+def normalize_lines(lines):
+    if not lines:
+        return []
+    joined = SEPARATOR.join(lines)
+    if joined.count(SEPARATOR) != len(lines) - 1:
+        joined = SEPARATOR.join(line.replace(SEPARATOR, "") for line in lines)
+    joined = UNICODE_SPACES.sub(" ", joined)
+    # surrogatepass: lone surrogates are deleted like any other non-ASCII character
+    data = joined.encode("utf-8", "surrogatepass").translate(TABLE, DELETE)
+    # Most text has no double spaces left, and each replace halves the longest run
+    while b"  " in data:
+        data = data.replace(b"  ", b" ")
+    data = data.replace(b" \x00", b"\x00").replace(b"\x00 ", b"\x00").strip(b" ")
+    return data.decode("ascii").split(SEPARATOR)
+
+
+def normalize(text):
+    return normalize_lines([text])[0]
+
+
+def get_pool(workers):
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = ProcessPoolExecutor(workers)
+        _pool_workers = workers
+    return _pool
+
+
+def normalize_column(series, workers=NORMALIZE_WORKERS, min_parallel=PARALLEL_MIN_LINES):
+    # Normalizes a Series of strings, keeping its index. Large inputs are split into one slice
+    # per worker and normalized in a process pool, which is kept for later calls.
+    lines = series.tolist()
+    if workers > 1 and len(lines) >= min_parallel:
+        step = -(-len(lines) // workers)
+        parts = get_pool(workers).map(normalize_lines, [lines[i:i + step] for i in range(0, len(lines), step)])
+        result = [line for part in parts for line in part]
+    else:
+        result = normalize_lines(lines)
+    return pd.Series(result, index=series.index)
@@ -1,17 +1,19 @@
 import pandas as pd
 import re
 from config import RAW_DATA_CSV,PREPROCESSED_CSV
+from normalizer import normalize_column
 def preprocess_text(text):
     text = re.sub(r'[^a-zA-Z0-9\s,.!?;:\'-]', '', text)
     text = re.sub(r'\s+', ' ', text)
     return text.lower().strip()
 
+def preprocess_chunk(df):
+    df['clean_line'] = normalize_column(df['line'])
+    return df[df['clean_line'] != ''].copy()
+
 def main():
     df = pd.read_csv(RAW_DATA_CSV)
-    df['clean_line'] = df['line'].apply(preprocess_text)
-
-   
-    df = df[df['clean_line'] != '']
+    df = preprocess_chunk(df)
 
     print(f"Preprocessed {len(df)} lines.")
     df.to_csv(PREPROCESSED_CSV)
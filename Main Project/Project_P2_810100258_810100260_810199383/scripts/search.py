@@ -0,0 +1,146 @@
+import argparse
+import re
+import sqlite3
+import pandas as pd
+from database_connection import get_connection
+from config import DATABASE
+
+FTS_TABLE = "book_lines_fts"
+TOKENIZER = "unicode61 remove_diacritics 2"
+SNIPPET_TOKENS = 16
+
+# book_lines_fts is an external-content FTS5 index over book_lines.line: it stores only the
+# inverted index and reads the lines themselves from book_lines by id. The triggers keep it in
+# step with every insert, delete and update, so a small import only indexes its own rows. A
+# large load drops the triggers and rebuilds the index once afterwards, like the other indexes.
+TRIGGERS = {
+    "book_lines_fts_insert": f'''
+        CREATE TRIGGER IF NOT EXISTS book_lines_fts_insert AFTER INSERT ON book_lines BEGIN
+            INSERT INTO {FTS_TABLE} (rowid, line) VALUES (new.id, new.line);
+        END
+    ''',
+    "book_lines_fts_delete": f'''
+        CREATE TRIGGER IF NOT EXISTS book_lines_fts_delete AFTER DELETE ON book_lines BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, line) VALUES ('delete', old.id, old.line);
+        END
+    ''',
+    "book_lines_fts_update": f'''
+        CREATE TRIGGER IF NOT EXISTS book_lines_fts_update AFTER UPDATE OF line ON book_lines BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, line) VALUES ('delete', old.id, old.line);
+            INSERT INTO {FTS_TABLE} (rowid, line) VALUES (new.id, new.line);
+        END
+    ''',
+}
+
+
+def fts5_available(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute("DROP TABLE temp.fts5_probe")
+    return True
+
+
+def has_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (FTS_TABLE,)).fetchone() is not None
+
+
+def create_index(conn):
+    # Creates the index and its triggers; an index added to a table that already has lines is
+    # built from them. Returns False if this SQLite has no FTS5.
+    if not fts5_available(conn):
+        return False
+    if not has_index(conn):
+        conn.execute(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(line, content='book_lines', content_rowid='id', "
+                     f"tokenize='{TOKENIZER}')")
+        rebuild_index(conn)
+    for sql in TRIGGERS.values():
+        conn.execute(sql)
+    return True
+
+
+def drop_triggers(conn):
+    for name in TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+
+def rebuild_index(conn):
+    conn.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def quote(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def term_query(word):
+    return quote(word)
+
+
+def phrase_query(text):
+    # The words must appear next to each other, in this order (punctuation between them is ignored)
+    return quote(" ".join(re.findall(r"\w+", text)))
+
+
+def prefix_query(prefix):
+    return quote(prefix) + " *"
+
+
+class LineSearch:
+    # Term, phrase and prefix queries over book_lines, best matches first by BM25. Every result row
+    # has the line's id, source_id, line_no and text, its bm25 score (lower is a better match, as
+    # SQLite ranks them) and a snippet with the matches in `marks`.
+    def __init__(self, database=DATABASE, marks=("[", "]")):
+        self.conn = get_connection(database)
+        self.marks = marks
+        if not has_index(self.conn):
+            self.conn.close()
+            raise Exception(f"Database at {database} has no full-text index, run import_to_db first!")
+
+    def search(self, match, limit=10, offset=0):
+        # `match` is an FTS5 query expression, e.g. from term_query, phrase_query or prefix_query
+        query = f'''
+            SELECT b.id, b.source_id, b.line_no, b.line, f.rank AS bm25,
+                   snippet({FTS_TABLE}, 0, ?, ?, '...', {SNIPPET_TOKENS}) AS snippet
+            FROM {FTS_TABLE} f JOIN book_lines b ON b.id = f.rowid
+            WHERE {FTS_TABLE} MATCH ?
+            ORDER BY f.rank
+            LIMIT ? OFFSET ?
+        '''
+        return pd.read_sql_query(query, self.conn, params=(*self.marks, match, limit, offset))
+
+    def count(self, match):
+        return self.conn.execute(f"SELECT COUNT(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ?", (match,)).fetchone()[0]
+
+    def term(self, word, limit=10):
+        return self.search(term_query(word), limit)
+
+    def phrase(self, text, limit=10):
+        return self.search(phrase_query(text), limit)
+
+    def prefix(self, prefix, limit=10):
+        return self.search(prefix_query(prefix), limit)
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the lines of the imported texts")
+    parser.add_argument("query")
+    parser.add_argument("--mode", choices=["term", "phrase", "prefix", "match"], default="phrase",
+                        help="how to read the query; 'match' passes it to FTS5 as is")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--database", default=DATABASE)
+    args = parser.parse_args()
+
+    queries = {"term": term_query, "phrase": phrase_query, "prefix": prefix_query, "match": lambda q: q}
+    match = queries[args.mode](args.query)
+    search = LineSearch(args.database)
+    try:
+        results = search.search(match, args.limit)
+        print(f"{search.count(match)} matching lines")
+        for row in results.itertuples():
+            print(f"{row.line_no:>8}  {row.bm25:7.2f}  {row.snippet}")
+    finally:
+        search.close()
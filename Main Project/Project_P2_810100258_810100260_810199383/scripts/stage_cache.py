@@ -0,0 +1,129 @@
+import hashlib
+import inspect
+import os
+import sqlite3
+import time
+import pandas as pd
+from config import STAGE_CACHE, STAGE_CACHE_MB
+
+ROW_OVERHEAD = 32  # Rough bytes per cached row on top of its values, for the size bound
+
+
+def code_version(name, modules, params=None):
+    # A stage's version changes with its name, parameters or the source of any module it runs
+    digest = hashlib.sha256(name.encode())
+    for module in modules:
+        digest.update(inspect.getsource(module).encode())
+    digest.update(repr(sorted((params or {}).items())).encode())
+    return digest.hexdigest()[:16]
+
+
+def combine(*parts):
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()[:16]
+
+
+def row_hashes(df, columns):
+    # One 64-bit content hash per row of `columns`, as signed integers for SQLite
+    return pd.util.hash_pandas_object(df[columns], index=False).astype("int64")
+
+
+def value_size(value):
+    return len(value) if isinstance(value, str) else 8
+
+
+class StageCache:
+    # Results of row-wise stages, per stage version: for every input row's content hash, the values
+    # the stage added to it, or that it dropped the row. A chunk only recomputes the rows it has not
+    # seen before, so a changed line costs one row, not a rerun. Also keeps the stage key that each
+    # materialized file was written with, so an up to date file is not written again.
+    # Each stage version is one table; once the recorded bytes exceed `max_bytes` the least
+    # recently used versions are dropped and their pages released.
+    def __init__(self, path=STAGE_CACHE, max_bytes=STAGE_CACHE_MB << 20):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                version TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                columns TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self.conn.execute("CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, key TEXT NOT NULL)")
+        self.conn.execute("CREATE TEMP TABLE wanted (hash INTEGER PRIMARY KEY)")
+        self.conn.commit()
+        self.used = set()
+
+    def has(self, version):
+        return self.conn.execute("SELECT 1 FROM entries WHERE version = ?", (version,)).fetchone() is not None
+
+    def open(self, stage, version, columns):
+        # Creates the table for a stage version on first use and marks it as recently used
+        self.used.add(version)
+        if not self.has(version):
+            names = ", ".join(f'"{column}"' for column in columns)
+            self.conn.execute(f'CREATE TABLE "rows_{version}" (hash INTEGER PRIMARY KEY, kept INTEGER NOT NULL, {names})')
+            self.conn.execute("INSERT INTO entries (version, stage, columns, bytes, last_used) VALUES (?, ?, ?, 0, ?)",
+                              (version, stage, ",".join(columns), time.time()))
+        else:
+            self.conn.execute("UPDATE entries SET last_used = ? WHERE version = ?", (time.time(), version))
+
+    def lookup(self, version, hashes):
+        # Returns (DataFrame of kept rows indexed by hash, set of dropped hashes) for the known hashes
+        self.conn.execute("DELETE FROM wanted")
+        self.conn.executemany("INSERT OR IGNORE INTO wanted (hash) VALUES (?)", ((h,) for h in hashes.tolist()))
+        table = f'"rows_{version}"'
+        kept = pd.read_sql_query(f"SELECT r.* FROM {table} r JOIN wanted USING (hash) WHERE r.kept = 1", self.conn,
+                                 index_col="hash").drop(columns="kept")
+        dropped = {row[0] for row in self.conn.execute(f"SELECT r.hash FROM {table} r JOIN wanted USING (hash) WHERE r.kept = 0")}
+        return kept, dropped
+
+    def store(self, version, kept, dropped):
+        # `kept`: new rows' values indexed by hash; `dropped`: hashes of rows the stage dropped
+        columns = list(kept.columns)
+        names = ", ".join(["hash", "kept"] + [f'"{column}"' for column in columns])
+        marks = ", ".join("?" * (len(columns) + 2))
+        values = [kept[column].tolist() for column in columns]
+        rows = [(h, 1, *row) for h, *row in zip(kept.index.tolist(), *values)]
+        rows += [(h, 0) + (None,) * len(columns) for h in dropped]
+        self.conn.executemany(f'INSERT OR REPLACE INTO "rows_{version}" ({names}) VALUES ({marks})', rows)
+        size = sum(value_size(v) for column in values for v in column) + len(rows) * ROW_OVERHEAD
+        self.conn.execute("UPDATE entries SET bytes = bytes + ? WHERE version = ?", (size, version))
+
+    def output_key(self, path):
+        row = self.conn.execute("SELECT key FROM outputs WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return row[0] if row and os.path.exists(path) else None
+
+    def set_output_key(self, path, key):
+        self.conn.execute("INSERT OR REPLACE INTO outputs (path, key) VALUES (?, ?)", (os.path.abspath(path), key))
+
+    def evict(self):
+        # Drops least recently used stage versions, never one used in this run, until under the bound
+        total = self.conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+        evicted = []
+        for version, size in self.conn.execute("SELECT version, bytes FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            if version in self.used:
+                continue
+            self.conn.execute(f'DROP TABLE "rows_{version}"')
+            self.conn.execute("DELETE FROM entries WHERE version = ?", (version,))
+            total -= size
+            evicted.append(version)
+        self.conn.commit()
+        if evicted:
+            self.conn.execute("PRAGMA incremental_vacuum")
+        return evicted
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.evict()
+        self.conn.close()
@@ -0,0 +1,233 @@
+import os
+import time
+import pandas as pd
+from stage_cache import code_version, combine, row_hashes
+
+
+class StageError(Exception):
+    def __init__(self, stage, error):
+        super().__init__(f"Stage '{stage}' failed: {error!r}")
+        self.stage = stage
+        self.error = error
+
+
+class CsvWriter:
+    # Appends chunks to one CSV under a temporary name; the file only appears at `path` once the
+    # whole run succeeded, so a failed run never leaves a truncated CSV behind.
+    def __init__(self, path, index=False):
+        self.path = path
+        self.index = index
+        self.partial = path + ".partial"
+        self.started = False
+        self.up_to_date = False
+
+    def write(self, df):
+        df.to_csv(self.partial, mode="a" if self.started else "w", header=not self.started, index=self.index)
+        self.started = True
+
+    def close(self, ok):
+        if not self.started:
+            return
+        if ok:
+            os.replace(self.partial, self.path)
+        else:
+            os.remove(self.partial)
+
+
+class Stage:
+    def __init__(self, name, fn, input=None, materialize=None, index=False, code=(), params=None,
+                 reads=None, writes=None, fingerprint=None, up_to_date=None):
+        self.name = name
+        self.fn = fn
+        self.input = input
+        # A path is written as CSV; anything else is a writer with CsvWriter's interface
+        self.writer = CsvWriter(materialize, index) if isinstance(materialize, str) else materialize
+        self.version = code_version(name, code, params)
+        self.reads = reads
+        self.writes = writes
+        self.fingerprint = fingerprint
+        self.up_to_date = up_to_date
+        self.key = None
+        self.children = []
+        self.chunks = 0
+        self.rows = 0
+        self.reused = 0
+        self.seconds = 0.0
+        self.skipped = False
+
+
+class StageGraph:
+    # Stages run in one process and pass DataFrame chunks to each other. A stage without an input is
+    # a source: fn() returns an iterable of chunks, or None for a step that only has side effects.
+    # Any other stage gets fn(chunk) for every chunk of its input and returns the chunk for its own
+    # children (or None to pass nothing on). Sources run in the order they were added, each one's
+    # chunks are pushed through all stages below it before the next chunk is read, so only a few
+    # chunks are in memory at a time. A stage's output is only written to CSV when it has a
+    # `materialize` path.
+    #
+    # With a StageCache, every stage below a source with a `fingerprint` gets a key: a hash of the
+    # fingerprint and the versions (code, parameters) of the stages on the way. Files already
+    # written with their stage's key are not written again, and a source whose files are all up
+    # to date is skipped. Stages that declare the columns they `reads` and `writes` are cached
+    # per row: they only see the rows whose input they have not processed before.
+    def __init__(self, cache=None, force=False):
+        self.stages = {}
+        self.cache = cache
+        self.force = force
+
+    def add(self, name, fn, input=None, materialize=None, index=False, **options):
+        if name in self.stages:
+            raise ValueError(f"Stage '{name}' is already defined")
+        if input is not None and input not in self.stages:
+            raise ValueError(f"Stage '{name}' reads from unknown stage '{input}'")
+        stage = Stage(name, fn, input, materialize, index, **options)
+        self.stages[name] = stage
+        if input is not None:
+            self.stages[input].children.append(stage)
+        return stage
+
+    def subtree(self, stage):
+        yield stage
+        for child in stage.children:
+            yield from self.subtree(child)
+
+    def assign_keys(self, stage, key):
+        stage.key = key
+        for child in stage.children:
+            self.assign_keys(child, combine(child.version, key))
+
+    def apply(self, stage, *args):
+        try:
+            return stage.fn(*args)
+        except Exception as e:
+            raise StageError(stage.name, e) from e
+
+    def call(self, stage, *args):
+        start = time.perf_counter()
+        try:
+            if args and self.cache and stage.reads:
+                return self.call_cached(stage, args[0])
+            return self.apply(stage, *args)
+        finally:
+            stage.seconds += time.perf_counter() - start
+
+    def call_cached(self, stage, chunk):
+        hashes = row_hashes(chunk, stage.reads)
+        self.cache.open(stage.name, stage.version, stage.writes)
+        if self.force:
+            known, dropped = pd.DataFrame(columns=stage.writes), set()
+        else:
+            known, dropped = self.cache.lookup(stage.version, hashes.unique())
+        missing = ~(hashes.isin(known.index) | hashes.isin(dropped))
+        stage.reused += int(len(chunk) - missing.sum())
+        if missing.any():
+            computed = self.apply(stage, chunk[missing].copy())
+            new = computed[stage.writes].set_axis(hashes[computed.index].to_numpy())
+            new = new[~new.index.duplicated()]
+            new_dropped = set(hashes[missing & ~chunk.index.isin(computed.index)].tolist())
+            self.cache.store(stage.version, new, new_dropped)
+            known = new if known.empty else pd.concat([known, new])
+            dropped |= new_dropped
+        keep = ~hashes.isin(dropped)
+        out = chunk[keep].copy()
+        for column in stage.writes:
+            out[column] = known[column].reindex(hashes[keep].to_numpy()).to_numpy()
+        return out
+
+    def push(self, stage, chunk):
+        stage.chunks += 1
+        stage.rows += len(chunk)
+        if stage.writer and not stage.writer.up_to_date:
+            start = time.perf_counter()
+            stage.writer.write(chunk)
+            stage.seconds += time.perf_counter() - start
+        for child in stage.children:
+            out = self.call(child, chunk)
+            if out is not None:
+                self.push(child, out)
+
+    def check_outputs(self, source):
+        # Marks the files below `source` that are up to date; True if all of them are
+        writers = [stage.writer for stage in self.subtree(source) if stage.writer]
+        for stage in self.subtree(source):
+            if stage.writer:
+                stage.writer.up_to_date = (not self.force and self.cache is not None
+                                           and self.cache.output_key(stage.writer.path) == stage.key)
+        return bool(writers) and all(writer.up_to_date for writer in writers)
+
+    def run_source(self, stage):
+        if stage.fingerprint and self.cache:
+            self.assign_keys(stage, combine(stage.version, stage.fingerprint()))
+            if self.check_outputs(stage):
+                for skipped in self.subtree(stage):
+                    skipped.skipped = True
+                return
+        chunks = self.call(stage)
+        if chunks is None:
+            return
+        chunks = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            except Exception as e:
+                raise StageError(stage.name, e) from e
+            finally:
+                stage.seconds += time.perf_counter() - start
+            self.push(stage, chunk)
+
+    def run(self):
+        ok = False
+        try:
+            for stage in self.stages.values():
+                if stage.input is None:
+                    self.run_source(stage)
+            ok = True
+        finally:
+            for stage in self.stages.values():
+                if stage.writer:
+                    start = time.perf_counter()
+                    stage.writer.close(ok)
+                    stage.seconds += time.perf_counter() - start
+            if self.cache:
+                if ok:
+                    for stage in self.stages.values():
+                        if stage.writer and stage.writer.started and stage.key:
+                            self.cache.set_output_key(stage.writer.path, stage.key)
+                self.cache.commit()
+
+    def plan(self):
+        # What run() would do, without running anything: (stage, status) pairs
+        plan = []
+        changed = False
+        for source in self.stages.values():
+            if source.input is not None:
+                continue
+            if source.fingerprint is None:
+                fresh = not self.force and source.up_to_date is not None and source.up_to_date()
+                changed = changed or not fresh
+                plan.append((source.name, "up to date" if fresh else "would run"))
+                continue
+            if self.cache and not changed:
+                self.assign_keys(source, combine(source.version, source.fingerprint()))
+                if self.check_outputs(source):
+                    plan.extend((stage.name, "skipped, outputs up to date") for stage in self.subtree(source))
+                    continue
+            for stage in self.subtree(source):
+                status = "would run"
+                if stage.reads and self.cache and not self.force and self.cache.has(stage.version):
+                    status += ", reusing cached rows"
+                if stage.writer:
+                    status += ", output up to date" if stage.writer.up_to_date else f", writes {stage.writer.path}"
+                plan.append((stage.name, status))
+        return plan
+
+    def report(self):
+        lines = [f"{'stage':<22}{'chunks':>8}{'rows':>12}{'reused':>12}{'seconds':>10}"]
+        for stage in self.stages.values():
+            seconds = "skipped" if stage.skipped else f"{stage.seconds:.2f}"
+            lines.append(f"{stage.name:<22}{stage.chunks:>8}{stage.rows:>12}{stage.reused:>12}{seconds:>10}")
+        lines.append(f"{'total':<22}{'':>8}{'':>12}{'':>12}{sum(s.seconds for s in self.stages.values()):>10.2f}")
+        return "\n".join(lines)